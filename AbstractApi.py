@@ -1,8 +1,19 @@
+import copy
+import dataclasses
+import json
+import os
+import time
 from abc import ABC, abstractmethod
-from typing import Optional
+from typing import Any, Callable, Optional
 
 import typing_extensions as typing
 
+import rate_limiter
+import telemetry
+from prompt_templates import PrefixTracker, RenderedPrompt
+from response_cache import ResponseCache, get_default_cache
+from typed_decoders import DecodeError, compile_decoder
+
 
 class Feedback(typing.TypedDict):
     grade: str
@@ -31,9 +42,228 @@ class FeedbackCollection(typing.TypedDict):
     feedback_collection: list[AugmentedFeedback]
 
 
+class IndexedFeedback(typing.TypedDict):
+    index: int
+    grade: str
+    suggestion: Optional[str]
+
+
+class FeedbackBatch(typing.TypedDict):
+    feedback: list[IndexedFeedback]
+
+
+DEFAULT_CONTEXT_WINDOW = 8192
+DEFAULT_POOL_SIZE = 32
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 300.0
+# Tokens reserved for the answer to a single criterion when packing criteria into one request
+ANSWER_TOKENS_PER_CRITERION = 200
+
+
+def context_window_for(model: str, windows: dict[str, int], default: int = DEFAULT_CONTEXT_WINDOW) -> int:
+    """Context window of the model from windows, whose keys are models or prefixes of models, e.g.
+    {"llama3.2": 4096, "gpt-4o": 128000}. The longest matching key wins, default applies to models without a key."""
+    matches = [prefix for prefix in windows if model.startswith(prefix)]
+    if matches:
+        return int(windows[max(matches, key=len)])
+    return default
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (about four characters per token) which does not depend on the model's tokenizer."""
+    return len(text) // 4 + 1
+
+
+def format_criterion(criterion: Criterion) -> str:
+    return f"{criterion.get('title', '')}: {criterion.get('explanation', '')}"
+
+
+def format_feedback(feedback: FeedbackCollection) -> str:
+    """Formats the feedback as one line per criterion for the refinement prompt."""
+    lines = []
+    for augmented_feedback in feedback.get('feedback_collection', []):
+        grade = augmented_feedback.get('feedback', {})
+        lines.append(f"- {format_criterion(augmented_feedback.get('criterion', {}))} Grade: {grade.get('grade')}, "
+                     f"Suggestion: {grade.get('suggestion') or '-'}")
+    return "\n".join(lines)
+
+
+@dataclasses.dataclass
+class ApiSettings:
+    """Settings of a backend instance. Unless given explicitly, they are read from the environment when the instance
+    is created, see settings_from_env. Backends with further settings extend this class."""
+    api_key: Optional[str] = None
+    base_url: Optional[str] = None
+    # None lets the server choose a seed
+    seed: Optional[int] = None
+    # Maximum number of kept-alive connections
+    pool_size: int = DEFAULT_POOL_SIZE
+    connect_timeout: float = DEFAULT_CONNECT_TIMEOUT
+    read_timeout: float = DEFAULT_READ_TIMEOUT
+    # Number of criteria graded in a single request, 1 grades every criterion on its own
+    batch_size: int = 1
+    # Context window of models without an entry in context_windows, whose keys are models or prefixes of models
+    context_window: int = DEFAULT_CONTEXT_WINDOW
+    context_windows: dict[str, int] = dataclasses.field(default_factory=dict)
+    # Requests failing with a RetryableError are retried until max_attempts or retry_deadline seconds are reached
+    max_attempts: int = rate_limiter.DEFAULT_MAX_ATTEMPTS
+    retry_deadline: float = rate_limiter.DEFAULT_RETRY_DEADLINE
+
+
 class AbstractApi(ABC):
-    def __init__(self, model):
+    # Name of the backend, part of the response cache key
+    backend = "abstract"
+    # Version of the prompts, has to be increased when they change so that existing outputs are rebuilt
+    prompt_version = "4"
+
+    def __init__(self, model, cache: Optional[ResponseCache] = None, batch_size: Optional[int] = None,
+                 context_window: Optional[int] = None, settings: Optional[ApiSettings] = None):
         self.model = model
+        self.settings = settings if settings is not None else self.settings_from_env()
+        # Seed sent with every request
+        self.seed = self.settings.seed
+        self.cache = cache if cache is not None else get_default_cache()
+        self.batch_size = batch_size or self.settings.batch_size
+        self.context_window = context_window or context_window_for(model, self.settings.context_windows,
+                                                                   self.settings.context_window)
+        self.max_attempts = self.settings.max_attempts
+        self.retry_deadline = self.settings.retry_deadline
+        self._prefixes = PrefixTracker()
+
+    @classmethod
+    def settings_from_env(cls) -> ApiSettings:
+        """Reads the settings shared by all backends, backends add e.g. their API key and base URL."""
+        return ApiSettings(seed=int(os.getenv("seed")) if os.getenv("seed") else None,
+                           pool_size=int(os.getenv("http-pool-size", DEFAULT_POOL_SIZE)),
+                           connect_timeout=float(os.getenv("http-connect-timeout", DEFAULT_CONNECT_TIMEOUT)),
+                           read_timeout=float(os.getenv("http-read-timeout", DEFAULT_READ_TIMEOUT)),
+                           batch_size=int(os.getenv("batch-size", 1)),
+                           context_window=int(os.getenv("context-window", DEFAULT_CONTEXT_WINDOW)),
+                           context_windows=json.loads(os.getenv("context-windows", "{}")),
+                           max_attempts=int(os.getenv("max-attempts", rate_limiter.DEFAULT_MAX_ATTEMPTS)),
+                           retry_deadline=float(os.getenv("retry-deadline", rate_limiter.DEFAULT_RETRY_DEADLINE)))
+
+    def with_seed(self, seed: int) -> "AbstractApi":
+        """Returns a copy generating with the seed, which shares the connections and the cache of this instance."""
+        api = copy.copy(self)
+        api.settings = dataclasses.replace(self.settings, seed=seed)
+        api.seed = seed
+        return api
+
+    def _prompt(self, request: Any, response_format: Any, seed: Any, send: Callable[[], Any],
+                schema: Any = None, prompt: Optional[RenderedPrompt] = None) -> Any:
+        """Returns the response to the request from the cache or by calling send.
+
+        :param request: JSON-serializable prompt or message list which is sent to the model.
+        :param response_format: Format the answer is requested in, e.g. a TypedDict class.
+        :param seed: Seed used for the generation.
+        :param send: Function sending the request to the model and returning the JSON-serializable answer.
+        :param schema: TypedDict the answer is decoded as, by default the response format if it is a TypedDict.
+        Answers which do not match raise a DecodeError and are not cached.
+        :param prompt: Rendered template the request was built from, used to report how often its prefix is reused.
+        """
+        if schema is None and typing.is_typeddict(response_format):
+            schema = response_format
+        decoder = compile_decoder(schema) if schema is not None else (lambda value: value)
+        key = ResponseCache.make_key(self.backend, self.model, request, response_format, seed)
+        start = time.perf_counter()
+        record = telemetry.CallRecord(stage=telemetry.current_stage(), backend=self.backend, model=self.model,
+                                      cache=self.cache.mode, queue_seconds=telemetry.take_queue_seconds())
+        try:
+            response = self.cache.get(key) if self.cache.mode == "use" else None
+            if response is not None:
+                try:
+                    decoded = decoder(response)
+                    record.cache = "hit"
+                    return decoded
+                except DecodeError:
+                    # Cached before the answer was validated, ask the model again
+                    pass
+            if self.cache.mode == "use":
+                record.cache = "miss"
+            if prompt is not None:
+                record.prompt_chars = len(prompt.text)
+                record.prefix_chars = len(prompt.static_prefix)
+                record.prefix_reused = self._prefixes.seen(prompt.static_prefix)
+            with telemetry.track_call(record):
+                response = self._send_with_retries(request, send, record)
+                with telemetry.timed("parse"):
+                    decoded = decoder(response)
+            self.cache.put(key, response)
+            return decoded
+        except Exception as e:
+            record.error = repr(e)
+            raise
+        finally:
+            record.total_seconds = time.perf_counter() - start
+            telemetry.get_telemetry().record(record)
+
+    def _send_with_retries(self, request: Any, send: Callable[[], Any], record: telemetry.CallRecord) -> Any:
+        """Calls send once the backend's admission controller admits the request, retrying on RetryableError."""
+        controller = rate_limiter.get_controller(self.backend)
+        estimated_tokens = estimate_tokens(json.dumps(request, ensure_ascii=False))
+
+        def on_retry(_):
+            record.retries += 1
+
+        response = rate_limiter.call_with_retries(controller, send, estimated_tokens, self.max_attempts,
+                                                  self.retry_deadline, on_retry)
+        used_tokens = record.prompt_tokens + record.completion_tokens
+        if used_tokens:
+            controller.record_tokens(used_tokens - estimated_tokens)
+        return response
+
+    def split_criteria(self, criteria: list[Criterion], prompt_overhead: str) -> list[list[Criterion]]:
+        """Splits the criteria into batches of at most batch_size criteria which fit into the context window.
+
+        :param prompt_overhead: Part of the prompt which is repeated in every request, e.g. the system prompt
+        and the requirement.
+        """
+        budget = self.context_window - estimate_tokens(prompt_overhead)
+        batches: list[list[Criterion]] = []
+        batch: list[Criterion] = []
+        used = 0
+        for criterion in criteria:
+            cost = estimate_tokens(format_criterion(criterion)) + ANSWER_TOKENS_PER_CRITERION
+            if batch and (len(batch) >= self.batch_size or used + cost > budget):
+                batches.append(batch)
+                batch, used = [], 0
+            batch.append(criterion)
+            used += cost
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _collect_feedback(self, criteria: Criteria, requirement: str, prompt_overhead: str,
+                          evaluate_criterion: Callable[[Criterion, str], Feedback],
+                          evaluate_batch: Callable[[list[Criterion], str], FeedbackBatch]) -> FeedbackCollection:
+        """Grades all criteria, batching them if batch_size > 1.
+
+        Criteria missing from a batched answer are graded on their own, so the result always contains one
+        AugmentedFeedback per criterion in the order of the criteria.
+        """
+        collection: list[AugmentedFeedback] = []
+        for batch in self.split_criteria(criteria.get('criteria', []), prompt_overhead):
+            if len(batch) == 1:
+                collection.append(AugmentedFeedback(criterion=batch[0],
+                                                    feedback=evaluate_criterion(batch[0], requirement)))
+                continue
+            try:
+                answers = {answer['index']: answer for answer in evaluate_batch(batch, requirement)['feedback']}
+            except DecodeError:
+                # Malformed batch answer, every criterion of the batch is graded on its own
+                answers = {}
+            for index, criterion in enumerate(batch, start=1):
+                answer = answers.get(index)
+                if answer is None or not answer.get('grade'):
+                    feedback = evaluate_criterion(criterion, requirement)
+                else:
+                    feedback = Feedback(grade=answer['grade'], suggestion=answer.get('suggestion'))
+                collection.append(AugmentedFeedback(criterion=criterion, feedback=feedback))
+        return FeedbackCollection(feedback_collection=collection)
+
+    def close(self):
+        """Releases resources held for the run, e.g. models kept loaded by the server."""
 
     @abstractmethod
     def determine_criteria(self, unstructured_guideline: str) -> Criteria:
@@ -0,0 +1,145 @@
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+import typing_extensions as typing
+
+from AbstractApi import AbstractApi, ApiSettings, AugmentedFeedback, Criteria, Criterion, Feedback, \
+    FeedbackCollection, ImprovedRequirement
+from scheduler import backend_slot
+from typed_decoders import DecodeError
+
+DEFAULT_SEEDS = 2
+DEFAULT_ESCALATE_GRADES = ("D", "E")
+VALID_GRADES = "ABCDEF"
+
+
+@dataclass
+class CascadeSettings(ApiSettings):
+    # Models of the tiers, cheapest first
+    models: list[str] = field(default_factory=list)
+    # Number of seeds every tier but the last grades with, a criterion is escalated if they disagree
+    seeds: int = DEFAULT_SEEDS
+    escalate_grades: tuple[str, ...] = DEFAULT_ESCALATE_GRADES
+
+
+class CascadeFeedback(AugmentedFeedback):
+    # Model of the tier whose grade was used
+    decided_by: str
+
+
+class CascadeFeedbackCollection(FeedbackCollection):
+    # Feedback of every tier for the criteria it graded, only present if a criterion was escalated
+    tier_feedback: typing.NotRequired[dict[str, FeedbackCollection]]
+
+
+def is_valid_grade(feedback: Optional[Feedback]) -> bool:
+    grade = (feedback or {}).get('grade')
+    return isinstance(grade, str) and len(grade.strip()) == 1 and grade.strip().upper() in VALID_GRADES
+
+
+class CascadeApi(AbstractApi):
+    """Grades the criteria with the cheapest model first and escalates a criterion to the next model only if the
+    grade is uncertain: malformed, different between seeds or a borderline grade.
+
+    The tiers are configured by the models of the settings, cheapest first. The last tier decides all criteria
+    which reach it. Criteria are generated by the last tier, as they are only generated once per subject, and
+    requirements are refined by the first tier, as they are refined once per requirement. Within a JobScheduler,
+    every request to a tier holds a slot of the tier's backend.
+    """
+    backend = "cascade"
+
+    def __init__(self, model, cache=None, settings: Optional[ApiSettings] = None,
+                 tiers: Optional[list[AbstractApi]] = None):
+        if settings is not None and not isinstance(settings, CascadeSettings):
+            settings = CascadeSettings(**asdict(settings))
+        super().__init__(model, cache, settings=settings)
+        if not tiers:
+            raise ValueError("The cascade needs at least one model, set cascade-models")
+        self.tiers = tiers
+        # Inputs are split and trimmed for the smallest model, as every tier may see them
+        self.context_window = min(tier.context_window for tier in tiers)
+        self.seeds = self.settings.seeds
+        self.escalate_grades = set(self.settings.escalate_grades)
+        # Outputs are rebuilt if the cascade changes
+        self.prompt_version = "|".join([AbstractApi.prompt_version, *(tier.model for tier in tiers), str(self.seeds),
+                                        "".join(sorted(self.escalate_grades))])
+
+    @classmethod
+    def settings_from_env(cls) -> CascadeSettings:
+        return CascadeSettings(**asdict(super().settings_from_env()),
+                               models=json.loads(os.getenv("cascade-models", "[]")),
+                               seeds=int(os.getenv("cascade-seeds", DEFAULT_SEEDS)),
+                               escalate_grades=tuple(json.loads(os.getenv("cascade-escalate-grades", "null"))
+                                                     or DEFAULT_ESCALATE_GRADES))
+
+    def determine_criteria(self, unstructured_guideline: str) -> Criteria:
+        with backend_slot(self.tiers[-1].backend):
+            return self.tiers[-1].determine_criteria(unstructured_guideline)
+
+    def refine_requirement(self, feedback: FeedbackCollection, requirement: str) -> ImprovedRequirement:
+        with backend_slot(self.tiers[0].backend):
+            return self.tiers[0].refine_requirement(feedback, requirement)
+
+    def analyze_requirement(self, criteria: Criteria, requirement: str) -> CascadeFeedbackCollection:
+        all_criteria = criteria.get('criteria', [])
+        decided: dict[int, CascadeFeedback] = {}
+        tier_feedback: dict[str, list[AugmentedFeedback]] = {}
+        pending = list(range(len(all_criteria)))
+        for level, tier in enumerate(self.tiers):
+            last = level == len(self.tiers) - 1
+            # The first seed is the tier's own, so its answers are shared with runs of the model on its own
+            base_seed = tier.seed if tier.seed is not None else 0
+            apis = [tier] if last else [tier] + [tier.with_seed(base_seed + offset) for offset in range(1, self.seeds)]
+            subset = [all_criteria[index] for index in pending]
+            with backend_slot(tier.backend):
+                runs = [self._grade(api, subset, requirement) for api in apis]
+
+            escalated = []
+            for position, index in enumerate(pending):
+                answers = [run[position] for run in runs]
+                if answers[0] is not None:
+                    tier_feedback.setdefault(tier.model, []).append(
+                        AugmentedFeedback(criterion=all_criteria[index], feedback=answers[0]))
+                if last and answers[0] is None:
+                    raise DecodeError(f"{tier.model} answered malformed feedback for "
+                                      f"'{all_criteria[index].get('title', '')}'")
+                if last or not self._uncertain(answers):
+                    decided[index] = CascadeFeedback(criterion=all_criteria[index], feedback=answers[0],
+                                                     decided_by=tier.model)
+                else:
+                    escalated.append(index)
+            pending = escalated
+            if not pending:
+                break
+
+        result = CascadeFeedbackCollection(feedback_collection=[decided[index] for index in range(len(all_criteria))])
+        if len(tier_feedback) > 1:
+            result['tier_feedback'] = {model: FeedbackCollection(feedback_collection=feedback)
+                                       for model, feedback in tier_feedback.items()}
+        return result
+
+    def _uncertain(self, answers: list[Optional[Feedback]]) -> bool:
+        if not all(is_valid_grade(answer) for answer in answers):
+            return True
+        grades = {answer['grade'].strip().upper() for answer in answers}
+        return len(grades) > 1 or not grades.isdisjoint(self.escalate_grades)
+
+    @staticmethod
+    def _grade(api: AbstractApi, criteria: list[Criterion], requirement: str) -> list[Optional[Feedback]]:
+        """Grades the criteria with the api, None for every criterion whose answer was malformed."""
+        try:
+            collection = api.analyze_requirement(Criteria(criteria=criteria), requirement)['feedback_collection']
+        except DecodeError:
+            # Grade every criterion on its own, so a single malformed answer does not escalate all of them
+            collection = []
+            for criterion in criteria:
+                try:
+                    answer = api.analyze_requirement(Criteria(criteria=[criterion]), requirement)
+                    collection.append((answer['feedback_collection'] or [None])[0])
+                except DecodeError:
+                    collection.append(None)
+        answers = [augmented_feedback.get('feedback') if augmented_feedback else None
+                   for augmented_feedback in collection]
+        return (answers + [None] * len(criteria))[:len(criteria)]
@@ -1,27 +1,40 @@
-from AbstractApi import AbstractApi, Feedback, ImprovedRequirement, Criteria, Criterion, AugmentedFeedback, \
+from typing import Optional
+
+from AbstractApi import AbstractApi, ApiSettings, Feedback, ImprovedRequirement, Criteria, Criterion, AugmentedFeedback, \
     FeedbackCollection
 
 
 class MockApi(AbstractApi):
-    def __init__(self, model):
-        super().__init__(model)
+    backend = "mock"
 
+    def __init__(self, model, cache=None, settings: Optional[ApiSettings] = None):
+        super().__init__(model, cache, settings=settings)
 
     def determine_criteria(self, unstructured_guideline: str) -> Criteria:
-        print("MockApi determine_criteria was called")
-        criterion: Criterion = {'title' : 'TestCriterion', 'explanation' : "TestExplanation"}
-        criteria: Criteria = {'criteria' : [criterion]}
-        return criteria
+        def send():
+            print("MockApi determine_criteria was called")
+            criterion: Criterion = {'title' : 'TestCriterion', 'explanation' : "TestExplanation"}
+            criteria: Criteria = {'criteria' : [criterion]}
+            return criteria
+
+        return self._prompt(unstructured_guideline, Criteria, self.seed, send)
 
     def analyze_requirement(self, criteria: Criteria, requirement: str) -> FeedbackCollection:
-        print("MockApi analyze_requirement was called")
-        feedback: Feedback = {'grade': 'B', 'suggestion': 'This is a mock suggestion.'}
-        augmented_feedback: AugmentedFeedback = {'feedback': feedback, 'criterion': criteria['criteria'][0]}
-        feedback_collection: FeedbackCollection = {'feedback_collection': [augmented_feedback]}
-        return feedback_collection
+        def send():
+            print("MockApi analyze_requirement was called")
+            feedback: Feedback = {'grade': 'B', 'suggestion': 'This is a mock suggestion.'}
+            # One feedback per criterion like the real backends, so results can be combined per criterion
+            feedback_collection: FeedbackCollection = {'feedback_collection': [
+                AugmentedFeedback(feedback=feedback, criterion=criterion) for criterion in criteria['criteria']]}
+            return feedback_collection
+
+        return self._prompt([criteria, requirement], FeedbackCollection, self.seed, send)
 
     def refine_requirement(self, feedback: list[AugmentedFeedback], requirement: str) -> ImprovedRequirement:
-        print("MockApi refine_requirement was called")
-        improved_requirement: ImprovedRequirement = {'improved_requirement': requirement + ' (Refined)'}
-        return improved_requirement
+        def send():
+            print("MockApi refine_requirement was called")
+            improved_requirement: ImprovedRequirement = {'improved_requirement': requirement + ' (Refined)'}
+            return improved_requirement
+
+        return self._prompt([feedback, requirement], ImprovedRequirement, self.seed, send)
 
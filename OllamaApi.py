@@ -1,72 +1,311 @@
 import json
 import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Optional, Union
 
-import requests
+import httpx
 
-from AbstractApi import AbstractApi, Criteria, Feedback, ImprovedRequirement, AugmentedFeedback
+from AbstractApi import AbstractApi, ApiSettings, Criteria, Feedback, ImprovedRequirement, AugmentedFeedback, Criterion, \
+    FeedbackBatch, FeedbackCollection, format_criterion, format_feedback
+from prompt_templates import RenderedPrompt
+import prompt_templates
+import telemetry
+from incremental_json import IncrementalJsonParser
+from rate_limiter import RetryableError, status_error
+from typed_decoders import DecodeError, parse_model_json
 
-OLLAMA_BASE_URL = os.getenv("ollama_base_url")
-SEED = 42
+DEFAULT_POOL_SIZE = 32
+# Ollama's own default, which close() hands the models back to
+OLLAMA_DEFAULT_KEEP_ALIVE = "5m"
+# Keeps the models loaded during a run, but releases them in time if a run is killed before it can call close()
+DEFAULT_KEEP_ALIVE = "30m"
+# Number of evaluated requirement prefixes whose context is kept for follow-up requests
+MAX_CONTEXTS = 64
 
-def prompt_model_ollama_json(prompt, model):
-    """Sends a request to the specified model via Ollama. The prompt must specify that the result should be valid json.
-    :return: Json object created from the answer"""
-    response = requests.post(OLLAMA_BASE_URL + 'api/generate/', json={
+
+def _generate_url(base_url=None) -> str:
+    return (base_url or os.getenv("ollama_base_url")) + 'api/generate/'
+
+
+def _generate_payload(prompt, model, stream=False, keep_alive=None, context=None, seed=None):
+    payload = {
         'model': model,
         'prompt': prompt,
         'format': 'json',
-        'stream': False,
-        'seed': SEED
-    })
+        'stream': stream,
+    }
+    # Ollama only reads the seed from the model options
+    if seed is not None:
+        payload['options'] = {'seed': seed}
+    if keep_alive is not None:
+        payload['keep_alive'] = keep_alive
+    if context is not None:
+        payload['context'] = context
+    return payload
+
+
+def _parse_keep_alive(value: str):
+    """Ollama expects a number of seconds or a duration string like "30m"."""
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def create_client(pool_size: int = DEFAULT_POOL_SIZE, timeout=None) -> httpx.Client:
+    """Creates a thread-safe client keeping up to pool_size connections to the Ollama server alive."""
+    return httpx.Client(limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+                        timeout=timeout)
+
+
+def _raise_for_status(response: httpx.Response):
+    """Raises a RetryableError for 429, 503 and other transient errors and httpx's error for all other error
+    statuses."""
+    error = status_error("Ollama", response.status_code, response.headers.get('Retry-After'))
+    if error is not None:
+        raise error
     response.raise_for_status()
-    content = json.loads(json.loads(response.content).get('response'))
+
+
+def prompt_model_ollama_json(prompt, model, client: httpx.Client = None, timeout=None, base_url=None,
+                             keep_alive=None, context=None, seed=None):
+    """Sends a request to the specified model via Ollama. The prompt must specify that the result should be valid json.
+    :param client: Client whose connection pool is used. Without a client, a new connection is opened.
+    :param timeout: Timeout in seconds or as httpx.Timeout, by default the client's.
+    :param keep_alive: How long Ollama keeps the model loaded after the request, e.g. "30m".
+    :param context: Context returned by an earlier request, which the prompt continues.
+    :param base_url: Base URL of the Ollama server, by default the ollama_base_url env variable.
+    :return: Json object created from the answer"""
+    http = client if client is not None else httpx
+    with telemetry.timed("network"):
+        response = http.post(_generate_url(base_url),
+                             json=_generate_payload(prompt, model, keep_alive=keep_alive, context=context, seed=seed),
+                             **_timeout(timeout))
+        _raise_for_status(response)
+    with telemetry.timed("parse"):
+        body = json.loads(response.content)
+        content = parse_model_json(body.get('response'))
+    telemetry.add_tokens(body.get('prompt_eval_count'), body.get('eval_count'))
     return content
 
+
+def _timeout(timeout) -> dict:
+    # Without a timeout, the client's applies
+    return {} if timeout is None else {'timeout': timeout}
+
+
+def prime_ollama_context(prompt, model, client: httpx.Client = None, timeout=None, base_url=None,
+                         keep_alive=None, seed=None) -> Optional[list[int]]:
+    """Lets the model evaluate the prompt while generating a single token and returns the resulting context, which
+    follow-up requests pass to continue from the prompt. Returns None if the server does not return a context.
+
+    Ollama cannot evaluate a prompt without generating, so the generated token is cut off the context again and
+    follow-up requests continue right after the prompt."""
+    http = client if client is not None else httpx
+    payload = _generate_payload(prompt, model, keep_alive=keep_alive, seed=seed)
+    payload['options'] = {**payload.get('options', {}), 'num_predict': 1}
+    with telemetry.timed("network"):
+        response = http.post(_generate_url(base_url), json=payload, **_timeout(timeout))
+        _raise_for_status(response)
+    body = response.json()
+    telemetry.add_tokens(body.get('prompt_eval_count'), body.get('eval_count'))
+    context, generated = body.get('context'), body.get('eval_count') or 0
+    if context and generated:
+        context = context[:-generated] or None
+    return context
+
+
+class GenerationBudgetExceeded(DecodeError):
+    """Raised when a streamed generation exceeds its token or time budget before the required keys are complete.
+
+    A DecodeError, as the answer is incomplete like a malformed one, so e.g. the cascade escalates it."""
+
+
+@dataclass
+class StreamStats:
+    time_to_first_token: Optional[float]
+    duration: float
+    tokens: int
+    # Why the stream ended: "done" (model finished), "complete" (required keys received), "token_budget", "time_budget"
+    stop_reason: str
+
+    @property
+    def tokens_per_second(self) -> float:
+        if self.time_to_first_token is None or self.duration <= self.time_to_first_token:
+            return 0.0
+        return self.tokens / (self.duration - self.time_to_first_token)
+
+
+def stream_model_ollama_json(prompt, model, required_keys, client: httpx.Client = None, timeout=None,
+                             base_url=None, max_tokens: Optional[int] = None,
+                             max_seconds: Optional[float] = None, keep_alive=None,
+                             context=None, seed=None) -> tuple[dict, StreamStats]:
+    """Streams the answer of the model and stops as soon as all required top-level keys have been received.
+
+    The generation is cut off when it exceeds max_tokens chunks or max_seconds. If the required keys are complete
+    at that point, the partial answer is returned, otherwise GenerationBudgetExceeded is raised.
+    :return: Json object created from the answer and the timing of the stream"""
+    http = client if client is not None else httpx
+    start = time.perf_counter()
+    first_token = None
+    tokens = 0
+    parser = IncrementalJsonParser()
+    stop_reason = "done"
+    prompt_tokens = None
+    # Leaving the with block closes the connection, which makes Ollama stop generating
+    with telemetry.timed("network"), http.stream("POST", _generate_url(base_url),
+                   json=_generate_payload(prompt, model, stream=True, keep_alive=keep_alive, context=context,
+                                          seed=seed),
+                   **_timeout(timeout)) as response:
+        _raise_for_status(response)
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if chunk.get('response'):
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                tokens += 1
+                parser.feed(chunk['response'])
+            if chunk.get('done'):
+                prompt_tokens = chunk.get('prompt_eval_count')
+                tokens = chunk.get('eval_count', tokens)
+                break
+            if parser.done:
+                break
+            if required_keys and parser.has_keys(required_keys):
+                stop_reason = "complete"
+                break
+            if max_tokens is not None and tokens >= max_tokens:
+                stop_reason = "token_budget"
+                break
+            if max_seconds is not None and time.perf_counter() - start >= max_seconds:
+                stop_reason = "time_budget"
+                break
+    stats = StreamStats(first_token, time.perf_counter() - start, tokens, stop_reason)
+    telemetry.add_tokens(prompt_tokens, tokens)
+    telemetry.add_stream(first_token, stats.duration - (first_token or stats.duration), stop_reason)
+    if stop_reason in ("token_budget", "time_budget") and not parser.has_keys(required_keys):
+        raise GenerationBudgetExceeded(f"{model} exceeded its {stop_reason.replace('_', ' ')} after {tokens} tokens")
+    return parser.partial_result(), stats
+
+
+@dataclass
+class OllamaSettings(ApiSettings):
+    # Streaming returns as soon as the required keys of the answer are complete
+    stream: bool = False
+    max_tokens: Optional[int] = None
+    max_seconds: Optional[float] = None
+    # Keeps the model loaded during the run instead of reloading it after Ollama's default of five minutes idle
+    keep_alive: Union[int, str] = DEFAULT_KEEP_ALIVE
+    reuse_context: bool = False
+
+
 class OllamaApi(AbstractApi):
+    backend = "ollama"
+
+    def __init__(self, model, cache=None, settings: Optional[ApiSettings] = None):
+        if settings is not None and not isinstance(settings, OllamaSettings):
+            # Plain settings leave the Ollama specific ones at their defaults
+            settings = OllamaSettings(**asdict(settings))
+        super().__init__(model, cache, settings=settings)
+        self.base_url = self.settings.base_url
+        self.pool_size = self.settings.pool_size
+        self.timeout = httpx.Timeout(self.settings.read_timeout, connect=self.settings.connect_timeout)
+        # httpx clients are thread-safe, so a single client serves all concurrent requests of this instance
+        self.client = create_client(self.pool_size, self.timeout)
+        self.stream = self.settings.stream
+        self.max_tokens = self.settings.max_tokens
+        self.max_seconds = self.settings.max_seconds
+        self.keep_alive = self.settings.keep_alive
+        self.reuse_context = self.settings.reuse_context
+        self._contexts: OrderedDict[str, Optional[list[int]]] = OrderedDict()
+        self._contexts_lock = threading.Lock()
+
+    @classmethod
+    def settings_from_env(cls) -> OllamaSettings:
+        return OllamaSettings(
+            **{**asdict(super().settings_from_env()), 'base_url': os.getenv("ollama_base_url")},
+            stream=os.getenv("ollama-stream", "false").lower() == "true",
+            max_tokens=int(os.getenv("ollama-max-tokens")) if os.getenv("ollama-max-tokens") else None,
+            max_seconds=float(os.getenv("ollama-max-seconds")) if os.getenv("ollama-max-seconds") else None,
+            keep_alive=_parse_keep_alive(os.getenv("ollama-keep-alive", DEFAULT_KEEP_ALIVE)),
+            reuse_context=os.getenv("ollama-reuse-context", "false").lower() == "true")
+
+    def _prompt_json(self, prompt: RenderedPrompt, schema, required_keys=()):
+        if self.reuse_context and prompt.suffix:
+            # The answer continues a context instead of the plain prompt, so it is cached separately
+            request = {'prompt': prompt.text, 'context_reuse': True}
+        else:
+            request = prompt.text
+        return self._prompt(request, 'json', self.seed, lambda: self._send(prompt, required_keys), schema, prompt)
+
+    def _context(self, prefix: str) -> Optional[list[int]]:
+        """Returns the context of the prefix, evaluating the prefix once per requirement."""
+        with self._contexts_lock:
+            if prefix in self._contexts:
+                self._contexts.move_to_end(prefix)
+                return self._contexts[prefix]
+        context = prime_ollama_context(prefix, self.model, self.client, base_url=self.base_url,
+                                       keep_alive=self.keep_alive, seed=self.seed)
+        with self._contexts_lock:
+            self._contexts[prefix] = context
+            while len(self._contexts) > MAX_CONTEXTS:
+                self._contexts.popitem(last=False)
+        return context
 
-    def __init__(self, model):
-        super().__init__(model)
+    def _send(self, prompt: RenderedPrompt, required_keys):
+        text, context = prompt.text, None
+        try:
+            if self.reuse_context and prompt.suffix:
+                context = self._context(prompt.static_prefix)
+                if context is not None:
+                    text = prompt.suffix
+            if not self.stream:
+                return prompt_model_ollama_json(text, self.model, self.client, base_url=self.base_url,
+                                                keep_alive=self.keep_alive, context=context, seed=self.seed)
+            result, _ = stream_model_ollama_json(text, self.model, required_keys, self.client,
+                                                 base_url=self.base_url, max_tokens=self.max_tokens,
+                                                 max_seconds=self.max_seconds, keep_alive=self.keep_alive,
+                                                 context=context, seed=self.seed)
+        except httpx.TransportError as e:
+            # Connection failures, timeouts and answers cut off by the server
+            raise RetryableError(f"Ollama request failed: {e!r}") from e
+        return result
+
+    def close(self):
+        """Hands the model back to Ollama's default unloading once the run is done and closes the connections."""
+        if self.keep_alive != OLLAMA_DEFAULT_KEEP_ALIVE:
+            try:
+                self.client.post(_generate_url(self.base_url),
+                                 json={'model': self.model, 'keep_alive': OLLAMA_DEFAULT_KEEP_ALIVE})
+            except httpx.HTTPError:
+                pass
+        self.client.close()
 
     def determine_criteria(self, unstructured_guideline: str) -> Criteria:
-        system_prompt = (
-            "You are responsible for the quality assurance of requirements for software projects. "
-            "Your task is to generate a checklist from unstructured text that describes which criteria "
-            "a singular requirements artifact should fulfill. The checklist is later used to check the quality "
-            "of a requirement, so each item on the checklist should be independent and as narrow as possible.\n"
-            "Example: \"Guideline: Title should identify the desired feature quickly, should be meaningful and unique, "
-            "should be written from a user's point of view where applicable, context should be indicated by prefix, "
-            "for example, Simulink: ..., SAP: ..., UI: ..., C++ Check: ...\"\n"
-            "Expected checklist: \n"
-            "1. The issue title should identify the desired feature quickly.\n"
-            "2. The issue title should be meaningful and unique.\n"
-            "3. The issue title should be written from a user's point of view where applicable.\n"
-            "4. The issue title should have its context indicated by prefix, e.g., Simulink: ...\n"
-            "Answer using JSON format."
-        )
-        user_prompt = f'Generate a checklist for the following guideline: "{unstructured_guideline}"'
-        prompt = f"{system_prompt}\n{user_prompt}"
-        result = prompt_model_ollama_json(prompt, self.model)
-        return Criteria(criteria=result.get('criteria', []))
-
-    def analyze_requirement(self, criteria: Criteria, requirement: str) -> AugmentedFeedback:
-        system_prompt = (
-            "You are responsible for the quality assurance of requirements for software projects. "
-            "You will be given a software requirement and a check. You are supposed to determine "
-            "how well the requirement fulfills the check. You can assign grades from A to F "
-            "(A being the best, F the worst, everything below D is considered a failing grade). "
-            "Furthermore, you should provide feedback that a human can use to increase the quality "
-            "of the requirement if possible.\n"
-            "Example: Requirement: \"As a user, I should be able to click a button to purchase my order\".\n"
-            "Check: \"The user story should clearly articulate the benefit to the user, presenting "
-            "the functionality from the user's viewpoint.\"\n"
-            "Expected answer: Grade: \"E\", Suggestion: \"The benefit the user gains from the functionality "
-            "is missing and should be present\"\n"
-            "Answer using JSON format."
-        )
-        user_prompt = f"Determine how well the requirement fulfills the check and provide feedback if possible: {requirement}"
-        prompt = f"{system_prompt}\n{user_prompt}\nCriterion: {criterion}"
-        result = prompt_model_ollama_json(prompt, self.model)
-        return Feedback(grade=result.get('grade', ''), suggestion=result.get('suggestion', ''))
-
-    def refine_requirement(self, feedback: list[Feedback], requirement: str) -> ImprovedRequirement:
-        pass
\ No newline at end of file
+        prompt = prompt_templates.DETERMINE_CRITERIA.render(guideline=unstructured_guideline)
+        return self._prompt_json(prompt, Criteria, ('criteria',))
+
+    def analyze_requirement(self, criteria: Criteria, requirement: str) -> FeedbackCollection:
+        prompt_overhead = prompt_templates.EVALUATE_CRITERION.render(requirement=requirement, criterion="").text
+        return self._collect_feedback(criteria, requirement, prompt_overhead,
+                                      self._evaluate_criterion, self._evaluate_batch)
+
+    def _evaluate_criterion(self, criterion: Criterion, requirement: str) -> Feedback:
+        prompt = prompt_templates.EVALUATE_CRITERION.render(requirement=requirement,
+                                                            criterion=format_criterion(criterion))
+        return self._prompt_json(prompt, Feedback, ('grade', 'suggestion'))
+
+    def _evaluate_batch(self, criteria: list[Criterion], requirement: str) -> FeedbackBatch:
+        checks = "\n".join(f"{index}. {format_criterion(criterion)}" for index, criterion in enumerate(criteria, 1))
+        prompt = prompt_templates.EVALUATE_BATCH.render(requirement=requirement, checks=checks)
+        return self._prompt_json(prompt, FeedbackBatch, ('feedback',))
+
+    def refine_requirement(self, feedback: FeedbackCollection, requirement: str) -> ImprovedRequirement:
+        prompt = prompt_templates.REFINE_REQUIREMENT.render(requirement=requirement,
+                                                            feedback=format_feedback(feedback))
+        return self._prompt_json(prompt, ImprovedRequirement, ('improved_requirement',))
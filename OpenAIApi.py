@@ -1,54 +1,116 @@
-from AbstractApi import AbstractApi, Criteria, Feedback, ImprovedRequirement, AugmentedFeedback
-from dotenv import load_dotenv
+from functools import lru_cache
+from typing import Optional
+
+import httpx
+from pydantic import TypeAdapter
+
+import prompt_templates
+import telemetry
+from AbstractApi import AbstractApi, ApiSettings, Criteria, Feedback, ImprovedRequirement, AugmentedFeedback, Criterion, \
+    FeedbackBatch, FeedbackCollection, format_criterion, format_feedback
+from prompt_templates import RenderedPrompt
 import os
+import openai
 from openai import OpenAI
+from rate_limiter import RetryableError, status_error
+from typed_decoders import parse_model_json
+
+
+
+@lru_cache(maxsize=None)
+def response_format_for(structured_format) -> dict:
+    """Builds the json_schema response format for a TypedDict, which the SDK's parse helper does not accept."""
+    return {
+        'type': 'json_schema',
+        'json_schema': {'name': structured_format.__name__,
+                        'schema': TypeAdapter(structured_format).json_schema()},
+    }
+
+
+def _retryable_error(error: openai.APIError) -> Optional[RetryableError]:
+    """Maps rate limits, overload and connection errors of the SDK to a RetryableError, None for all other errors."""
+    if isinstance(error, openai.APIConnectionError):
+        return RetryableError(f"OpenAI request failed: {error!r}")
+    if not isinstance(error, openai.APIStatusError) or error.code == "insufficient_quota":
+        # An exhausted quota is reported as 429 as well, but does not recover by waiting
+        return None
+    headers = error.response.headers
+    retry_after = headers.get('retry-after')
+    if headers.get('retry-after-ms') is not None:
+        retry_after = str(float(headers['retry-after-ms']) / 1000)
+    return status_error("OpenAI", error.status_code, retry_after)
 
-load_dotenv()
-OPENAI_API_KEY = os.getenv("openai-api-key")
-SEED = int(os.getenv("seed"))
-MODEL = os.getenv("openai-model")
 
+def prompt_model_openai_json(messages, model, structured_format, client: OpenAI = None, seed: Optional[int] = None):
+    """Sends the messages to the model and returns the answer parsed as json.
+    :param client: Client whose connection pool is used. Without a client, a new one is created for the request.
+    :param seed: Seed of the generation, None to let the server choose one."""
+    client = client if client is not None else OpenAI(api_key=os.getenv("openai-api-key"), max_retries=0)
+    with telemetry.timed("network"):
+        try:
+            completion = client.chat.completions.create(model=model, messages=messages,
+                                                        response_format=response_format_for(structured_format),
+                                                        seed=seed if seed is not None else openai.NOT_GIVEN)
+        except openai.APIError as e:
+            error = _retryable_error(e)
+            if error is not None:
+                raise error from e
+            raise
+    if completion.usage is not None:
+        telemetry.add_tokens(completion.usage.prompt_tokens, completion.usage.completion_tokens)
+    with telemetry.timed("parse"):
+        return parse_model_json(completion.choices[0].message.content)
 
-def prompt_model_openai_json(messages, model, structured_format):
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    completion = client.beta.chat.completions.parse(model=model, messages=messages,
-                                                    response_format=structured_format, seed=SEED)
-    response = completion.choices[0].message.parsed
-    return response.json()
 
 class OpenAIApi(AbstractApi):
+    backend = "openai"
 
-    def __init__(self, model):
-        super().__init__(model)
+    def __init__(self, model, cache=None, settings: Optional[ApiSettings] = None):
+        super().__init__(model, cache, settings=settings)
+        self.pool_size = self.settings.pool_size
+        self.timeout = httpx.Timeout(self.settings.read_timeout, connect=self.settings.connect_timeout)
+        self.limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+        # httpx clients are thread-safe, so a single client serves all concurrent requests of this instance
+        self.base_url = self.settings.base_url
+        # Retries are left to AbstractApi, which backs off for all requests to the backend instead of only this one
+        self.client = OpenAI(api_key=self.settings.api_key, base_url=self.base_url, timeout=self.timeout, max_retries=0,
+                             http_client=httpx.Client(limits=self.limits, timeout=self.timeout))
+
+    @classmethod
+    def settings_from_env(cls) -> ApiSettings:
+        settings = super().settings_from_env()
+        settings.api_key = os.getenv("openai-api-key")
+        settings.base_url = os.getenv("openai-base-url")
+        return settings
+
+    def _prompt_json(self, prompt: RenderedPrompt, structured_format):
+        # The system prompt and prefix come first, so OpenAI can reuse them from its prompt cache
+        messages = prompt.messages()
+        return self._prompt(messages, structured_format, self.seed,
+                            lambda: prompt_model_openai_json(messages, self.model, structured_format, self.client,
+                                                             self.seed),
+                            prompt=prompt)
 
     def determine_criteria(self, unstructured_guideline: str) -> Criteria:
-        system_prompt = """You are responsible for the quality assurance of requirements for software projects. Your task is to generate a checklist from unstructured text that describes which criteria a singular requirements artifact should fulfil. The checklist is later used to check the quality of a requirement, so each item on the checklist should be independent and as narrow as possible.
-        Example: "Guideline: "Title
-        Should identify the desired feature quickly
-        Should be meaningful and unique
-        Should be written from a user's point of view where applicable
-        Context should be indicated by prefix, for example, Simulink: ..., SAP: ..., UI: ..., C++ Check: ..."
-        Expected checklist: 
-        ""The issue title should identify the desired feature quickly"
-        "The issue title should be meaningful and unique"
-        "The issue title should be written from a user's point of view where applicable"
-        "The issue title should have its context indicated by prefix, for example, Simulink: ..."""""
-        user_prompt = f"""Generate a checklist for the following guideline: "{unstructured_guideline}\""""
-        messages = [{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': user_prompt}]
-        return prompt_model_openai_json(messages, self.model, Criteria)
-
-    def analyze_requirement(self, criteria: Criteria, requirement: str) -> AugmentedFeedback:
-        system_prompt = """You are responsible for the quality assurance of requirements for software projects. You will be given a software requirement and a check. You are supposed to determine how well the requirement fulfils the check. You can assign grades from A to F (A being the best, F the worst, everything below D is considered a failing grade).
-       Furthermore, you should provide feedback that a human can use to increase the quality of the requirement if possible.
-       Example: "Requirement: "As a user, I should be able to click a button to purchase my order".
-       Check: "The user story should clearly articulate the benefit to the user, presenting the functionality from the user's viewpoint."
-       Expected answer:
-       "Grade: "E", Suggestion: "The benefit the user gains from the functionality is missing and should be present"""""
-        user_prompt = f"""Determine how well the requirement fulfills the check and provide feedback if possible:
-        {requirement}"""
-        messages = [{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': user_prompt},
-                    {'role': 'user', 'content': user_prompt}, {'role': 'user', 'content': criterion}]
-        return prompt_model_openai_json(messages, self.model, Criteria)
-
-    def refine_requirement(self, feedback: list[Feedback], requirement: str) -> ImprovedRequirement:
-        """"""
+        prompt = prompt_templates.DETERMINE_CRITERIA.render(guideline=unstructured_guideline)
+        return self._prompt_json(prompt, Criteria)
+
+    def analyze_requirement(self, criteria: Criteria, requirement: str) -> FeedbackCollection:
+        prompt_overhead = prompt_templates.EVALUATE_CRITERION.render(requirement=requirement, criterion="").text
+        return self._collect_feedback(criteria, requirement, prompt_overhead,
+                                      self._evaluate_criterion, self._evaluate_batch)
+
+    def _evaluate_criterion(self, criterion: Criterion, requirement: str) -> Feedback:
+        prompt = prompt_templates.EVALUATE_CRITERION.render(requirement=requirement,
+                                                            criterion=format_criterion(criterion))
+        return self._prompt_json(prompt, Feedback)
+
+    def _evaluate_batch(self, criteria: list[Criterion], requirement: str) -> FeedbackBatch:
+        checks = "\n".join(f"{index}. {format_criterion(criterion)}" for index, criterion in enumerate(criteria, 1))
+        prompt = prompt_templates.EVALUATE_BATCH.render(requirement=requirement, checks=checks)
+        return self._prompt_json(prompt, FeedbackBatch)
+
+    def refine_requirement(self, feedback: FeedbackCollection, requirement: str) -> ImprovedRequirement:
+        prompt = prompt_templates.REFINE_REQUIREMENT.render(requirement=requirement,
+                                                            feedback=format_feedback(feedback))
+        return self._prompt_json(prompt, ImprovedRequirement)
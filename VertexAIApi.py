@@ -1,7 +1,10 @@
-from AbstractApi import AbstractApi, Feedback, ImprovedRequirement, Criteria
+from typing import Optional
+
+from AbstractApi import AbstractApi, ApiSettings, Feedback, ImprovedRequirement, Criteria
 
 
 class VertexAIApi(AbstractApi):
+    backend = "vertexai"
 
     def determine_criteria(self, unstructured_guideline: str) -> Criteria:
         pass
@@ -12,5 +15,5 @@ class VertexAIApi(AbstractApi):
     def refine_requirement(self, feedback: list[Feedback], requirement: str) -> ImprovedRequirement:
         pass
 
-    def __init__(self, model):
-        super().__init__(model)
\ No newline at end of file
+    def __init__(self, model, cache=None, settings: Optional[ApiSettings] = None):
+        super().__init__(model, cache, settings=settings)
\ No newline at end of file
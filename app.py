@@ -1,16 +1,27 @@
+import argparse
 import json
+from dataclasses import dataclass
+from functools import lru_cache
 from os import DirEntry
-from typing import LiteralString, TypedDict, Type, List, T, Dict, Any, TypeVar, get_type_hints
+from typing import LiteralString, TypedDict, Type, List, T, Dict, Any, TypeVar, get_type_hints, Optional, Callable, \
+    Union
 from pathlib import Path
 from dotenv import load_dotenv
 import os
-from AbstractApi import AbstractApi, Criterion, Criteria, AugmentedFeedback, FeedbackCollection, ImprovedRequirement
-from MockApi import MockApi
-from OllamaApi import OllamaApi
-from OpenAIApi import OpenAIApi
-from VertexAIApi import VertexAIApi
+import threading
+import importlib
+from AbstractApi import AbstractApi, ApiSettings, Criterion, Criteria, AugmentedFeedback, FeedbackCollection, \
+    ImprovedRequirement
 from itertools import product
 
+from build_manifest import BuildManifest, hash_inputs
+from criteria_filter import FilterPolicy, apply_policy, load_policy
+from typed_decoders import decode, load_cached
+from results_store import JsonResultsStore, ResultsStore, create_results_store
+from scheduler import JobScheduler, RunReport
+import chunking
+import telemetry
+
 
 # Function generated using GPT-4o
 def unique_combinations(list1, list2):
@@ -27,49 +38,120 @@ def unique_combinations(list1, list2):
     return result
 
 
+ENTRY_POINT_GROUP = "llm_ticket_checker.backends"
+
+
 # Class generated using GPT-4o
 class ApiFactory:
     _api_cache = {}
+    # Reentrant, a cascade gets the APIs of its tiers while it is created
+    _lock = threading.RLock()
+    # Backend name -> (model name prefixes, "module:Class"). The modules are only imported once a model of the
+    # backend is requested, so that e.g. the openai SDK is not loaded for runs which only use Ollama.
+    _backends: Dict[str, tuple[tuple[str, ...], str]] = {
+        "openai": (("gpt",), "OpenAIApi:OpenAIApi"),
+        "ollama": (("llama",), "OllamaApi:OllamaApi"),
+        "vertexai": (("meta",), "VertexAIApi:VertexAIApi"),
+        "mock": (("mock",), "MockApi:MockApi"),
+        "cascade": (("cascade",), "CascadeApi:CascadeApi"),
+    }
+    _settings: Dict[str, ApiSettings] = {}
+    _entry_points_loaded = False
+
+    @staticmethod
+    def register_backend(name: str, prefixes: tuple[str, ...], target: str):
+        """Registers a backend serving all models starting with one of the prefixes.
+
+        :param target: Class implementing AbstractApi as "module:Class", imported when first needed.
+        """
+        ApiFactory._backends[name] = (tuple(prefixes), target)
+
+    @staticmethod
+    def configure(backend: str, settings: ApiSettings):
+        """Uses the settings instead of the environment for all instances of the backend created afterwards."""
+        ApiFactory._settings[backend] = settings
+
+    @staticmethod
+    def _load_entry_points():
+        """Registers backends of installed plugins, named after the model prefix they serve, e.g.
+        [project.entry-points."llm_ticket_checker.backends"] claude = "claude_backend:ClaudeApi"."""
+        from importlib.metadata import entry_points
+        ApiFactory._entry_points_loaded = True
+        for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+            if entry_point.name not in ApiFactory._backends:
+                ApiFactory.register_backend(entry_point.name, (entry_point.name,), entry_point.value)
+
+    @staticmethod
+    def _find_backend(model: str) -> Optional[str]:
+        return next((name for name, (prefixes, _) in ApiFactory._backends.items()
+                     if model.startswith(prefixes)), None)
+
+    @staticmethod
+    def get_backend_name(model: str) -> str:
+        """Returns the name of the backend serving the model, used e.g. to apply per-backend concurrency limits."""
+        backend = ApiFactory._find_backend(model)
+        # Plugins are only looked up for unknown models, scanning the installed distributions is slow
+        if backend is None and not ApiFactory._entry_points_loaded:
+            ApiFactory._load_entry_points()
+            backend = ApiFactory._find_backend(model)
+        if backend is None:
+            raise ValueError(f"Unsupported model: {model}")
+        return backend
 
     @staticmethod
     def get_api(model: str) -> AbstractApi:
         """Returns the corresponding API for the model, reusing existing instances."""
-        # Check if the instance already exists
-        if model in ApiFactory._api_cache:
-            return ApiFactory._api_cache[model]
-
-        # Determine which API to use based on the model name
-        api_instance = None
-        if model.startswith("gpt"):
-            api_instance = OpenAIApi(model)
-        elif model.startswith("llama"):
-            api_instance = OllamaApi(model)
-        elif model.startswith("meta"):
-            api_instance = VertexAIApi(model)
-        elif model.startswith("mock"):
-            api_instance = MockApi(model)
-        else:
-            raise ValueError(f"Unsupported model: {model}")
+        with ApiFactory._lock:
+            # Check if the instance already exists
+            if model in ApiFactory._api_cache:
+                return ApiFactory._api_cache[model]
+
+            # Determine which API to use based on the model name
+            backend = ApiFactory.get_backend_name(model)
+            module_name, _, class_name = ApiFactory._backends[backend][1].partition(":")
+            api_class = getattr(importlib.import_module(module_name), class_name)
+            if backend == "cascade":
+                settings = ApiFactory._settings.get(backend) or api_class.settings_from_env()
+                api_instance = api_class(model, settings=settings,
+                                         tiers=[ApiFactory.get_api(tier) for tier in settings.models])
+            else:
+                api_instance = api_class(model, settings=ApiFactory._settings.get(backend))
+
+            # Cache the new instance
+            ApiFactory._api_cache[model] = api_instance
+            return api_instance
 
-        # Cache the new instance
-        ApiFactory._api_cache[model] = api_instance
-        return api_instance
+    @staticmethod
+    def close_all():
+        """Closes all instances created during the run."""
+        with ApiFactory._lock:
+            apis = list(ApiFactory._api_cache.values())
+            ApiFactory._api_cache.clear()
+        for api in apis:
+            api.close()
 
 
-def generate_criteria(model: str, subject: str, subjects_folder: str):
-    """Generates a new file in which the deducted criteria are stored as json if it does not exist yet."""
+def commit_directly(write: Callable[[], None]) -> None:
+    write()
+
+
+def generate_criteria(model: str, subject: str, subjects_folder: str,
+                      commit: Callable[[Callable[[], None]], None] = commit_directly):
+    """Generates a new file in which the deducted criteria are stored as json.
+
+    :param commit: Called with the function writing the output, e.g. to write it only while a job lease is held.
+    """
     subject_path = os.path.join(subjects_folder, subject)
     criteria_path = os.path.join(subject_path, model + "_criteria.json")
     guideline_path = os.path.join(subject_path, "guideline")
-    if not os.path.isfile(criteria_path):
-        with open(guideline_path, "r", encoding='utf-8') as guideline_file:
-            guideline_text = guideline_file.read()
 
-            # Get the API using the provided model
-            api: AbstractApi = ApiFactory.get_api(model)
-            criteria: Criteria = api.determine_criteria(guideline_text)
+    # Get the API using the provided model
+    api: AbstractApi = ApiFactory.get_api(model)
+    with telemetry.stage("determine_criteria"):
+        # Guidelines exceeding the model's context window are split into sections
+        criteria: Criteria = chunking.extract_criteria(api, guideline_path)
 
-            write_typed_dict_to_json(criteria, criteria_path)
+    commit(lambda: write_typed_dict_to_json(criteria, criteria_path))
 
 
 # Function generated using GPT-4o
@@ -85,42 +167,32 @@ def write_typed_dict_to_json(typed_dict_instance: Dict[str, Any], file_path: str
         json.dump(typed_dict_instance, file, ensure_ascii=False, indent=4)
 
 
-# Function generated using GPT-4o
-def load_json_as_typed_dict(path: str, cls: Type[TypedDict]) -> TypedDict:
-    def parse_value(value: Any, expected_type: Any) -> Any:
-        if isinstance(expected_type, type) and issubclass(expected_type, TypedDict):
-            # Recursively handle nested TypedDict
-            return parse_dict(value, expected_type)
-        elif isinstance(expected_type, list) and len(expected_type) == 1:
-            # Handle lists with a single expected item type
-            item_type = expected_type[0]
-            return [parse_value(item, item_type) for item in value]
-        elif isinstance(expected_type, dict):
-            # Handle dicts with specified key and value types
-            key_type, val_type = list(expected_type.items())[0]
-            return {parse_value(k, key_type): parse_value(v, val_type) for k, v in value.items()}
-        else:
-            # For basic types, just return the value
-            return value
-
-    def parse_dict(data: Dict[str, Any], expected_cls: Type[TypedDict]) -> TypedDict:
-        result = {}
-        for key, expected_type in expected_cls.__annotations__.items():
-            if key in data:
-                result[key] = parse_value(data[key], expected_type)
-        return expected_cls(**result)
-
-    # Load JSON data from the file
-    with open(path, 'r') as file:
-        json_data = json.load(file)
-
-    # Parse the JSON data and return the constructed TypedDict object
-    return parse_dict(json_data, cls)
+# Partly generated using GPT-4o
+def filter_mode() -> str:
+    """Returns "policy" (default) to filter the criteria by the policy file or "interactive" to ask the user."""
+    return os.getenv("filter-mode", "policy")
 
 
-# Partly generated using GPT-4o
-def filter_criteria(model: str, subject: str, subjects_folder: str):
-    """Generates a new file in which the filtered criteria are stored as JSON if it does not exist yet."""
+def select_criteria_interactively(model: str, subject: str, criteria: list[Criterion]) -> list[Criterion]:
+    print(
+        f"Please select if the following criteria should be included in the next step for model {model} and subject {subject}`(y/n).")
+    filtered_criteria = []
+
+    for criterion in criteria:
+        title = criterion.get("title", "No Title")
+        explanation = criterion.get("explanation", "No Explanation")
+
+        i = input(f"{title}: {explanation} (y/n): ")
+        while i.lower() not in {'y', 'n'}:
+            i = input("Please enter either 'y' or 'n' to select if the criterion should be included: ")
+        if i.lower() == 'y':
+            filtered_criteria.append(criterion)
+    return filtered_criteria
+
+
+def filter_criteria(model: str, subject: str, subjects_folder: str,
+                    commit: Callable[[Callable[[], None]], None] = commit_directly):
+    """Generates a new file in which the filtered criteria are stored as JSON."""
     subject_path = os.path.join(subjects_folder, subject)
     criteria_path = os.path.join(subject_path, model + "_criteria.json")
     filtered_criteria_path = os.path.join(subject_path, model + "_criteria_filtered.json")
@@ -128,73 +200,305 @@ def filter_criteria(model: str, subject: str, subjects_folder: str):
     if not os.path.isfile(criteria_path):
         raise RuntimeError("Called filter_criteria without criteria existing")
 
-    if not os.path.isfile(filtered_criteria_path):
-        with open(criteria_path, "r", encoding='utf-8') as criteria_file:
-            # Load the JSON and access the list of criteria
-            data = json.load(criteria_file)
-            criteria = data.get("criteria", [])
-
-            print(
-                f"Please select if the following criteria should be included in the next step for model {model} and subject {subject}`(y/n).")
-            filtered_criteria = []
+    with open(criteria_path, "r", encoding='utf-8') as criteria_file:
+        # Load the JSON and access the list of criteria
+        criteria = decode(Criteria, json.load(criteria_file))["criteria"]
 
-            for criterion in criteria:
-                title = criterion.get("title", "No Title")
-                explanation = criterion.get("explanation", "No Explanation")
+    if filter_mode() == "interactive":
+        filtered_criteria = select_criteria_interactively(model, subject, criteria)
+    else:
+        result = apply_policy(criteria, load_policy(), subject)
+        filtered_criteria = result.kept
+        print(f"Kept {len(result.kept)} of {len(criteria)} criteria for model {model} and subject {subject}")
+        for criterion, reason in result.dropped:
+            print(f"  dropped {criterion.get('title', 'No Title')}: {reason}")
 
-                i = input(f"{title}: {explanation} (y/n): ")
-                while i.lower() not in {'y', 'n'}:
-                    i = input("Please enter either 'y' or 'n' to select if the criterion should be included: ")
-                if i.lower() == 'y':
-                    filtered_criteria.append(criterion)
-            # Save the filtered criteria into a new JSON file
-            with open(filtered_criteria_path, "w", encoding='utf-8') as filtered_criteria_file:
-                json.dump({"criteria": filtered_criteria}, filtered_criteria_file, ensure_ascii=False, indent=4)
+    # Save the filtered criteria into a new JSON file
+    commit(lambda: write_typed_dict_to_json({"criteria": filtered_criteria}, filtered_criteria_path))
 
 
-def analyze_requirement(model: str, subject: str, subjects_folder: str, requirement_name: DirEntry[str]):
+def analyze_requirement(model: str, subject: str, subjects_folder: str, requirement_name: DirEntry[str],
+                        store: Optional[ResultsStore] = None,
+                        commit: Callable[[Callable[[], None]], None] = commit_directly):
     # Read content from file and check if the criteria are fulfilled
 
     subject_path = os.path.join(subjects_folder, subject)
     filtered_criteria_path = os.path.join(subject_path, model + "_criteria_filtered.json")
-
-    # Create folder for the model analysis if it does not exist yet
-    analysis_path = Path(f"{subjects_folder}/{subject}/analysis/{model}")
-    analysis_path.mkdir(parents=True, exist_ok=True)
+    store = store or JsonResultsStore(subjects_folder)
 
     api: AbstractApi = ApiFactory.get_api(model)
 
-    criteria: Criteria = load_json_as_typed_dict(filtered_criteria_path, Criteria)
-    with open(requirement_name.path, "r", encoding='utf-8') as requirement_file:
-        requirement = requirement_file.read()
+    # Decoded once per file version and shared by all requirements of the subject
+    criteria: Criteria = load_cached(filtered_criteria_path, Criteria)
+    # Requirements exceeding the model's budget are trimmed to the parts relevant to the criteria
+    requirement = chunking.read_requirement(requirement_name.path, criteria.get('criteria', []),
+                                            chunking.requirement_budget(api))
 
-    feedback_collection: FeedbackCollection = api.analyze_requirement(criteria, requirement)
+    with telemetry.stage("analyze_requirement"):
+        feedback_collection: FeedbackCollection = api.analyze_requirement(criteria, requirement)
+    # A cascade also returns the feedback of every model it escalated to, which is kept as {model}@{tier model}
+    tier_feedback: Dict[str, FeedbackCollection] = feedback_collection.pop('tier_feedback', None) or {}
 
-    # Save feedback to data/subjects/{subject}/analysis/{model}/{requirement_name.name}_feedback.json
-    write_typed_dict_to_json(feedback_collection, os.path.join(analysis_path, f"{requirement_name.name}_feedback.json"))
+    def write():
+        # With the JSON store, saved to data/subjects/{subject}/analysis/{model}/{requirement_name.name}_feedback.json
+        store.write_feedback(subject, model, requirement_name.name, feedback_collection)
+        for tier_model, feedback in tier_feedback.items():
+            store.write_feedback(subject, f"{model}@{tier_model}", requirement_name.name, feedback)
 
+    commit(write)
 
-def refine_requirement(model: str, subject: str, subjects_folder: str, requirement_name: DirEntry[str]):
-    subject_path = os.path.join(subjects_folder, subject)
 
-    # Load feedback
-    analysis_path = Path(f"{subjects_folder}/{subject}/analysis/{model}")
-    feedback_path = os.path.join(analysis_path, f"{requirement_name.name}_feedback.json")
+def refine_requirement(model: str, subject: str, subjects_folder: str, requirement_name: DirEntry[str],
+                       store: Optional[ResultsStore] = None,
+                       commit: Callable[[Callable[[], None]], None] = commit_directly):
+    store = store or JsonResultsStore(subjects_folder)
 
-    feedback_collection: FeedbackCollection = load_json_as_typed_dict(feedback_path, FeedbackCollection)
+    # Load feedback
+    feedback_collection: FeedbackCollection = store.read_feedback(subject, model, requirement_name.name)
+    if feedback_collection is None:
+        raise RuntimeError("Called refine_requirement without feedback existing")
 
     with open(requirement_name.path, "r", encoding='utf-8') as requirement_file:
         requirement = requirement_file.read()
 
     api: AbstractApi = ApiFactory.get_api(model)
-    refined_requirement: ImprovedRequirement = api.refine_requirement(feedback_collection, requirement)
+    with telemetry.stage("refine_requirement"):
+        refined_requirement: ImprovedRequirement = api.refine_requirement(feedback_collection, requirement)
+
+    commit(lambda: store.write_improved(subject, model, requirement_name.name, refined_requirement))
+
+
+STAGES = ("criteria", "filter", "analyze", "refine")
+
+
+@dataclass
+class PlannedStage:
+    stage: str
+    subject: str
+    model: str
+    output_path: str
+    requirement: Optional[DirEntry] = None
+    # Number of LLM requests needed to build the output, None if it depends on outputs of earlier stages
+    llm_calls: Optional[int] = 1
 
-    improved_path = os.path.join(analysis_path, f"{requirement_name.name}_improved")
-    with open(improved_path, "w", encoding='utf-8') as requirement_file:
-        requirement_file.write(str(refined_requirement))
+    @property
+    def name(self) -> str:
+        suffix = f"/{self.requirement.name}" if self.requirement is not None else ""
+        return f"{self.stage} {self.subject}/{self.model}{suffix}"
+
+
+def stage_output_path(stage: str, model: str, subject_path: str, requirement_name: Optional[str] = None) -> str:
+    if stage == "criteria":
+        return os.path.join(subject_path, model + "_criteria.json")
+    if stage == "filter":
+        return os.path.join(subject_path, model + "_criteria_filtered.json")
+    if stage == "analyze":
+        return os.path.join(subject_path, "analysis", model, f"{requirement_name}_feedback.json")
+    return os.path.join(subject_path, "analysis", model, f"{requirement_name}_improved")
+
+
+def stage_output_exists(stage: str, model: str, subject_path: str, store: ResultsStore,
+                        requirement: Optional[DirEntry] = None) -> bool:
+    subject = os.path.basename(subject_path)
+    if stage == "analyze":
+        return store.has_feedback(subject, model, requirement.name)
+    if stage == "refine":
+        return store.has_improved(subject, model, requirement.name)
+    return os.path.isfile(stage_output_path(stage, model, subject_path))
+
+
+def stage_input_hash(stage: str, model: str, subject_path: str, store: ResultsStore,
+                     requirement: Optional[DirEntry] = None) -> Optional[str]:
+    """Hashes everything the output of a stage is built from, None if an input does not exist (yet)."""
+    api: AbstractApi = ApiFactory.get_api(model)
+    if stage == "criteria":
+        files = [os.path.join(subject_path, "guideline")]
+        parameters = [model, api.prompt_version]
+    elif stage == "filter":
+        files = [stage_output_path("criteria", model, subject_path)]
+        # Interactive selections are kept as long as the criteria do not change
+        parameters = [] if filter_mode() == "interactive" else [load_policy().fingerprint()]
+    elif stage == "analyze":
+        files = [stage_output_path("filter", model, subject_path), requirement.path]
+        parameters = [model, api.prompt_version, api.batch_size]
+    else:
+        feedback = store.read_feedback(os.path.basename(subject_path), model, requirement.name)
+        if feedback is None:
+            return None
+        files = [requirement.path]
+        parameters = [json.dumps(feedback, sort_keys=True).encode('utf-8'), model, api.prompt_version]
+    if not all(os.path.isfile(file) for file in files):
+        return None
+    # Inputs split or trimmed to the model's budget are rebuilt if the budget changes
+    budget = {"criteria": chunking.guideline_budget, "analyze": chunking.requirement_budget}.get(stage)
+    if budget is not None and not chunking.fits(files[-1], budget(api)):
+        parameters.append(f"budget={budget(api)}")
+    return hash_inputs(stage, *files, *parameters)
+
+
+@lru_cache(maxsize=64)
+def policy_filtered_criteria(criteria_path: str, version: int, subject: str, policy_fingerprint: str) -> list[Criterion]:
+    """Applies the policy to the criteria file once per file version instead of once per requirement."""
+    criteria = load_cached(criteria_path, Criteria).get('criteria', [])
+    return apply_policy(criteria, FilterPolicy(**json.loads(policy_fingerprint)), subject).kept
+
+
+def count_analysis_calls(model: str, subject_path: str, requirement: DirEntry, filter_stale: bool) -> Optional[int]:
+    """Returns the number of requests needed to analyze the requirement, None if the criteria are not known yet."""
+    criteria_path = stage_output_path("criteria" if filter_stale else "filter", model, subject_path)
+    if not os.path.isfile(criteria_path):
+        return None
+    criteria: Criteria = load_cached(criteria_path, Criteria)
+    if filter_stale and filter_mode() != "interactive":
+        # The policy filter is deterministic, so the criteria it keeps are known before it runs
+        policy = load_policy()
+        criteria = Criteria(criteria=policy_filtered_criteria(criteria_path, os.stat(criteria_path).st_mtime_ns,
+                                                              os.path.basename(subject_path), policy.fingerprint()))
+    api: AbstractApi = ApiFactory.get_api(model)
+    requirement_text = chunking.read_requirement(requirement.path, criteria.get('criteria', []),
+                                                 chunking.requirement_budget(api))
+    return len(api.split_criteria(criteria.get('criteria', []), requirement_text))
+
+
+def plan_subject(model: str, subject: str, subjects_folder: str, manifest: BuildManifest,
+                 store: ResultsStore) -> list[PlannedStage]:
+    """Determines the stale outputs of the subject for the model, in the order in which they have to be built.
+
+    An output is stale if it does not exist, if its inputs changed since it was built or if one of its inputs is
+    rebuilt in this run.
+    """
+    subject_path = os.path.join(subjects_folder, subject)
+    plan = []
+
+    def stale(stage, upstream_stale, requirement=None):
+        output_path = stage_output_path(stage, model, subject_path, requirement.name if requirement else None)
+        if upstream_stale or manifest.is_stale(output_path,
+                                               stage_input_hash(stage, model, subject_path, store, requirement),
+                                               stage_output_exists(stage, model, subject_path, store, requirement)):
+            return output_path
+        return None
+
+    criteria_output = stale("criteria", False)
+    if criteria_output:
+        sections = chunking.count_guideline_sections(ApiFactory.get_api(model), os.path.join(subject_path, "guideline"))
+        plan.append(PlannedStage("criteria", subject, model, criteria_output, llm_calls=sections))
+    filter_output = stale("filter", criteria_output is not None)
+    if filter_output:
+        plan.append(PlannedStage("filter", subject, model, filter_output, llm_calls=0))
+
+    for requirement in sorted(os.scandir(os.path.join(subjects_folder, subject, "requirements")),
+                              key=lambda entry: entry.name):
+        if not requirement.is_file():
+            continue
+        analyze_output = stale("analyze", filter_output is not None, requirement)
+        if analyze_output:
+            plan.append(PlannedStage("analyze", subject, model, analyze_output, requirement,
+                                     count_analysis_calls(model, subject_path, requirement, filter_output is not None)
+                                     if criteria_output is None else None))
+        refine_output = stale("refine", analyze_output is not None, requirement)
+        if refine_output:
+            plan.append(PlannedStage("refine", subject, model, refine_output, requirement))
+    return plan
+
+
+def build_stage(planned: PlannedStage, subjects_folder: str, manifest: BuildManifest, store: ResultsStore,
+                commit: Callable[[Callable[[], None]], None] = commit_directly):
+    """Builds the output of a planned stage and records the hash of its inputs in the manifest.
+
+    :param commit: Called with the function writing the output and recording it in the manifest.
+    """
+    subject_path = os.path.join(subjects_folder, planned.subject)
+    input_hash = stage_input_hash(planned.stage, planned.model, subject_path, store, planned.requirement)
+
+    def commit_output(write: Callable[[], None]):
+        def write_and_record():
+            write()
+            manifest.record(planned.output_path, input_hash)
+        commit(write_and_record)
+
+    if planned.stage == "criteria":
+        generate_criteria(planned.model, planned.subject, subjects_folder, commit_output)
+    elif planned.stage == "filter":
+        filter_criteria(planned.model, planned.subject, subjects_folder, commit_output)
+    elif planned.stage == "analyze":
+        analyze_requirement(planned.model, planned.subject, subjects_folder, planned.requirement, store, commit_output)
+    else:
+        refine_requirement(planned.model, planned.subject, subjects_folder, planned.requirement, store, commit_output)
+
+
+def stage_key(planned: PlannedStage) -> Union[str, tuple[str, str]]:
+    """Identifies the stage within the plan of a subject and model."""
+    return planned.stage if planned.requirement is None else (planned.stage, planned.requirement.name)
+
+
+def previous_stage_key(planned: PlannedStage) -> Optional[Union[str, tuple[str, str]]]:
+    """Returns the key of the stage whose output the stage is built from, None for the first stage."""
+    if planned.stage == "criteria":
+        return None
+    previous_stage = STAGES[STAGES.index(planned.stage) - 1]
+    return previous_stage if previous_stage in ("criteria", "filter") else (previous_stage, planned.requirement.name)
+
+
+def print_plan(plan: list[PlannedStage]):
+    for planned in plan:
+        calls = "?" if planned.llm_calls is None else planned.llm_calls
+        print(f"{planned.name} -> {planned.output_path} ({calls} LLM calls)")
+    known_calls = sum(planned.llm_calls or 0 for planned in plan)
+    unknown = sum(1 for planned in plan if planned.llm_calls is None)
+    suffix = f" plus {unknown} stages whose number depends on the generated criteria" if unknown else ""
+    print(f"{len(plan)} outputs to build, {known_calls} LLM calls{suffix}")
+
+
+def run_pipeline(subject_folder: str, subjects: list[str], required_models: list[str],
+                 concurrency: Optional[dict[str, int]] = None, dry_run: bool = False,
+                 progress: Optional[Callable[[str], None]] = print) -> Optional[RunReport]:
+    """Builds all stale outputs of the subjects for the models.
+
+    :param concurrency: Maximum number of concurrent requests per backend, e.g. {"ollama": 4, "openai": 32}
+    :param dry_run: Only print the outputs that would be rebuilt.
+    :return: Report of the run, None for a dry run.
+    """
+    combinations = unique_combinations(subjects, required_models)
+    store = create_results_store(subject_folder)
+    manifests = {subject: BuildManifest(os.path.join(subject_folder, subject)) for subject in subjects}
+    plans = [plan_subject(model, subject, subject_folder, manifests[subject], store)
+             for (subject, model) in combinations]
+
+    if dry_run:
+        print_plan([planned for plan in plans for planned in plan])
+        store.close()
+        return None
+    # Keep outputs adopted during planning, so they are not planned again if they are deleted
+    for manifest in manifests.values():
+        manifest.save()
+
+    # Interactive filtering asks for user input, so only one filter job may prompt at a time
+    scheduler = JobScheduler({**(concurrency or {}), "interactive": 1}, progress=progress)
+
+    for plan in plans:
+        # Outputs of the previous stages this run builds, the first stages are only present if they are stale
+        jobs = {}
+        for planned in plan:
+            if planned.stage == "filter":
+                backend = "interactive" if filter_mode() == "interactive" else "local"
+            else:
+                backend = ApiFactory.get_backend_name(planned.model)
+            dependency = jobs.get(previous_stage_key(planned))
+            job = scheduler.submit(planned.name, backend, build_stage, planned, subject_folder,
+                                   manifests[planned.subject], store, after=[dependency] if dependency else None)
+            jobs[stage_key(planned)] = job
+
+    report = scheduler.wait()
+    store.close()
+    return report
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Analyzes the requirements of the configured subjects.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print the outputs that would be rebuilt and the number of LLM calls without running them")
+    args = parser.parse_args()
+
     # Load environment variables from a .env file
     load_dotenv()
 
@@ -203,26 +507,27 @@ def main():
 
     subjects = json.loads(os.getenv('subjects'))
     required_models = json.loads(os.getenv('models'))
-
-    combinations = unique_combinations(subjects, required_models)
-
-    for (subject, model) in combinations:
-        # Generate new criteria if they do not exist yet
-        generate_criteria(model, subject, subject_folder)
-
-        # Let the user select a list of filtered generated criteria
-        filter_criteria(model, subject, subject_folder)
-
-        # Run the filtered criteria against each requirement
-        for requirement in os.scandir(os.path.join(subject_folder, subject, "requirements")):
-            requirement_analysis_path = os.path.join(subject_folder, subject, "analysis", model, requirement.name,
-                                                     "feedback.json")
-            # Create analysis if corresponding file does not exist yet.
-            if requirement.is_file() and not Path(requirement_analysis_path).is_file():
-                analyze_requirement(model, subject, subject_folder, requirement)
-
-                # Provide an improved version of the requirement
-                refine_requirement(model, subject, subject_folder, requirement)
+    # Maximum number of concurrent requests per backend, e.g. {"ollama": 4, "openai": 32}
+    concurrency = json.loads(os.getenv('concurrency', '{}'))
+
+    try:
+        report = run_pipeline(subject_folder, subjects, required_models, concurrency, args.dry_run)
+    finally:
+        ApiFactory.close_all()
+    if report is None:
+        return
+    print(report.summary())
+
+    # Report how the LLM calls of the run were spent
+    run_telemetry = telemetry.get_telemetry()
+    print(run_telemetry.format_summary())
+    if os.getenv('telemetry-jsonl'):
+        run_telemetry.export_jsonl(os.getenv('telemetry-jsonl'))
+    if os.getenv('telemetry-prometheus'):
+        with open(os.getenv('telemetry-prometheus'), "w", encoding='utf-8') as metrics_file:
+            metrics_file.write(run_telemetry.export_prometheus())
+    if not report.ok:
+        raise SystemExit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,232 @@
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+
+@dataclass
+class FakeServerConfig:
+    # Mean time until the answer is sent and uniform jitter around it, in milliseconds
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    # Share of requests answered with error_status instead of an answer
+    error_rate: float = 0.0
+    error_status: int = 500
+    # Retry-After header sent with error responses, in seconds
+    retry_after: Optional[float] = None
+    # Requests arriving while this many are being answered are rejected with 429, like a provider's quota
+    max_in_flight: Optional[int] = None
+    # Time to evaluate 1000 prompt characters which are not a prefix of one of the recently evaluated prompts,
+    # like a server reusing its KV cache. Prompts continuing a context only evaluate their own characters.
+    prefill_ms_per_kchar: float = 0.0
+    # Length of every suggestion and improved requirement in characters
+    response_chars: int = 32
+    # Number of criteria answered to a criteria request
+    criteria_count: int = 10
+    seed: Optional[int] = None
+
+
+def _answer(kind: str, config: FakeServerConfig, criteria_count: int) -> dict:
+    text = ("Fake suggestion. " * (config.response_chars // 17 + 1))[:config.response_chars]
+    if kind == "criteria":
+        return {'criteria': [{'title': f"Criterion {i}", 'explanation': text} for i in range(config.criteria_count)]}
+    if kind == "batch":
+        return {'feedback': [{'index': i, 'grade': 'B', 'suggestion': text} for i in range(1, criteria_count + 1)]}
+    if kind == "refine":
+        return {'improved_requirement': text}
+    return {'grade': 'B', 'suggestion': text}
+
+
+def _count_checks(prompt: str) -> int:
+    checks = prompt.split("Checks:\n", 1)[1]
+    return sum(1 for line in checks.splitlines() if line.split(".", 1)[0].isdigit())
+
+
+def _ollama_kind(prompt: str) -> tuple[str, int]:
+    if "Generate a checklist" in prompt:
+        return "criteria", 0
+    if "Checks:\n" in prompt:
+        return "batch", _count_checks(prompt)
+    if "improved_requirement" in prompt:
+        return "refine", 0
+    return "feedback", 0
+
+
+def _openai_kind(request: dict) -> tuple[str, int]:
+    name = request.get('response_format', {}).get('json_schema', {}).get('name')
+    if name == "Criteria":
+        return "criteria", 0
+    if name == "FeedbackBatch":
+        return "batch", _count_checks(request['messages'][-1]['content'])
+    if name == "ImprovedRequirement":
+        return "refine", 0
+    return "feedback", 0
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so that clients can keep connections alive
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server: "_Server"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        path = self.path.rstrip('/')
+        config = self.server.config
+        self.server.count_request()
+        if not self.server.enter():
+            self._send_json({'error': 'too many requests'}, 429)
+            return
+        try:
+            self._answer(path, request, config)
+        finally:
+            self.server.leave()
+
+    def _answer(self, path: str, request: dict, config: FakeServerConfig):
+        delay = config.latency_ms + self.server.random.uniform(-config.jitter_ms, config.jitter_ms)
+        if config.prefill_ms_per_kchar:
+            if path == '/api/generate':
+                prompt = request.get('prompt', '')
+                uncached = len(prompt) if request.get('context') else self.server.uncached_chars(prompt)
+            else:
+                uncached = self.server.uncached_chars("\n".join(message.get('content', '')
+                                                                for message in request.get('messages', [])))
+            delay += config.prefill_ms_per_kchar * uncached / 1000
+        if delay > 0:
+            time.sleep(delay / 1000)
+        if config.error_rate and self.server.random.random() < config.error_rate:
+            self._send_json({'error': 'fake error'}, config.error_status)
+            return
+
+        if path == '/api/generate':
+            kind, count = _ollama_kind(request.get('prompt', ''))
+            answer = json.dumps(_answer(kind, config, count))
+            if request.get('stream'):
+                self._stream(answer)
+            else:
+                self._send_json({'model': request.get('model'), 'done': True, 'response': answer,
+                                 'context': [len(request.get('prompt', ''))]})
+        elif path == '/v1/chat/completions':
+            kind, count = _openai_kind(request)
+            self._send_json({
+                'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': int(time.time()),
+                'model': request.get('model'),
+                'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {
+                    'role': 'assistant', 'content': json.dumps(_answer(kind, config, count))}}],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+            })
+        else:
+            self.send_error(404)
+
+    def _send_json(self, body: dict, status: int = 200):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        if status != 200 and self.server.config.retry_after is not None:
+            self.send_header('Retry-After', str(self.server.config.retry_after))
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, answer: str):
+        """Sends the answer as NDJSON chunks of a few characters each, like Ollama does with 'stream': true."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        chunks = [{'model': 'fake', 'done': False, 'response': answer[i:i + 4]} for i in range(0, len(answer), 4)]
+        chunks.append({'model': 'fake', 'done': True, 'response': ''})
+        try:
+            for chunk in chunks:
+                data = json.dumps(chunk).encode('utf-8') + b'\n'
+                self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading early
+            self.close_connection = True
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config: FakeServerConfig):
+        super().__init__(address, _Handler)
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.requests = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self._recent_prompts: deque[str] = deque(maxlen=8)
+        self._lock = threading.Lock()
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def uncached_chars(self, prompt: str) -> int:
+        """Returns the number of characters after the longest prefix shared with a recently evaluated prompt."""
+        with self._lock:
+            cached = max((len(os.path.commonprefix([prompt, recent])) for recent in self._recent_prompts), default=0)
+            self._recent_prompts.append(prompt)
+        return len(prompt) - cached
+
+    def enter(self) -> bool:
+        """Admits a request unless max_in_flight requests are already being answered."""
+        with self._lock:
+            if self.config.max_in_flight is not None and self.in_flight >= self.config.max_in_flight:
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+class FakeLlmServer:
+    """Local stand-in for an LLM server, running in a background thread.
+
+    Speaks the Ollama api/generate protocol (with and without streaming) and the OpenAI chat completions protocol
+    (under v1/) and answers every stage of the pipeline with a valid, synthetic answer.
+    """
+
+    def __init__(self, config: Optional[FakeServerConfig] = None, host: str = "127.0.0.1", port: int = 0):
+        self._server = _Server((host, port), config or FakeServerConfig())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    @property
+    def openai_base_url(self) -> str:
+        return self.base_url + "v1"
+
+    @property
+    def requests(self) -> int:
+        """Number of requests received so far."""
+        return self._server.requests
+
+    @property
+    def rejected(self) -> int:
+        """Number of requests rejected with 429 because max_in_flight was exceeded."""
+        return self._server.rejected
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,43 @@
+"""Compares the latency of Ollama requests with a new connection per request against a pooled client.
+
+Usage: python -m benchmarks.http_pool [--requests N]
+"""
+import argparse
+import statistics
+import time
+
+from OllamaApi import create_client, prompt_model_ollama_json
+from benchmarks.fake_llm_server import FakeLlmServer
+
+
+def measure(n: int, send) -> list[float]:
+    latencies = []
+    for _ in range(n):
+        start = time.perf_counter()
+        send()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=500)
+    args = parser.parse_args()
+
+    with FakeLlmServer() as server:
+        client = create_client()
+        results = {
+            'new connection per request': measure(
+                args.requests, lambda: prompt_model_ollama_json("prompt", "fake", base_url=server.base_url)),
+            'pooled client': measure(
+                args.requests, lambda: prompt_model_ollama_json("prompt", "fake", client, base_url=server.base_url)),
+        }
+        client.close()
+
+    for name, latencies in results.items():
+        print(f"{name}: mean {statistics.mean(latencies):.3f} ms, median {statistics.median(latencies):.3f} ms, "
+              f"total {sum(latencies):.0f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+"""Benchmarks the backends and the full pipeline against a local stand-in LLM server.
+
+Usage: python -m benchmarks.run_benchmarks [--scenario ollama|openai|pipeline|all] [--output results.json]
+
+The results (throughput, p50/p95/p99 latency, peak memory) are written as JSON, so runs of different revisions
+can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from typing import Callable, Optional
+
+from benchmarks.fake_llm_server import FakeLlmServer, FakeServerConfig
+
+SCENARIOS = ("ollama", "openai", "pipeline")
+
+
+def percentile(values: list[float], share: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(share * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies: list[float], duration: float, requests: int, peak_memory: Optional[int],
+              errors: int) -> dict:
+    result = {
+        'operations': len(latencies),
+        'errors': errors,
+        'llm_requests': requests,
+        'duration_s': duration,
+        'operations_per_s': len(latencies) / duration if duration else 0.0,
+        'llm_requests_per_s': requests / duration if duration else 0.0,
+        'latency_ms': {
+            'p50': percentile(latencies, 0.50) * 1000,
+            'p95': percentile(latencies, 0.95) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000,
+            'max': max(latencies, default=0.0) * 1000,
+        },
+        # Peak RSS of the process so far, scenarios run in order so later ones include earlier peaks
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    if peak_memory is not None:
+        result['peak_traced_memory_bytes'] = peak_memory
+    return result
+
+
+def prefix_reuse(records: list) -> dict:
+    """Share of prompt characters which repeated an already sent prefix and the latency with a new and a
+    repeated prefix."""
+    import telemetry
+
+    collector = telemetry.Telemetry()
+    for record in records:
+        collector.record(record)
+    totals = {'prompt_chars': 0, 'reused_prefix_chars': 0, 'cold_prefix_calls': 0, 'cold_prefix_network_seconds': 0.0,
+              'warm_prefix_calls': 0, 'warm_prefix_network_seconds': 0.0}
+    for group in collector.summary().values():
+        for key in totals:
+            totals[key] += group[key]
+    return {
+        'shared_prefix_ratio': totals['reused_prefix_chars'] / totals['prompt_chars'] if totals['prompt_chars'] else 0.0,
+        'new_prefix_latency_ms': 1000 * totals['cold_prefix_network_seconds'] / max(1, totals['cold_prefix_calls']),
+        'repeated_prefix_latency_ms': 1000 * totals['warm_prefix_network_seconds'] / max(1, totals['warm_prefix_calls']),
+    }
+
+
+def start_memory_trace(args):
+    if args.trace_memory:
+        tracemalloc.start()
+
+
+def stop_memory_trace(args) -> Optional[int]:
+    """Returns the peak of the memory allocated by Python since start_memory_trace, None if not traced."""
+    if not args.trace_memory:
+        return None
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def synthetic_criteria(count: int) -> dict:
+    return {'criteria': [{'title': f"Criterion {i}", 'explanation': f"The requirement should fulfill check {i}."}
+                         for i in range(count)]}
+
+
+def synthetic_requirement(index: int, size: int) -> str:
+    text = f"As a user of component {index}, I want to export my reports so that I can share them. "
+    return (text * (size // len(text) + 1))[:size]
+
+
+def measure(operations: list[Callable[[], object]], concurrency: int) -> tuple[list[float], float, int]:
+    """Runs the operations on a thread pool and returns their latencies, the total duration and the errors."""
+    def timed(operation):
+        start = time.perf_counter()
+        try:
+            operation()
+            return time.perf_counter() - start, False
+        except Exception:
+            return time.perf_counter() - start, True
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, operations))
+    duration = time.perf_counter() - start
+    return [latency for latency, _ in results], duration, sum(1 for _, failed in results if failed)
+
+
+def run_backend(scenario: str, server: FakeLlmServer, args) -> dict:
+    import telemetry
+    from response_cache import ResponseCache
+
+    cache = ResponseCache(tempfile.mkdtemp(prefix="bench-cache-"), mode="bypass")
+    if scenario == "ollama":
+        from OllamaApi import OllamaApi
+        os.environ["ollama_base_url"] = server.base_url
+        api = OllamaApi("llama-bench", cache)
+    else:
+        from OpenAIApi import OpenAIApi
+        os.environ["openai-base-url"] = server.openai_base_url
+        api = OpenAIApi("gpt-bench", cache)
+
+    criteria = synthetic_criteria(args.criteria)
+    operations = [lambda i=i: api.analyze_requirement(criteria, synthetic_requirement(i, args.requirement_chars))
+                  for i in range(args.requirements)]
+    requests_before = server.requests
+    records_before = len(telemetry.get_telemetry().records)
+    start_memory_trace(args)
+    latencies, duration, errors = measure(operations, args.concurrency)
+    peak = stop_memory_trace(args)
+    result = summarize(latencies, duration, server.requests - requests_before, peak, errors)
+    result['prompt_prefix'] = prefix_reuse(telemetry.get_telemetry().records[records_before:])
+    return result
+
+
+def create_subjects(folder: str, args) -> list[str]:
+    """Creates synthetic subjects whose criteria are already generated and filtered for every model."""
+    subjects = []
+    for subject_index in range(args.subjects):
+        subject = f"bench-{subject_index}"
+        subject_path = os.path.join(folder, subject)
+        os.makedirs(os.path.join(subject_path, "requirements"))
+        with open(os.path.join(subject_path, "guideline"), "w", encoding='utf-8') as guideline_file:
+            guideline_file.write("Requirements should be testable, unambiguous and written from a user's view.\n")
+        for model in args.models:
+            for name in (f"{model}_criteria.json", f"{model}_criteria_filtered.json"):
+                with open(os.path.join(subject_path, name), "w", encoding='utf-8') as criteria_file:
+                    json.dump(synthetic_criteria(args.criteria), criteria_file)
+        for index in range(args.requirements):
+            with open(os.path.join(subject_path, "requirements", f"REQ-{index}"), "w", encoding='utf-8') as file:
+                file.write(synthetic_requirement(index, args.requirement_chars))
+        subjects.append(subject)
+    return subjects
+
+
+def run_pipeline_scenario(server: FakeLlmServer, args) -> dict:
+    import app
+
+    os.environ["ollama_base_url"] = server.base_url
+    os.environ["openai-base-url"] = server.openai_base_url
+    working_directory = tempfile.mkdtemp(prefix="bench-pipeline-")
+    subject_folder = os.path.join(working_directory, "data/subjects")
+    subjects = create_subjects(subject_folder, args)
+    concurrency = {backend: args.concurrency for backend in ("ollama", "openai", "mock")}
+
+    requests_before = server.requests
+    start_memory_trace(args)
+    start = time.perf_counter()
+    report = app.run_pipeline(subject_folder, subjects, args.models, concurrency, progress=None)
+    duration = time.perf_counter() - start
+    peak = stop_memory_trace(args)
+    result = summarize(list(report.durations.values()), duration, server.requests - requests_before, peak,
+                       len(report.failures) + len(report.skipped))
+    result['operation'] = "pipeline job (analyze or refine of one requirement)"
+    return result
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="all")
+    parser.add_argument("--requirements", type=int, default=50, help="requirements per subject")
+    parser.add_argument("--requirement-chars", type=int, default=600)
+    parser.add_argument("--criteria", type=int, default=10)
+    parser.add_argument("--subjects", type=int, default=2)
+    parser.add_argument("--models", type=json.loads, default=["llama-bench", "gpt-bench"],
+                        help="JSON list of models for the pipeline scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    parser.add_argument("--jitter-ms", type=float, default=2.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--retry-after", type=float, help="Retry-After header sent with error responses, in seconds")
+    parser.add_argument("--max-in-flight", type=int,
+                        help="reject requests with 429 while this many are answered, like a provider's quota")
+    parser.add_argument("--response-chars", type=int, default=200)
+    parser.add_argument("--prefill-ms-per-kchar", type=float, default=0.0,
+                        help="time the server needs per 1000 prompt characters not shared with a recent prompt")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="also report the peak memory allocated by Python, which slows down all scenarios")
+    parser.add_argument("--output", help="file the JSON results are written to instead of stdout")
+    args = parser.parse_args()
+
+    # The backends read their configuration from the environment, the values only have to be valid
+    os.environ.setdefault("seed", str(args.seed))
+    os.environ.setdefault("openai-api-key", "benchmark")
+    os.environ["cache-mode"] = "bypass"
+
+    config = FakeServerConfig(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+                              error_status=args.error_status, retry_after=args.retry_after,
+                              max_in_flight=args.max_in_flight, response_chars=args.response_chars,
+                              prefill_ms_per_kchar=args.prefill_ms_per_kchar, criteria_count=args.criteria,
+                              seed=args.seed)
+    scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'arguments': {key: value for key, value in vars(args).items() if key != "output"},
+        'server': asdict(config),
+        'scenarios': {},
+    }
+    with FakeLlmServer(config) as server:
+        for scenario in scenarios:
+            if scenario == "pipeline":
+                results['scenarios'][scenario] = run_pipeline_scenario(server, args)
+            else:
+                results['scenarios'][scenario] = run_backend(scenario, server, args)
+        results['rejected_requests'] = server.rejected
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, "w", encoding='utf-8') as output_file:
+            output_file.write(output)
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Measures how long the CLI takes to become ready, i.e. to import app and create a mock backend.
+
+Every measurement runs in a fresh interpreter, so modules cached by an earlier run do not hide import costs.
+Fails if a backend SDK is imported without being used or the import exceeds --max-import-ms.
+
+Usage: python -m benchmarks.startup [--runs N] [--max-import-ms MS]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Modules only needed by backends which are not used by a mock run
+HEAVY_MODULES = ["openai", "httpx", "pydantic", "requests", "jira"]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.ApiFactory.get_api("mock")
+ready = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000, "ready_ms": (ready - start) * 1000,
+                  "heavy_modules": [name for name in HEAVY_MODULES if name in sys.modules]}))
+"""
+
+
+def measure() -> dict:
+    output = subprocess.run([sys.executable, "-c", f"HEAVY_MODULES = {HEAVY_MODULES!r}\n{PROBE}"],
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--max-import-ms", type=float, default=None,
+                        help="Fails if the median import time of app exceeds the limit")
+    args = parser.parse_args()
+
+    runs = [measure() for _ in range(args.runs)]
+    import_ms = statistics.median(run["import_ms"] for run in runs)
+    ready_ms = statistics.median(run["ready_ms"] for run in runs)
+    heavy_modules = sorted({name for run in runs for name in run["heavy_modules"]})
+    print(f"import app: median {import_ms:.1f} ms, ready with mock backend: median {ready_ms:.1f} ms "
+          f"over {args.runs} runs")
+
+    failures = []
+    if heavy_modules:
+        failures.append(f"modules of unused backends were imported: {', '.join(heavy_modules)}")
+    if args.max_import_ms is not None and import_ms > args.max_import_ms:
+        failures.append(f"import took {import_ms:.1f} ms, more than {args.max_import_ms:.1f} ms")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
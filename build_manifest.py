@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Optional, Union
+
+MANIFEST_NAME = ".build_manifest.json"
+
+
+def hash_inputs(*inputs: Union[str, bytes, int, None]) -> str:
+    """Hashes the given inputs. Strings which are paths of existing files are hashed by their content."""
+    digest = hashlib.sha256()
+    for value in inputs:
+        if isinstance(value, str) and os.path.isfile(value):
+            with open(value, "rb") as file:
+                for block in iter(lambda: file.read(1 << 16), b""):
+                    digest.update(block)
+        elif isinstance(value, bytes):
+            digest.update(value)
+        else:
+            digest.update(repr(value).encode('utf-8'))
+        # Separator so that ("ab", "c") and ("a", "bc") hash differently
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class BuildManifest:
+    """Records, for every output file of a subject, the hash of the inputs it was built from.
+
+    An output is stale if it does not exist or if its inputs changed since it was built. Outputs which exist but
+    are not recorded yet (e.g. created before the manifest was introduced) are adopted with the current inputs
+    instead of being rebuilt.
+    """
+
+    def __init__(self, subject_path: str):
+        self.subject_path = subject_path
+        self.path = os.path.join(subject_path, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self._entries: dict[str, str] = self._load()
+
+    def _load(self) -> dict[str, str]:
+        try:
+            with open(self.path, "r", encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def reload(self) -> None:
+        """Reads the manifest again, e.g. before recording an output while other processes record theirs."""
+        with self._lock:
+            self._entries = self._load()
+
+    def _key(self, output_path: str) -> str:
+        return os.path.relpath(output_path, self.subject_path).replace(os.sep, "/")
+
+    def is_stale(self, output_path: str, input_hash: Optional[str], exists: Optional[bool] = None) -> bool:
+        """:param input_hash: Hash of the current inputs, None if they cannot be determined yet.
+        :param exists: Whether the output exists, by default whether output_path is a file."""
+        if exists is None:
+            exists = os.path.isfile(output_path)
+        if input_hash is None or not exists:
+            return True
+        with self._lock:
+            recorded = self._entries.setdefault(self._key(output_path), input_hash)
+        return recorded != input_hash
+
+    def record(self, output_path: str, input_hash: str) -> None:
+        """Records that the output was built from inputs with the given hash and saves the manifest."""
+        with self._lock:
+            self._entries[self._key(output_path)] = input_hash
+            self._save()
+
+    def save(self) -> None:
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        os.makedirs(self.subject_path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.subject_path, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding='utf-8') as file:
+            json.dump(self._entries, file, ensure_ascii=False, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,199 @@
+import heapq
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator, Optional
+
+import prompt_templates
+import scheduler
+import telemetry
+from AbstractApi import AbstractApi, Criteria, Criterion, estimate_tokens, format_criterion
+from criteria_filter import DEFAULT_DUPLICATE_THRESHOLD, collapse_near_duplicates
+
+# Files are read in pieces of at most this many characters, so a single huge line does not have to fit into memory
+READ_BLOCK_CHARS = 64 * 1024
+# Tokens reserved for the generated checklist of a guideline section, at most a quarter of the context window
+CRITERIA_ANSWER_TOKENS = 1024
+# Smallest section or requirement worth a request, smaller context windows are rejected
+MIN_INPUT_TOKENS = 128
+# Marks paragraphs omitted from a trimmed requirement
+OMITTED_MARKER = "[...]"
+DEFAULT_CHUNK_CONCURRENCY = 4
+# Share of the context window a requirement may use, the rest is left for the criteria and the answers
+DEFAULT_REQUIREMENT_SHARE = 0.5
+_HEADING = re.compile(r"^\s*(#{1,6}\s|\d+(\.\d+)*\.?\s+\S|[A-Z][^.!?]{0,80}:\s*$)")
+_WORD = re.compile(r"[a-z][a-z0-9_-]{3,}")
+_STOPWORDS = {"should", "must", "shall", "which", "would", "could", "their", "there", "these", "those", "with",
+              "from", "that", "this", "have", "been", "where", "when", "what", "into", "than", "then", "also", "only",
+              "each", "every", "other", "more", "most", "some", "such", "very", "will", "does", "about", "issue"}
+
+
+def read_pieces(path: str) -> Iterator[str]:
+    """Yields the lines of the file, lines longer than READ_BLOCK_CHARS in several pieces."""
+    with open(path, "r", encoding='utf-8') as file:
+        yield from iter(lambda: file.readline(READ_BLOCK_CHARS), "")
+
+
+def _split_long(text: str, max_tokens: int) -> Iterator[str]:
+    """Splits text exceeding max_tokens at whitespace, or anywhere if a word is too long."""
+    max_chars = max(max_tokens * 4 - 4, 1)
+    while len(text) > max_chars:
+        cut = text.rfind(" ", 0, max_chars)
+        cut = cut if cut > 0 else max_chars
+        yield text[:cut]
+        text = text[cut:].lstrip(" ")
+    if text:
+        yield text
+
+
+def iter_paragraphs(pieces: Iterable[str], max_tokens: int) -> Iterator[str]:
+    """Groups lines into paragraphs, separated by blank lines or headings, of at most max_tokens each.
+
+    Headings start a new paragraph and stay with the text following them.
+    """
+    max_chars = max(max_tokens * 4 - 4, 1)
+    paragraph: list[str] = []
+    size = 0
+    for piece in pieces:
+        blank = not piece.strip()
+        if paragraph and (blank or _HEADING.match(piece) or size + len(piece) > max_chars):
+            yield "".join(paragraph).strip("\n")
+            paragraph, size = [], 0
+        if blank:
+            continue
+        if len(piece) > max_chars:
+            *parts, piece = _split_long(piece, max_tokens)
+            yield from parts
+        paragraph.append(piece)
+        size += len(piece)
+    if paragraph:
+        yield "".join(paragraph).strip("\n")
+
+
+def iter_sections(pieces: Iterable[str], max_tokens: int) -> Iterator[str]:
+    """Packs consecutive paragraphs into sections of at most max_tokens each."""
+    section: list[str] = []
+    used = 0
+    for paragraph in iter_paragraphs(pieces, max_tokens):
+        cost = estimate_tokens(paragraph + "\n\n")
+        if section and used + cost > max_tokens:
+            yield "\n\n".join(section)
+            section, used = [], 0
+        section.append(paragraph)
+        used += cost
+    if section:
+        yield "\n\n".join(section)
+
+
+def fits(path: str, max_tokens: int) -> bool:
+    """Whether the file fits into max_tokens, judged by its size in bytes which is at least its length."""
+    # Same estimate as estimate_tokens, without reading the file
+    return os.path.getsize(path) // 4 + 1 <= max_tokens
+
+
+def _checked_budget(api: AbstractApi, budget: int, prompt: str) -> int:
+    if budget < MIN_INPUT_TOKENS:
+        raise ValueError(f"The context window of {api.model} ({api.context_window} tokens) is too small for the "
+                         f"{prompt} prompt, set context-window or context-windows")
+    return budget
+
+
+def guideline_budget(api: AbstractApi) -> int:
+    """Tokens a guideline section may use in the criteria prompt of the model."""
+    overhead = prompt_templates.DETERMINE_CRITERIA.render(guideline="").text
+    answer = min(CRITERIA_ANSWER_TOKENS, api.context_window // 4)
+    return _checked_budget(api, api.context_window - estimate_tokens(overhead) - answer, "criteria")
+
+
+def requirement_budget(api: AbstractApi) -> int:
+    """Tokens a requirement may use in the analysis prompts of the model."""
+    share = float(os.getenv("requirement-share", DEFAULT_REQUIREMENT_SHARE))
+    overhead = prompt_templates.EVALUATE_CRITERION.render(requirement="", criterion="").text
+    return _checked_budget(api, int(api.context_window * share) - estimate_tokens(overhead), "analysis")
+
+
+def count_guideline_sections(api: AbstractApi, guideline_path: str) -> int:
+    """Number of requests extract_criteria needs for the guideline."""
+    budget = guideline_budget(api)
+    if not os.path.isfile(guideline_path) or fits(guideline_path, budget):
+        return 1
+    return sum(1 for _ in iter_sections(read_pieces(guideline_path), budget))
+
+
+def extract_criteria(api: AbstractApi, guideline_path: str) -> Criteria:
+    """Generates the criteria of the guideline, split into sections if it does not fit into the model's budget.
+
+    The criteria of the sections are generated in parallel, concatenated in the order of the sections and collapsed
+    where they are near-duplicates of each other. At most chunk-concurrency requests are sent at a time, and within
+    a JobScheduler only as many as the backend has free slots besides the one of the calling job.
+    """
+    budget = guideline_budget(api)
+    if fits(guideline_path, budget):
+        with open(guideline_path, "r", encoding='utf-8') as guideline_file:
+            return api.determine_criteria(guideline_file.read())
+
+    stage = telemetry.current_stage()
+    job = scheduler.current_job()
+
+    def determine(section: str) -> list[Criterion]:
+        with telemetry.stage(stage), scheduler.running_job(job):
+            return api.determine_criteria(section).get('criteria', [])
+
+    criteria: list[Criterion] = []
+    sections = iter_sections(read_pieces(guideline_path), budget)
+    limit = int(os.getenv("chunk-concurrency", DEFAULT_CHUNK_CONCURRENCY))
+    # The calling job's slot is used by one of the requests while it waits for them
+    with scheduler.borrow_slots(max(limit - 1, 0)) as borrowed, \
+            ThreadPoolExecutor(max_workers=borrowed + 1, thread_name_prefix="chunk") as executor:
+        parallel = borrowed + 1
+        # Only a few sections are read ahead, so memory does not grow with the size of the guideline
+        pending = [executor.submit(determine, section) for section in islice(sections, parallel)]
+        while pending:
+            criteria.extend(pending.pop(0).result())
+            section = next(sections, None)
+            if section is not None:
+                pending.append(executor.submit(determine, section))
+    return Criteria(criteria=collapse_near_duplicates(criteria, DEFAULT_DUPLICATE_THRESHOLD).kept)
+
+
+def _terms(text: str) -> set[str]:
+    return {word for word in _WORD.findall(text.lower()) if word not in _STOPWORDS}
+
+
+def read_requirement(requirement_path: str, criteria: list[Criterion], max_tokens: Optional[int]) -> str:
+    """Reads the requirement, trimmed to the paragraphs most relevant to the criteria if it exceeds max_tokens.
+
+    The first paragraph, usually the summary, is always kept. The other paragraphs are ranked by the number of
+    distinct terms they share with the criteria and kept in their original order, omitted ones are marked by "[...]".
+    The markers count towards max_tokens.
+    """
+    if max_tokens is None or fits(requirement_path, max_tokens):
+        with open(requirement_path, "r", encoding='utf-8') as requirement_file:
+            return requirement_file.read()
+
+    terms = _terms(" ".join(format_criterion(criterion) for criterion in criteria))
+    # A marker may precede every kept paragraph but the first and follow the last one, so one is reserved for each
+    marker = estimate_tokens(OMITTED_MARKER + "\n\n")
+    # Min-heap of (score, -position, paragraph), the least relevant kept paragraph is dropped first
+    kept: list[tuple[float, int, str]] = []
+    used = marker
+    position = -1
+    for position, paragraph in enumerate(iter_paragraphs(read_pieces(requirement_path), max_tokens - 2 * marker)):
+        score = float("inf") if position == 0 else len(terms & _terms(paragraph))
+        heapq.heappush(kept, (score, -position, paragraph))
+        used += estimate_tokens(paragraph + "\n\n") + (marker if position else 0)
+        while used > max_tokens and len(kept) > 1:
+            _, negative_position, dropped = heapq.heappop(kept)
+            used -= estimate_tokens(dropped + "\n\n") + (marker if negative_position else 0)
+
+    parts = []
+    previous = -1
+    for _, negative_position, paragraph in sorted(kept, key=lambda entry: -entry[1]):
+        if -negative_position != previous + 1:
+            parts.append(OMITTED_MARKER)
+        parts.append(paragraph)
+        previous = -negative_position
+    if previous != position:
+        parts.append(OMITTED_MARKER)
+    return "\n\n".join(parts)
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import random
+import re
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+from AbstractApi import Criterion
+
+DEFAULT_POLICY_PATH = "data/filter_policy.json"
+DEFAULT_DUPLICATE_THRESHOLD = 0.7
+NUM_PERMUTATIONS = 64
+SHINGLE_SIZE = 4
+_MERSENNE_PRIME = (1 << 61) - 1
+# Fixed seed, so that signatures and therefore the filtered criteria are reproducible between runs
+_random = random.Random(20240601)
+_PERMUTATIONS = [(_random.randrange(1, _MERSENNE_PRIME), _random.randrange(0, _MERSENNE_PRIME))
+                 for _ in range(NUM_PERMUTATIONS)]
+
+
+@dataclass
+class FilterPolicy:
+    """Rules deciding which generated criteria are used for the analysis.
+
+    Patterns are case-insensitive regular expressions searched in "title: explanation" of a criterion.
+    """
+    # If not empty, only criteria matching one of the patterns are kept
+    accept: list[str] = field(default_factory=list)
+    reject: list[str] = field(default_factory=list)
+    # Patterns per subject whose criteria are always kept, regardless of reject, duplicates and max_count
+    allowlist: dict[str, list[str]] = field(default_factory=dict)
+    # Maximum number of kept criteria per subject and model, allowlisted criteria count towards it
+    max_count: Optional[int] = None
+    # Estimated Jaccard similarity of two criteria's shingles from which they are considered duplicates, 1 disables
+    duplicate_threshold: float = DEFAULT_DUPLICATE_THRESHOLD
+
+    def fingerprint(self) -> str:
+        """Changes whenever the policy changes, so that filtered criteria are rebuilt."""
+        return json.dumps(asdict(self), sort_keys=True)
+
+
+@dataclass
+class FilterResult:
+    kept: list[Criterion]
+    # Dropped criteria with the reason, e.g. "rejected by 'pattern'" or "duplicate of 'title'"
+    dropped: list[tuple[Criterion, str]]
+
+
+def load_policy(path: Optional[str] = None) -> FilterPolicy:
+    """Loads the policy from the JSON file given by the filter-policy env variable, the default policy only
+    collapses near-duplicates if the file does not exist."""
+    path = path or os.getenv("filter-policy", DEFAULT_POLICY_PATH)
+    if not os.path.isfile(path):
+        return FilterPolicy()
+    with open(path, "r", encoding='utf-8') as policy_file:
+        return FilterPolicy(**json.load(policy_file))
+
+
+def _text(criterion: Criterion) -> str:
+    return f"{criterion.get('title', '')}: {criterion.get('explanation', '')}"
+
+
+def _first_match(patterns: list[str], text: str) -> Optional[str]:
+    return next((pattern for pattern in patterns if re.search(pattern, text, re.IGNORECASE)), None)
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> set[str]:
+    """Character shingles of the text after normalizing case, punctuation and whitespace."""
+    normalized = " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+    if len(normalized) <= size:
+        return {normalized}
+    return {normalized[i:i + size] for i in range(len(normalized) - size + 1)}
+
+
+def minhash_signature(text: str) -> list[int]:
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+              for shingle in shingles(text)]
+    return [min((a * value + b) % _MERSENNE_PRIME for value in hashes) for a, b in _PERMUTATIONS]
+
+
+def estimated_similarity(signature: list[int], other: list[int]) -> float:
+    """Estimates the Jaccard similarity of the shingles from the share of equal MinHash values."""
+    return sum(1 for value, other_value in zip(signature, other) if value == other_value) / len(signature)
+
+
+def collapse_near_duplicates(criteria: list[Criterion], threshold: float = DEFAULT_DUPLICATE_THRESHOLD,
+                             keep: Optional[set[int]] = None) -> FilterResult:
+    """Keeps only the first criterion of every group of near-duplicates.
+
+    :param keep: Indices of criteria which are kept even if they duplicate an earlier one.
+    """
+    keep = keep or set()
+    kept: list[tuple[Criterion, list[int]]] = []
+    dropped = []
+    for index, criterion in enumerate(criteria):
+        signature = minhash_signature(_text(criterion))
+        duplicate = None if threshold >= 1 or index in keep else next(
+            (other for other, other_signature in kept
+             if estimated_similarity(signature, other_signature) >= threshold), None)
+        if duplicate is None:
+            kept.append((criterion, signature))
+        else:
+            dropped.append((criterion, f"duplicate of '{duplicate.get('title', '')}'"))
+    return FilterResult([criterion for criterion, _ in kept], dropped)
+
+
+def apply_policy(criteria: list[Criterion], policy: FilterPolicy, subject: str) -> FilterResult:
+    """Filters the criteria by the patterns, then collapses near-duplicates and finally applies max_count."""
+    allow_patterns = policy.allowlist.get(subject, [])
+    candidates: list[Criterion] = []
+    allowed: set[int] = set()
+    dropped = []
+    for criterion in criteria:
+        text = _text(criterion)
+        if _first_match(allow_patterns, text):
+            allowed.add(len(candidates))
+            candidates.append(criterion)
+            continue
+        rejected_by = _first_match(policy.reject, text)
+        if rejected_by:
+            dropped.append((criterion, f"rejected by '{rejected_by}'"))
+        elif policy.accept and not _first_match(policy.accept, text):
+            dropped.append((criterion, "not accepted by any pattern"))
+        else:
+            candidates.append(criterion)
+
+    # Allowlisted criteria are moved to the front, so they are never dropped as duplicates or by max_count
+    order = sorted(range(len(candidates)), key=lambda index: index not in allowed)
+    deduplicated = collapse_near_duplicates([candidates[index] for index in order], policy.duplicate_threshold,
+                                            keep=set(range(len(allowed))))
+    dropped.extend(deduplicated.dropped)
+    kept = deduplicated.kept
+    if policy.max_count is not None and len(kept) > max(policy.max_count, len(allowed)):
+        limit = max(policy.max_count, len(allowed))
+        dropped.extend((criterion, f"exceeds max_count {policy.max_count}") for criterion in kept[limit:])
+        kept = kept[:limit]
+    # Restore the order of the generated criteria
+    position = {id(criterion): index for index, criterion in enumerate(criteria)}
+    return FilterResult(sorted(kept, key=lambda criterion: position[id(criterion)]), dropped)
@@ -0,0 +1,122 @@
+import json
+from typing import Any, Optional
+
+_EXPECT_KEY = 0
+_IN_KEY = 1
+_EXPECT_COLON = 2
+_EXPECT_VALUE = 3
+_IN_VALUE = 4
+
+
+class IncrementalJsonParser:
+    """Parses a JSON object which arrives in chunks, e.g. from a streamed LLM answer.
+
+    Only the top level of the object is tracked: after each chunk, completed_keys contains the keys whose values
+    have been received completely, and partial_result() returns the object consisting of these keys. This allows
+    to stop a generation as soon as all required keys are present.
+    """
+
+    def __init__(self):
+        self._buffer = []
+        self.completed_keys: list[str] = []
+        self.done = False
+        self._position = 0
+        self._started = False
+        self._state = _EXPECT_KEY
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._key_chars: list[str] = []
+        self._current_key: Optional[str] = None
+        self._value_is_string = False
+        self._value_is_scalar = False
+        self._complete_end = None
+
+    def feed(self, text: str) -> None:
+        for char in text:
+            if self.done:
+                break
+            self._feed_char(char)
+            self._buffer.append(char)
+            self._position += 1
+
+    def has_keys(self, keys) -> bool:
+        return all(key in self.completed_keys for key in keys)
+
+    def _complete(self, end: int):
+        self.completed_keys.append(self._current_key)
+        self._complete_end = end
+        self._state = _EXPECT_KEY
+        self._current_key = None
+
+    def _feed_char(self, char: str):
+        if not self._started:
+            if char == '{':
+                self._started = True
+                self._depth = 1
+            return
+
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif char == '\\':
+                self._escape = True
+            elif char == '"':
+                self._in_string = False
+                if self._state == _IN_KEY:
+                    self._current_key = json.loads('"' + "".join(self._key_chars) + '"')
+                    self._state = _EXPECT_COLON
+                elif self._depth == 1 and self._value_is_string:
+                    self._complete(self._position + 1)
+                return
+            if self._state == _IN_KEY:
+                self._key_chars.append(char)
+            return
+
+        if self._state == _EXPECT_KEY:
+            if char == '"':
+                self._in_string = True
+                self._key_chars = []
+                self._state = _IN_KEY
+            elif char == '}':
+                self._depth = 0
+                self.done = True
+        elif self._state == _EXPECT_COLON:
+            if char == ':':
+                self._state = _EXPECT_VALUE
+        elif self._state == _EXPECT_VALUE:
+            if char.isspace():
+                return
+            self._state = _IN_VALUE
+            self._value_is_string = char == '"'
+            self._value_is_scalar = char not in '"{['
+            if char == '"':
+                self._in_string = True
+            elif char in '{[':
+                self._depth += 1
+        elif self._state == _IN_VALUE:
+            if char == '"':
+                self._in_string = True
+            elif char in '{[':
+                self._depth += 1
+            elif char in '}]':
+                if self._depth == 1:
+                    # End of the top-level object directly after a scalar value
+                    self._complete(self._position)
+                    self._depth = 0
+                    self.done = True
+                    return
+                self._depth -= 1
+                if self._depth == 1:
+                    self._complete(self._position + 1)
+            elif char == ',' and self._depth == 1 and self._value_is_scalar:
+                self._complete(self._position)
+
+    def partial_result(self) -> dict[str, Any]:
+        """Returns the object made of all completely received top-level values."""
+        if self.done:
+            return json.loads("".join(self._buffer))
+        if self._complete_end is None:
+            return {}
+        text = "".join(self._buffer[:self._complete_end]).rstrip().rstrip(',')
+        return json.loads(text + "}")
@@ -1,7 +1,214 @@
-from jira import JIRA
+import argparse
+import json
 import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone, tzinfo
+from itertools import islice
+from typing import Any, Iterator, Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
-JIRA_BASE_URL = os.getenv("jira-base-url")
-JIRA_API_KEY = os.getenv("jira-api-key")
-JIRA_USER = os.getenv("jira-user")
-jira = JIRA(server=JIRA_BASE_URL, basic_auth=(JIRA_USER, JIRA_API_KEY))
\ No newline at end of file
+from dotenv import load_dotenv
+from jira import JIRA, JIRAError
+
+# Only the fields which are written to the requirement files are requested
+GRADED_FIELDS = ["summary", "description", "updated"]
+SYNC_STATE_NAME = ".jira_sync.json"
+DEFAULT_PAGE_SIZE = 100
+DEFAULT_PARALLEL_PAGES = 4
+# Jira's search index may lag behind edits, so incremental syncs start a little before the high-water mark.
+# Tickets in the overlap are fetched again, which is harmless since writing them is idempotent.
+HIGH_WATER_MARK_OVERLAP = timedelta(minutes=10)
+
+_jira = None
+_jira_lock = threading.Lock()
+
+
+def get_jira() -> JIRA:
+    """Returns a Jira client configured via the jira-base-url, jira-user and jira-api-key env variables."""
+    global _jira
+    with _jira_lock:
+        if _jira is None:
+            _jira = JIRA(server=os.getenv("jira-base-url"),
+                         basic_auth=(os.getenv("jira-user"), os.getenv("jira-api-key")))
+        return _jira
+
+
+def _key_order(key: str) -> tuple[str, int]:
+    """Orders issue keys like Jira does, by project and then numerically by issue number."""
+    project, _, number = key.rpartition("-")
+    return (project, int(number)) if number.isdigit() else (key, 0)
+
+
+def _position(issue: dict[str, Any]) -> tuple[datetime, tuple[str, int]]:
+    """Position of the issue in the order "updated ASC, key ASC"."""
+    return _parse_jira_time(issue['fields']['updated']), _key_order(issue['key'])
+
+
+def _user_time_zone(jira: JIRA) -> tzinfo:
+    """JQL dates are interpreted in the time zone of the Jira user, UTC if it cannot be determined."""
+    try:
+        return ZoneInfo(jira.myself().get('timeZone') or "UTC")
+    except (JIRAError, ZoneInfoNotFoundError, AttributeError):
+        return timezone.utc
+
+
+def iter_keys(jira: JIRA, jql: str, since: Optional[tuple[datetime, tuple[str, int]]] = None,
+              page_size: int = DEFAULT_PAGE_SIZE) -> Iterator[dict[str, Any]]:
+    """Yields the key and updated timestamp of the issues matching the JQL query after since, ordered by updated.
+
+    Pages are requested by keyset: every page starts after the last issue of the previous page instead of at an
+    offset, so an issue which is edited during the sync and moves to the end of the order does not shift later
+    issues into pages which were already fetched. JQL dates have minute precision, so every page starts at the
+    minute of the last issue and the issues up to it are skipped.
+    """
+    time_zone = _user_time_zone(jira)
+    cursor = since
+    while True:
+        query = f"({jql})"
+        if cursor is not None:
+            minute = cursor[0].astimezone(time_zone).strftime("%Y/%m/%d %H:%M")
+            query += f' AND updated >= "{minute}"'
+        query += " ORDER BY updated ASC, key ASC"
+        start = 0
+        while True:
+            issues = jira.search_issues(query, startAt=start, maxResults=page_size, fields="updated",
+                                        json_result=True).get('issues', [])
+            new_issues = [issue for issue in issues if cursor is None or _position(issue) > cursor]
+            for issue in new_issues:
+                yield issue
+                cursor = _position(issue)
+            if len(issues) < page_size:
+                return
+            if new_issues:
+                break
+            # A whole page within the minute of the cursor, only then the next page is requested by offset
+            start += page_size
+
+
+def fetch_issues(jira: JIRA, jql: str, fields: list[str] = GRADED_FIELDS, page_size: int = DEFAULT_PAGE_SIZE,
+                 parallel_pages: int = DEFAULT_PARALLEL_PAGES,
+                 since: Optional[tuple[datetime, tuple[str, int]]] = None) -> Iterator[dict[str, Any]]:
+    """Yields the raw issues matching the JQL query after since, ordered by updated.
+
+    The keys are listed by iter_keys, the issues with all fields are downloaded by key, parallel_pages pages at a
+    time while the issues of the previous pages are consumed.
+    """
+    def fetch_page(keys: list[str]) -> list[dict[str, Any]]:
+        # Issues deleted since they were listed are reported as warnings instead of failing the query
+        issues = jira.search_issues(f"key in ({','.join(keys)})", maxResults=len(keys), fields=",".join(fields),
+                                    validate_query=False, json_result=True).get('issues', [])
+        by_key = {issue['key']: issue for issue in issues}
+        return [by_key[key] for key in keys if key in by_key]
+
+    def pages() -> Iterator[list[str]]:
+        keys = (issue['key'] for issue in iter_keys(jira, jql, since, page_size))
+        while page := list(islice(keys, page_size)):
+            yield page
+
+    key_pages = pages()
+    with ThreadPoolExecutor(max_workers=parallel_pages, thread_name_prefix="jira") as executor:
+        pending = [executor.submit(fetch_page, page) for page in islice(key_pages, parallel_pages)]
+        while pending:
+            issues = pending.pop(0).result()
+            page = next(key_pages, None)
+            if page is not None:
+                pending.append(executor.submit(fetch_page, page))
+            yield from issues
+
+
+def requirement_text(issue: dict[str, Any]) -> str:
+    fields = issue.get('fields', {})
+    summary = fields.get('summary') or ""
+    description = fields.get('description') or ""
+    return f"{summary}\n\n{description}".strip() + "\n"
+
+
+def write_requirement(issue: dict[str, Any], requirements_path: str) -> bool:
+    """Writes the issue to requirements_path/{issue key}.
+
+    :return: True if the file was created or changed."""
+    path = os.path.join(requirements_path, issue['key'])
+    text = requirement_text(issue)
+    try:
+        with open(path, "r", encoding='utf-8') as requirement_file:
+            if requirement_file.read() == text:
+                return False
+    except FileNotFoundError:
+        pass
+    with open(path, "w", encoding='utf-8') as requirement_file:
+        requirement_file.write(text)
+    return True
+
+
+def _parse_jira_time(value: str) -> datetime:
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f%z")
+
+
+def _load_state(path: str) -> dict[str, Any]:
+    try:
+        with open(path, "r", encoding='utf-8') as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_state(path: str, state: dict[str, Any]):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w", encoding='utf-8') as state_file:
+        json.dump(state, state_file, indent=4)
+    os.replace(tmp_path, path)
+
+
+def sync(subject: str, jql: str, subjects_folder: str, jira: Optional[JIRA] = None, full: bool = False,
+         page_size: int = DEFAULT_PAGE_SIZE, parallel_pages: int = DEFAULT_PARALLEL_PAGES) -> int:
+    """Writes the tickets matching the JQL query as requirement files of the subject.
+
+    The latest 'updated' timestamp of the synced tickets is stored in data/subjects/{subject}/.jira_sync.json,
+    so later syncs only fetch tickets which changed since then.
+    :param full: Ignore the stored high-water mark and fetch all tickets.
+    :return: Number of requirement files created or changed.
+    """
+    subject_path = os.path.join(subjects_folder, subject)
+    requirements_path = os.path.join(subject_path, "requirements")
+    os.makedirs(requirements_path, exist_ok=True)
+    state_path = os.path.join(subject_path, SYNC_STATE_NAME)
+    state = _load_state(state_path)
+
+    high_water_mark = None if full or state.get('jql') != jql else state.get('updated')
+    since = None
+    if high_water_mark:
+        since = (_parse_jira_time(high_water_mark) - HIGH_WATER_MARK_OVERLAP, ("", 0))
+
+    changed = 0
+    latest = high_water_mark
+    for issue in fetch_issues(jira or get_jira(), jql, GRADED_FIELDS, page_size, parallel_pages, since):
+        if write_requirement(issue, requirements_path):
+            changed += 1
+        updated = issue.get('fields', {}).get('updated')
+        if updated and (latest is None or _parse_jira_time(updated) > _parse_jira_time(latest)):
+            latest = updated
+
+    _save_state(state_path, {'jql': jql, 'updated': latest})
+    return changed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Syncs Jira tickets into the requirements of a subject.")
+    parser.add_argument("subject", help="name of the folder in data/subjects the tickets are written to")
+    parser.add_argument("jql", help="JQL query selecting the tickets, e.g. 'project = ABC AND type = Story'")
+    parser.add_argument("--full", action="store_true", help="fetch all tickets instead of only the changed ones")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE)
+    parser.add_argument("--parallel-pages", type=int, default=DEFAULT_PARALLEL_PAGES)
+    args = parser.parse_args()
+
+    load_dotenv()
+    subjects_folder = os.path.join(os.getcwd(), "data/subjects")
+    changed = sync(args.subject, args.jql, subjects_folder, full=args.full, page_size=args.page_size,
+                   parallel_pages=args.parallel_pages)
+    print(f"{changed} requirements of subject {args.subject} created or changed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import hashlib
+import string
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class RenderedPrompt:
+    """Prompt whose system prompt and prefix are identical for all calls about the same input.
+
+    Only the suffix differs, e.g. between the criteria graded for one requirement, so servers can reuse the
+    evaluated prefix (Ollama's KV cache, OpenAI's prompt caching) instead of evaluating it again.
+    """
+    system: str
+    prefix: str
+    suffix: str
+
+    @property
+    def static_prefix(self) -> str:
+        return f"{self.system}\n{self.prefix}\n"
+
+    @property
+    def text(self) -> str:
+        """The prompt as a single string, as sent to Ollama."""
+        return self.static_prefix + self.suffix
+
+    def messages(self) -> list[dict]:
+        """The prompt as chat messages, as sent to OpenAI. The suffix is the last message."""
+        messages = [{'role': 'system', 'content': self.system}, {'role': 'user', 'content': self.prefix}]
+        if self.suffix:
+            messages.append({'role': 'user', 'content': self.suffix})
+        return messages
+
+
+class PromptTemplate:
+    """Prompt of one pipeline stage, parsed once so that rendering only joins the parts."""
+
+    def __init__(self, system: str, prefix: str, suffix: str = ""):
+        self.system = system
+        self._prefix = self._compile(prefix)
+        self._suffix = self._compile(suffix)
+
+    @staticmethod
+    def _compile(template: str) -> list[tuple[str, str]]:
+        return [(literal, field or "") for literal, field, _, _ in string.Formatter().parse(template)]
+
+    @staticmethod
+    def _render(parts: list[tuple[str, str]], values: dict) -> str:
+        return "".join(literal + (str(values[field]) if field else "") for literal, field in parts)
+
+    def render(self, **values) -> RenderedPrompt:
+        return RenderedPrompt(self.system, self._render(self._prefix, values), self._render(self._suffix, values))
+
+
+class PrefixTracker:
+    """Remembers the most recently sent prefixes to tell whether a server may still have a prefix cached."""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._seen: OrderedDict[bytes, None] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, prefix: str) -> bool:
+        """Records the prefix as sent and returns whether it was sent before."""
+        key = hashlib.sha256(prefix.encode('utf-8')).digest()
+        with self._lock:
+            if key in self._seen:
+                self._seen.move_to_end(key)
+                return True
+            self._seen[key] = None
+            if len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+            return False
+
+
+CRITERIA_SYSTEM_PROMPT = (
+    "You are responsible for the quality assurance of requirements for software projects. "
+    "Your task is to generate a checklist from unstructured text that describes which criteria "
+    "a singular requirements artifact should fulfill. The checklist is later used to check the quality "
+    "of a requirement, so each item on the checklist should be independent and as narrow as possible.\n"
+    "Example: \"Guideline: Title should identify the desired feature quickly, should be meaningful and unique, "
+    "should be written from a user's point of view where applicable, context should be indicated by prefix, "
+    "for example, Simulink: ..., SAP: ..., UI: ..., C++ Check: ...\"\n"
+    "Expected checklist: \n"
+    "1. The issue title should identify the desired feature quickly.\n"
+    "2. The issue title should be meaningful and unique.\n"
+    "3. The issue title should be written from a user's point of view where applicable.\n"
+    "4. The issue title should have its context indicated by prefix, e.g., Simulink: ...\n"
+    'Answer with a JSON object of the form {"criteria": [{"title": "...", "explanation": "..."}, ...]} containing '
+    "one entry per checklist item, where title is the item and explanation describes how to check it."
+)
+ANALYZE_SYSTEM_PROMPT = (
+    "You are responsible for the quality assurance of requirements for software projects. "
+    "You will be given a software requirement and a check. You are supposed to determine "
+    "how well the requirement fulfills the check. You can assign grades from A to F "
+    "(A being the best, F the worst, everything below D is considered a failing grade). "
+    "Furthermore, you should provide feedback that a human can use to increase the quality "
+    "of the requirement if possible.\n"
+    "Example: Requirement: \"As a user, I should be able to click a button to purchase my order\".\n"
+    "Check: \"The user story should clearly articulate the benefit to the user, presenting "
+    "the functionality from the user's viewpoint.\"\n"
+    "Expected answer: grade: \"E\", suggestion: \"The benefit the user gains from the functionality "
+    "is missing and should be present\"\n"
+    "Answer using JSON format."
+)
+REFINE_SYSTEM_PROMPT = (
+    "You are responsible for the quality assurance of requirements for software projects. "
+    "You will be given a software requirement and feedback on how well it fulfills a list of checks. "
+    "Rewrite the requirement so that it addresses the feedback while keeping its original intent. "
+    "Do not invent functionality which is not described in the requirement.\n"
+    'Answer using JSON format with the key "improved_requirement".'
+)
+# The requirement comes before the checks, so all analysis prompts for a requirement share their prefix
+ANALYZE_PREFIX = ("Determine how well the requirement fulfills the check and provide feedback if possible.\n"
+                  "Requirement: {requirement}")
+# In the suffix, as the batch prompts share the system prompt but expect a different answer
+SINGLE_ANSWER_INSTRUCTION = 'Answer with a JSON object of the form {{"grade": "A", "suggestion": "..."}}.'
+BATCH_ANSWER_INSTRUCTION = (
+    'Grade every check on its own. Answer with a JSON object of the form {{"feedback": [{{"index": 1, '
+    '"grade": "A", "suggestion": "..."}}, ...]}} containing one entry per check, where index is the number of the '
+    'check.'
+)
+
+DETERMINE_CRITERIA = PromptTemplate(CRITERIA_SYSTEM_PROMPT,
+                                    'Generate a checklist for the following guideline: "{guideline}"')
+EVALUATE_CRITERION = PromptTemplate(ANALYZE_SYSTEM_PROMPT, ANALYZE_PREFIX,
+                                    "Check: {criterion}\n" + SINGLE_ANSWER_INSTRUCTION)
+EVALUATE_BATCH = PromptTemplate(ANALYZE_SYSTEM_PROMPT, ANALYZE_PREFIX,
+                                "Checks:\n{checks}\n" + BATCH_ANSWER_INSTRUCTION)
+REFINE_REQUIREMENT = PromptTemplate(REFINE_SYSTEM_PROMPT, "Improve the following requirement: {requirement}",
+                                    "Feedback:\n{feedback}")
@@ -0,0 +1,209 @@
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Optional
+
+DEFAULT_MAX_CONCURRENCY = 32
+DEFAULT_MAX_ATTEMPTS = 6
+DEFAULT_RETRY_DEADLINE = 600.0
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 60.0
+RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+# Status codes meaning that the server is overloaded, which shrinks the concurrency window
+OVERLOAD_STATUS_CODES = frozenset({429, 503})
+
+
+class RetryableError(Exception):
+    """Raised by a backend for failures which may succeed when retried, e.g. HTTP 429/503 or timeouts.
+
+    :param overloaded: Whether the server signalled overload (429/503), which shrinks the concurrency window.
+    :param retry_after: Seconds the server asked to wait before the next request, if given.
+    """
+
+    def __init__(self, message: str, overloaded: bool = False, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.overloaded = overloaded
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request could not be completed before its retry deadline."""
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parses a Retry-After header given in seconds. HTTP dates are ignored."""
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None
+
+
+def status_error(source: str, status: int, retry_after: Optional[str] = None) -> Optional[RetryableError]:
+    """Returns the RetryableError for an HTTP error status, None if retrying the request would not help."""
+    if status not in RETRYABLE_STATUS_CODES:
+        return None
+    return RetryableError(f"{source} returned HTTP {status}", overloaded=status in OVERLOAD_STATUS_CODES,
+                          retry_after=parse_retry_after(retry_after))
+
+
+class TokenBucket:
+    """Allows up to per_minute units per minute with bursts of up to per_minute units."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self._available = per_minute
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self._available = min(self.capacity, self._available + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Returns how long to wait until amount units are available, 0 if they are available now."""
+        self._refill(now)
+        # Requests larger than the bucket only wait until it is full
+        amount = min(amount, self.capacity)
+        return 0.0 if self._available >= amount else (amount - self._available) / self.rate
+
+    def take(self, amount: float):
+        # May become negative when the actual usage is higher than estimated, which delays the next requests
+        self._available -= amount
+
+
+class AdmissionController:
+    """Decides when a request to a backend may be sent.
+
+    Requests are limited by a requests-per-minute and a tokens-per-minute bucket and by an AIMD concurrency
+    window: every successful request grows the window by 1/window, a 429/503 halves it and pauses new
+    requests for the Retry-After time given by the server. The window is halved once per congestion event: 429/503
+    answers to requests admitted before the last decrease do not shrink it again.
+    """
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY, min_concurrency: int = 1):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.window = float(max_concurrency)
+        self.in_flight = 0
+        # Number of decreases of the window, requests admitted before the last one do not decrease it again
+        self.decreases = 0
+        self._paused_until = 0.0
+        self._condition = threading.Condition()
+
+    def _wait_time(self, tokens: float, now: float) -> float:
+        wait = max(0.0, self._paused_until - now)
+        if self.in_flight >= max(self.min_concurrency, int(self.window)):
+            # Waits until a request in flight finishes
+            return float('inf') if wait == 0 else wait
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1, now))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens, now))
+        return wait
+
+    @contextmanager
+    def admit(self, tokens: float = 0, deadline: Optional[float] = None):
+        """Blocks until the request may be sent and keeps it counted as in flight within the block.
+
+        :param tokens: Estimated number of tokens of the request.
+        :param deadline: time.monotonic() value after which DeadlineExceeded is raised instead of waiting.
+        :return: Number of window decreases at admission, to pass to on_overload.
+        """
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                wait = self._wait_time(tokens, now)
+                if wait <= 0:
+                    break
+                remaining = None if deadline is None else deadline - now
+                if remaining is not None and (remaining <= 0 or (wait != float('inf') and wait > remaining)):
+                    raise DeadlineExceeded("request could not be admitted before its deadline")
+                if remaining is not None:
+                    wait = min(wait, remaining)
+                self._condition.wait(timeout=None if wait == float('inf') else wait)
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(tokens)
+            self.in_flight += 1
+            admitted = self.decreases
+        try:
+            yield admitted
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+    def record_tokens(self, difference: float):
+        """Corrects the token bucket once the actual token usage of a request is known."""
+        if self.tokens is not None and difference:
+            with self._condition:
+                self.tokens.take(difference)
+
+    def on_success(self):
+        with self._condition:
+            self.window = min(self.max_concurrency, self.window + 1 / self.window)
+
+    def on_overload(self, retry_after: Optional[float] = None, admitted: Optional[int] = None):
+        """:param admitted: Value returned by admit for the overloaded request, None to halve the window regardless."""
+        with self._condition:
+            if admitted is None or admitted == self.decreases:
+                self.window = max(self.min_concurrency, self.window / 2)
+                self.decreases += 1
+            if retry_after:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            self._condition.notify_all()
+
+
+def backoff_delay(attempt: int, base_delay: float = DEFAULT_BASE_DELAY, max_delay: float = DEFAULT_MAX_DELAY) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def call_with_retries(controller: AdmissionController, send: Callable[[], Any], tokens: float = 0,
+                      max_attempts: int = DEFAULT_MAX_ATTEMPTS, deadline_seconds: float = DEFAULT_RETRY_DEADLINE,
+                      on_retry: Optional[Callable[[RetryableError], None]] = None) -> Any:
+    """Sends the request through the admission controller and retries it on RetryableError.
+
+    Retries wait for the Retry-After time given by the server or otherwise for a jittered exponential backoff,
+    and stop after max_attempts or once the next attempt would start after deadline_seconds.
+    """
+    deadline = time.monotonic() + deadline_seconds
+    attempt = 0
+    while True:
+        admitted = None
+        try:
+            with controller.admit(tokens, deadline) as admitted:
+                result = send()
+            controller.on_success()
+            return result
+        except RetryableError as e:
+            attempt += 1
+            if e.overloaded:
+                controller.on_overload(e.retry_after, admitted)
+            delay = e.retry_after if e.retry_after is not None else backoff_delay(attempt - 1)
+            if attempt >= max_attempts or time.monotonic() + delay > deadline:
+                raise
+            if on_retry is not None:
+                on_retry(e)
+            time.sleep(delay)
+
+
+_controllers: dict[str, AdmissionController] = {}
+_controllers_lock = threading.Lock()
+
+
+def get_controller(backend: str) -> AdmissionController:
+    """Returns the controller of the backend, configured via the rate-limits env variable, e.g.
+    {"openai": {"requests_per_minute": 500, "tokens_per_minute": 200000, "max_concurrency": 32}}."""
+    with _controllers_lock:
+        if backend not in _controllers:
+            limits = json.loads(os.getenv("rate-limits", "{}")).get(backend, {})
+            _controllers[backend] = AdmissionController(**limits)
+        return _controllers[backend]
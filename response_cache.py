@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Any, Callable, Optional
+
+CACHE_MODES = ("use", "bypass", "refresh")
+DEFAULT_CACHE_DIR = ".cache/llm-responses"
+DEFAULT_CACHE_MAX_MB = 512
+
+
+def _format_key(response_format: Any) -> Any:
+    """Returns a JSON-serializable representation of a response format (TypedDict class, schema dict or string)."""
+    if response_format is None or isinstance(response_format, (str, dict, list)):
+        return response_format
+    return f"{getattr(response_format, '__module__', '')}.{getattr(response_format, '__qualname__', response_format)}"
+
+
+class ResponseCache:
+    """Content-addressed on-disk cache for LLM responses.
+
+    Every response is stored as its own JSON file named after the hash of the request, so concurrent processes can
+    read and write the cache without locking: files are written to a temporary file and atomically renamed into
+    place. The total size is bounded by evicting the least recently used entries (the mtime is refreshed on a hit).
+
+    Modes:
+      - use: return cached responses and store new ones
+      - bypass: neither read nor write the cache
+      - refresh: ignore cached responses but store the new ones
+    """
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_CACHE_MAX_MB * 1024 * 1024, mode: str = "use"):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unsupported cache mode: {mode}")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size: Optional[int] = None
+
+    @staticmethod
+    def make_key(backend: str, model: str, request: Any, response_format: Any = None, seed: Any = None) -> str:
+        """Hashes everything that influences the response of a model into a cache key."""
+        payload = json.dumps({
+            'backend': backend,
+            'model': model,
+            'request': request,
+            'response_format': _format_key(response_format),
+            'seed': seed,
+        }, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, key: str) -> Optional[Any]:
+        """Returns the cached response for the key or None. Unreadable entries are treated as a miss."""
+        if self.mode != "use":
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding='utf-8') as file:
+                value = json.load(file)['response']
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        if self.mode == "bypass":
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps({'response': value}, ensure_ascii=False).encode('utf-8')
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            if self._size is not None:
+                self._size += len(data)
+        self._evict_if_needed()
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any]) -> Any:
+        """Returns the cached response for the key or computes, stores and returns it."""
+        if self.mode == "use":
+            cached = self.get(key)
+            if cached is not None:
+                return cached
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict_if_needed(self) -> None:
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            if self._size <= self.max_bytes:
+                return
+            # Evict down to 90% of the limit so eviction does not run on every write
+            entries = sorted(self._entries())
+            size = sum(entry_size for _, entry_size, _ in entries)
+            target = self.max_bytes * 0.9
+            for _, entry_size, path in entries:
+                if size <= target:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                size -= entry_size
+            self._size = size
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+_default_cache: Optional[ResponseCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache() -> ResponseCache:
+    """Returns the process-wide cache configured via the cache-dir, cache-max-mb and cache-mode env variables."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache(
+                os.getenv("cache-dir", DEFAULT_CACHE_DIR),
+                max_bytes=int(float(os.getenv("cache-max-mb", DEFAULT_CACHE_MAX_MB)) * 1024 * 1024),
+                mode=os.getenv("cache-mode", "use"),
+            )
+        return _default_cache
@@ -0,0 +1,316 @@
+import argparse
+import ast
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Optional
+
+from AbstractApi import AugmentedFeedback, FeedbackCollection, ImprovedRequirement
+from typed_decoders import load_typed_json
+
+DEFAULT_DB_PATH = "data/results.sqlite"
+DEFAULT_WRITE_BATCH_SIZE = 200
+
+
+class ResultsStore(ABC):
+    """Stores the feedback and improved requirements per subject, model and requirement."""
+
+    @abstractmethod
+    def write_feedback(self, subject: str, model: str, requirement: str, feedback: FeedbackCollection) -> None:
+        pass
+
+    @abstractmethod
+    def read_feedback(self, subject: str, model: str, requirement: str) -> Optional[FeedbackCollection]:
+        pass
+
+    @abstractmethod
+    def write_improved(self, subject: str, model: str, requirement: str, improved: ImprovedRequirement) -> None:
+        pass
+
+    @abstractmethod
+    def has_improved(self, subject: str, model: str, requirement: str) -> bool:
+        pass
+
+    def has_feedback(self, subject: str, model: str, requirement: str) -> bool:
+        return self.read_feedback(subject, model, requirement) is not None
+
+    def flush(self) -> None:
+        """Makes all writes so far visible to other processes."""
+
+    def close(self) -> None:
+        pass
+
+
+class JsonResultsStore(ResultsStore):
+    """Stores the results as files in data/subjects/{subject}/analysis/{model}/."""
+
+    def __init__(self, subjects_folder: str):
+        self.subjects_folder = subjects_folder
+
+    def _analysis_path(self, subject: str, model: str) -> Path:
+        return Path(f"{self.subjects_folder}/{subject}/analysis/{model}")
+
+    def feedback_path(self, subject: str, model: str, requirement: str) -> str:
+        return os.path.join(self._analysis_path(subject, model), f"{requirement}_feedback.json")
+
+    def improved_path(self, subject: str, model: str, requirement: str) -> str:
+        return os.path.join(self._analysis_path(subject, model), f"{requirement}_improved")
+
+    def write_feedback(self, subject: str, model: str, requirement: str, feedback: FeedbackCollection) -> None:
+        self._analysis_path(subject, model).mkdir(parents=True, exist_ok=True)
+        with open(self.feedback_path(subject, model, requirement), "w", encoding='utf-8') as file:
+            json.dump(feedback, file, ensure_ascii=False, indent=4)
+
+    def read_feedback(self, subject: str, model: str, requirement: str) -> Optional[FeedbackCollection]:
+        try:
+            return load_typed_json(self.feedback_path(subject, model, requirement), FeedbackCollection)
+        except FileNotFoundError:
+            return None
+
+    def has_feedback(self, subject: str, model: str, requirement: str) -> bool:
+        return os.path.isfile(self.feedback_path(subject, model, requirement))
+
+    def write_improved(self, subject: str, model: str, requirement: str, improved: ImprovedRequirement) -> None:
+        self._analysis_path(subject, model).mkdir(parents=True, exist_ok=True)
+        with open(self.improved_path(subject, model, requirement), "w", encoding='utf-8') as file:
+            file.write(str(improved))
+
+    def read_improved(self, subject: str, model: str, requirement: str) -> Optional[str]:
+        """Returns the improved requirement text of a file written by write_improved."""
+        try:
+            with open(self.improved_path(subject, model, requirement), "r", encoding='utf-8') as file:
+                content = file.read()
+        except FileNotFoundError:
+            return None
+        try:
+            value = ast.literal_eval(content)
+        except (ValueError, SyntaxError):
+            return content
+        return value.get('improved_requirement', content) if isinstance(value, dict) else content
+
+    def has_improved(self, subject: str, model: str, requirement: str) -> bool:
+        return os.path.isfile(self.improved_path(subject, model, requirement))
+
+    def iter_results(self):
+        """Yields (subject, model, requirement) for every feedback file in the tree."""
+        for feedback_file in sorted(Path(self.subjects_folder).glob("*/analysis/*/*_feedback.json")):
+            yield (feedback_file.parents[2].name, feedback_file.parent.name,
+                   feedback_file.name[:-len("_feedback.json")])
+
+
+class SqliteResultsStore(ResultsStore):
+    """Stores all results in a single SQLite database, by default in WAL mode.
+
+    Writes are buffered and committed in batches of write_batch_size rows in a single transaction. Reads flush
+    the buffer first, so a thread always sees its own writes.
+    :param journal_mode: "DELETE" for databases shared by processes on different machines, which WAL does not support.
+    """
+
+    def __init__(self, path: str = DEFAULT_DB_PATH, write_batch_size: int = DEFAULT_WRITE_BATCH_SIZE,
+                 journal_mode: str = "WAL"):
+        self.path = path
+        self.write_batch_size = write_batch_size
+        self._lock = threading.RLock()
+        self._feedback_rows: list[tuple] = []
+        self._improved_rows: list[tuple] = []
+        self._deleted: list[tuple] = []
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(f"PRAGMA journal_mode={journal_mode}")
+        self._connection.execute("PRAGMA synchronous=NORMAL" if journal_mode == "WAL" else "PRAGMA synchronous=FULL")
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS feedback (
+                subject TEXT NOT NULL,
+                model TEXT NOT NULL,
+                requirement TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                criterion_title TEXT NOT NULL,
+                criterion_explanation TEXT,
+                grade TEXT,
+                suggestion TEXT,
+                -- Model of the cascade tier whose grade was used, NULL for single models
+                decided_by TEXT,
+                PRIMARY KEY (subject, model, requirement, position)
+            );
+            CREATE TABLE IF NOT EXISTS improved (
+                subject TEXT NOT NULL,
+                model TEXT NOT NULL,
+                requirement TEXT NOT NULL,
+                improved_requirement TEXT,
+                PRIMARY KEY (subject, model, requirement)
+            );
+            CREATE INDEX IF NOT EXISTS feedback_model ON feedback (model);
+            CREATE INDEX IF NOT EXISTS feedback_requirement ON feedback (requirement);
+            CREATE INDEX IF NOT EXISTS feedback_criterion ON feedback (criterion_title);
+        """)
+        columns = {row[1] for row in self._connection.execute("PRAGMA table_info(feedback)")}
+        if "decided_by" not in columns:
+            # Databases created before cascades were supported
+            self._connection.execute("ALTER TABLE feedback ADD COLUMN decided_by TEXT")
+        self._connection.commit()
+
+    def write_feedback(self, subject: str, model: str, requirement: str, feedback: FeedbackCollection) -> None:
+        with self._lock:
+            key = (subject, model, requirement)
+            self._deleted.append(key)
+            self._feedback_rows = [row for row in self._feedback_rows if row[:3] != key]
+            for position, augmented_feedback in enumerate(feedback.get('feedback_collection', [])):
+                criterion = augmented_feedback.get('criterion', {})
+                grade = augmented_feedback.get('feedback', {})
+                self._feedback_rows.append((subject, model, requirement, position, criterion.get('title', ''),
+                                            criterion.get('explanation'), grade.get('grade'),
+                                            grade.get('suggestion'), augmented_feedback.get('decided_by')))
+            self._flush_if_needed()
+
+    def write_improved(self, subject: str, model: str, requirement: str, improved: ImprovedRequirement) -> None:
+        with self._lock:
+            self._improved_rows.append((subject, model, requirement, improved.get('improved_requirement')))
+            self._flush_if_needed()
+
+    def _flush_if_needed(self):
+        if len(self._feedback_rows) + len(self._improved_rows) >= self.write_batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Commits all buffered writes in a single transaction."""
+        with self._lock:
+            if not (self._deleted or self._feedback_rows or self._improved_rows):
+                return
+            with self._connection:
+                # Feedback is replaced as a whole, a rerun may produce fewer criteria than before
+                self._connection.executemany(
+                    "DELETE FROM feedback WHERE subject = ? AND model = ? AND requirement = ?", self._deleted)
+                self._connection.executemany("INSERT OR REPLACE INTO feedback VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                             self._feedback_rows)
+                self._connection.executemany("INSERT OR REPLACE INTO improved VALUES (?, ?, ?, ?)",
+                                             self._improved_rows)
+            self._deleted, self._feedback_rows, self._improved_rows = [], [], []
+
+    def read_feedback(self, subject: str, model: str, requirement: str) -> Optional[FeedbackCollection]:
+        with self._lock:
+            self.flush()
+            rows = self._connection.execute(
+                "SELECT criterion_title, criterion_explanation, grade, suggestion FROM feedback "
+                "WHERE subject = ? AND model = ? AND requirement = ? ORDER BY position",
+                (subject, model, requirement)).fetchall()
+        if not rows:
+            return None
+        return FeedbackCollection(feedback_collection=[
+            AugmentedFeedback(criterion={'title': title, 'explanation': explanation},
+                              feedback={'grade': grade, 'suggestion': suggestion})
+            for title, explanation, grade, suggestion in rows])
+
+    def has_improved(self, subject: str, model: str, requirement: str) -> bool:
+        with self._lock:
+            self.flush()
+            return self._connection.execute(
+                "SELECT 1 FROM improved WHERE subject = ? AND model = ? AND requirement = ?",
+                (subject, model, requirement)).fetchone() is not None
+
+    def grade_distribution(self, subject: Optional[str] = None) -> dict[str, dict[str, int]]:
+        """Returns the number of grades per model, e.g. {"gpt-4o": {"A": 10, "B": 3}}."""
+        with self._lock:
+            self.flush()
+            rows = self._connection.execute(
+                "SELECT model, grade, COUNT(*) FROM feedback WHERE (? IS NULL OR subject = ?) "
+                "GROUP BY model, grade ORDER BY model, grade", (subject, subject)).fetchall()
+        distribution: dict[str, dict[str, int]] = {}
+        for model, grade, count in rows:
+            distribution.setdefault(model, {})[grade] = count
+        return distribution
+
+    def cross_model_agreement(self, subject: Optional[str] = None) -> dict[str, dict[str, float]]:
+        """Returns, for every pair of models, the share of identical grades on the same requirement and criterion.
+
+        Each model generates its own criteria, so only criteria with the same title are compared.
+        """
+        with self._lock:
+            self.flush()
+            rows = self._connection.execute(
+                "SELECT a.model, b.model, COUNT(*), SUM(a.grade = b.grade) FROM feedback a JOIN feedback b "
+                "ON a.subject = b.subject AND a.requirement = b.requirement "
+                "AND a.criterion_title = b.criterion_title AND a.model < b.model "
+                "WHERE (? IS NULL OR a.subject = ?) GROUP BY a.model, b.model", (subject, subject)).fetchall()
+        return {f"{model_a} / {model_b}": {'compared': compared, 'agreement': agreeing / compared}
+                for model_a, model_b, compared, agreeing in rows}
+
+    def import_json_tree(self, subjects_folder: str) -> int:
+        """Imports all results written by JsonResultsStore.
+
+        :return: Number of imported requirements."""
+        json_store = JsonResultsStore(subjects_folder)
+        count = 0
+        for subject, model, requirement in json_store.iter_results():
+            self.write_feedback(subject, model, requirement, json_store.read_feedback(subject, model, requirement))
+            improved = json_store.read_improved(subject, model, requirement)
+            if improved is not None:
+                self.write_improved(subject, model, requirement, ImprovedRequirement(improved_requirement=improved))
+            count += 1
+        self.flush()
+        return count
+
+    def export_json_tree(self, subjects_folder: str) -> int:
+        """Writes all results in the layout of JsonResultsStore.
+
+        :return: Number of exported requirements."""
+        json_store = JsonResultsStore(subjects_folder)
+        with self._lock:
+            self.flush()
+            keys = self._connection.execute(
+                "SELECT DISTINCT subject, model, requirement FROM feedback").fetchall()
+            improved = {(subject, model, requirement): text for subject, model, requirement, text in
+                        self._connection.execute("SELECT * FROM improved").fetchall()}
+        for subject, model, requirement in keys:
+            json_store.write_feedback(subject, model, requirement, self.read_feedback(subject, model, requirement))
+            if (subject, model, requirement) in improved:
+                json_store.write_improved(subject, model, requirement, ImprovedRequirement(
+                    improved_requirement=improved[(subject, model, requirement)]))
+        return len(keys)
+
+    def close(self) -> None:
+        with self._lock:
+            self.flush()
+            self._connection.close()
+
+
+def create_results_store(subjects_folder: str, shared: bool = False) -> ResultsStore:
+    """Creates the store configured via the results-backend (json or sqlite) and results-db env variables.
+
+    :param shared: Whether processes on other machines may write to the store at the same time, e.g. queue workers.
+    """
+    backend = os.getenv("results-backend", "json")
+    if backend == "json":
+        return JsonResultsStore(subjects_folder)
+    elif backend == "sqlite":
+        return SqliteResultsStore(os.getenv("results-db", DEFAULT_DB_PATH), journal_mode="DELETE" if shared else "WAL")
+    else:
+        raise ValueError(f"Unsupported results backend: {backend}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Imports, exports and queries the SQLite results store.")
+    parser.add_argument("command", choices=["import", "export", "grades", "agreement"])
+    parser.add_argument("--db", default=DEFAULT_DB_PATH)
+    parser.add_argument("--subjects-folder", default="data/subjects")
+    parser.add_argument("--subject", help="restrict grades and agreement to a subject")
+    args = parser.parse_args()
+
+    store = SqliteResultsStore(args.db)
+    try:
+        if args.command == "import":
+            print(f"Imported {store.import_json_tree(args.subjects_folder)} requirements")
+        elif args.command == "export":
+            print(f"Exported {store.export_json_tree(args.subjects_folder)} requirements")
+        elif args.command == "grades":
+            print(json.dumps(store.grade_distribution(args.subject), indent=4))
+        else:
+            print(json.dumps(store.cross_model_agreement(args.subject), indent=4))
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator, Optional
+
+import telemetry
+
+DEFAULT_CONCURRENCY = 4
+# Scheduler and backend semaphore of the job running on the current thread
+_current_job = threading.local()
+JobContext = tuple[Optional["JobScheduler"], Optional[threading.BoundedSemaphore]]
+
+
+def current_job() -> JobContext:
+    """Returns the context of the job running on the current thread, to run helper threads of the job in it."""
+    return getattr(_current_job, 'scheduler', None), getattr(_current_job, 'semaphore', None)
+
+
+@contextmanager
+def running_job(job: JobContext) -> Iterator[None]:
+    """Runs the block in the context of the job, e.g. on a helper thread of the job."""
+    previous = current_job()
+    _current_job.scheduler, _current_job.semaphore = job
+    try:
+        yield
+    finally:
+        _current_job.scheduler, _current_job.semaphore = previous
+
+
+@contextmanager
+def backend_slot(backend: str) -> Iterator[None]:
+    """Holds a slot of the backend while a job of another backend sends requests to it, e.g. the cascade to its
+    tiers, so the concurrency limit of the backend also applies to these requests. Does nothing outside of a job."""
+    scheduler, semaphore = current_job()
+    if scheduler is None:
+        yield
+        return
+    slot = scheduler._semaphore(backend)
+    if slot is semaphore:
+        yield
+        return
+    with slot, running_job((scheduler, slot)):
+        yield
+
+
+@contextmanager
+def borrow_slots(count: int) -> Iterator[int]:
+    """Acquires up to count further slots of the backend of the running job, for jobs sending several requests at
+    the same time. Only slots which are free right away are acquired, so jobs waiting for each other's slots cannot
+    deadlock.
+
+    :return: Number of acquired slots, count if the current thread does not run a job of a JobScheduler.
+    """
+    semaphore = current_job()[1]
+    if semaphore is None:
+        yield count
+        return
+    borrowed = 0
+    while borrowed < count and semaphore.acquire(blocking=False):
+        borrowed += 1
+    try:
+        yield borrowed
+    finally:
+        for _ in range(borrowed):
+            semaphore.release()
+
+
+@dataclass
+class JobFailure:
+    name: str
+    error: BaseException
+    traceback: str
+
+
+@dataclass
+class RunReport:
+    total: int = 0
+    succeeded: int = 0
+    skipped: list[str] = field(default_factory=list)
+    failures: list[JobFailure] = field(default_factory=list)
+    # Wall time of every finished job in seconds, excluding the time waiting for a free backend slot
+    durations: dict[str, float] = field(default_factory=dict)
+
+    @property
+    def ok(self) -> bool:
+        return not self.failures and not self.skipped
+
+    def summary(self) -> str:
+        lines = [f"{self.succeeded}/{self.total} jobs succeeded, {len(self.failures)} failed, "
+                 f"{len(self.skipped)} skipped"]
+        for failure in self.failures:
+            lines.append(f"  FAILED {failure.name}: {failure.error!r}")
+        for name in self.skipped:
+            lines.append(f"  SKIPPED {name}: a job it depends on failed")
+        return "\n".join(lines)
+
+
+class DependencyFailed(Exception):
+    """Raised for a job that was not started because one of its dependencies did not succeed."""
+
+
+class JobScheduler:
+    """Runs pipeline jobs on a thread pool with a separate concurrency limit per backend.
+
+    Jobs only wait for the jobs they explicitly depend on, so e.g. the analysis of one requirement can run while the
+    criteria of another subject are still being generated. A failing job is recorded in the report instead of
+    aborting the run; jobs depending on it are skipped.
+    """
+
+    def __init__(self, concurrency: Optional[dict[str, int]] = None, default_concurrency: int = DEFAULT_CONCURRENCY,
+                 progress: Optional[Callable[[str], None]] = print):
+        self._concurrency = dict(concurrency or {})
+        self._default_concurrency = default_concurrency
+        self._semaphores: dict[str, threading.BoundedSemaphore] = {}
+        # One pool per backend, sized by its limit, so every backend can be saturated however many backends a run
+        # uses and the threads add up to the sum of the limits of the backends used
+        self._executors: dict[str, ThreadPoolExecutor] = {}
+        self._progress = progress
+        self._lock = threading.Lock()
+        self._report = RunReport()
+        self._pending: list[Future] = []
+
+    def _limit(self, backend: str) -> int:
+        return max(1, self._concurrency.get(backend, self._default_concurrency))
+
+    def _semaphore(self, backend: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            if backend not in self._semaphores:
+                self._semaphores[backend] = threading.BoundedSemaphore(self._limit(backend))
+            return self._semaphores[backend]
+
+    def _executor(self, backend: str) -> ThreadPoolExecutor:
+        with self._lock:
+            if backend not in self._executors:
+                self._executors[backend] = ThreadPoolExecutor(max_workers=self._limit(backend),
+                                                              thread_name_prefix=f"job-{backend}")
+            return self._executors[backend]
+
+    def submit(self, name: str, backend: str, fn: Callable[..., Any], *args,
+               after: Optional[list[Future]] = None, **kwargs) -> Future:
+        """Schedules fn(*args, **kwargs) once all futures in after have completed successfully.
+
+        :param name: Human-readable job name used for progress output and the report.
+        :param backend: Name of the backend whose concurrency limit applies to the job.
+        :param after: Futures of jobs which have to succeed before this job is started.
+        :return: Future resolving to the return value of fn.
+        """
+        result: Future = Future()
+        dependencies = list(after or [])
+        with self._lock:
+            self._report.total += 1
+            self._pending.append(result)
+
+        def run(ready: float):
+            if not result.set_running_or_notify_cancel():
+                return
+            start = None
+            semaphore = self._semaphore(backend)
+            try:
+                with semaphore:
+                    start = time.perf_counter()
+                    telemetry.job_started(start - ready)
+                    with running_job((self, semaphore)):
+                        value = fn(*args, **kwargs)
+            except BaseException as e:
+                self._record_duration(name, start)
+                self._finish(name, result, error=e, trace=traceback.format_exc())
+            else:
+                self._record_duration(name, start)
+                self._finish(name, result, value=value)
+
+        def start():
+            failed = [dependency for dependency in dependencies
+                      if dependency.cancelled() or dependency.exception() is not None]
+            if failed:
+                result.set_running_or_notify_cancel()
+                self._finish(name, result, error=DependencyFailed(name))
+            else:
+                self._executor(backend).submit(run, time.perf_counter())
+
+        if not dependencies:
+            start()
+            return result
+
+        remaining = [len(dependencies)]
+
+        def on_dependency_done(_):
+            with self._lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                start()
+
+        for dependency in dependencies:
+            dependency.add_done_callback(on_dependency_done)
+        return result
+
+    def _record_duration(self, name: str, start: Optional[float]):
+        if start is not None:
+            with self._lock:
+                self._report.durations[name] = time.perf_counter() - start
+
+    def _finish(self, name: str, result: Future, value: Any = None, error: Optional[BaseException] = None,
+                trace: str = ""):
+        with self._lock:
+            if error is None:
+                self._report.succeeded += 1
+                status = "done"
+            elif isinstance(error, DependencyFailed):
+                self._report.skipped.append(name)
+                status = "skipped"
+            else:
+                self._report.failures.append(JobFailure(name, error, trace))
+                status = f"failed ({error!r})"
+            finished = self._report.succeeded + len(self._report.skipped) + len(self._report.failures)
+            total = self._report.total
+        if self._progress is not None:
+            self._progress(f"[{finished}/{total}] {name}: {status}")
+        if error is None:
+            result.set_result(value)
+        else:
+            result.set_exception(error)
+
+    def wait(self) -> RunReport:
+        """Blocks until every submitted job has finished and returns the aggregated report."""
+        while True:
+            with self._lock:
+                pending = [future for future in self._pending if not future.done()]
+            if not pending:
+                break
+            for future in pending:
+                try:
+                    future.result()
+                except BaseException:
+                    pass
+        with self._lock:
+            executors = list(self._executors.values())
+        for executor in executors:
+            executor.shutdown(wait=True)
+        return self._report
@@ -0,0 +1,246 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+
+@dataclass
+class CallRecord:
+    """Structured record of a single LLM call."""
+    stage: str
+    backend: str
+    model: str
+    # hit, miss, refresh or bypass
+    cache: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # Time the job waited for a free backend slot before its first call
+    queue_seconds: float = 0.0
+    network_seconds: float = 0.0
+    parse_seconds: float = 0.0
+    total_seconds: float = 0.0
+    retries: int = 0
+    prompt_chars: int = 0
+    # Length of the static prefix of the prompt and whether the same prefix was sent to the model before
+    prefix_chars: int = 0
+    prefix_reused: Optional[bool] = None
+    # Only set for streamed calls: time until the first token, time generating after it and why the stream ended
+    time_to_first_token: Optional[float] = None
+    generation_seconds: float = 0.0
+    stop_reason: Optional[str] = None
+    error: Optional[str] = None
+    timestamp: float = field(default_factory=time.time)
+
+
+_local = threading.local()
+
+
+@contextmanager
+def stage(name: str):
+    """Attributes all LLM calls made by the current thread within the block to the pipeline stage."""
+    previous = getattr(_local, 'stage', None)
+    _local.stage = name
+    try:
+        yield
+    finally:
+        _local.stage = previous
+
+
+def current_stage() -> str:
+    return getattr(_local, 'stage', None) or "unknown"
+
+
+def job_started(queue_seconds: float) -> None:
+    """Called by the scheduler when a job starts, the queue time is attributed to the job's first LLM call."""
+    _local.queue_seconds = queue_seconds
+
+
+def take_queue_seconds() -> float:
+    queue_seconds = getattr(_local, 'queue_seconds', 0.0)
+    _local.queue_seconds = 0.0
+    return queue_seconds
+
+
+def current_call() -> Optional[CallRecord]:
+    """Returns the record of the LLM call in progress on this thread, so backends can add timings and tokens."""
+    return getattr(_local, 'call', None)
+
+
+@contextmanager
+def track_call(record: CallRecord):
+    previous = current_call()
+    _local.call = record
+    try:
+        yield record
+    finally:
+        _local.call = previous
+
+
+@contextmanager
+def timed(phase: str):
+    """Adds the duration of the block to the network_seconds or parse_seconds of the current call."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record = current_call()
+        if record is not None:
+            attribute = f"{phase}_seconds"
+            setattr(record, attribute, getattr(record, attribute) + time.perf_counter() - start)
+
+
+def add_tokens(prompt_tokens: Optional[int], completion_tokens: Optional[int]) -> None:
+    record = current_call()
+    if record is not None:
+        record.prompt_tokens += prompt_tokens or 0
+        record.completion_tokens += completion_tokens or 0
+
+
+def add_stream(time_to_first_token: Optional[float], generation_seconds: float, stop_reason: str) -> None:
+    """Records the timing of a streamed answer on the current call."""
+    record = current_call()
+    if record is not None:
+        record.time_to_first_token = time_to_first_token
+        record.generation_seconds += generation_seconds
+        record.stop_reason = stop_reason
+
+
+def format_stream(group: dict) -> str:
+    """Describes the average time to the first token and the generation speed of the streamed calls."""
+    line = (f"streamed: {group['streamed_calls']} calls, "
+            f"{group['first_token_seconds'] / group['streamed_calls'] * 1000:.0f}ms to the first token")
+    if group['generation_seconds']:
+        line += f", {group['streamed_tokens'] / group['generation_seconds']:.1f} tokens/s"
+    return line
+
+
+def format_prefix_reuse(group: dict) -> str:
+    """Describes how much of the sent prompts repeated an already sent prefix and the latency of those calls."""
+    line = f"shared prefix: {group['reused_prefix_chars'] / group['prompt_chars']:.0%} of prompt characters"
+    if group['cold_prefix_calls'] and group['warm_prefix_calls']:
+        cold = group['cold_prefix_network_seconds'] / group['cold_prefix_calls']
+        warm = group['warm_prefix_network_seconds'] / group['warm_prefix_calls']
+        line += (f", {cold * 1000:.0f}ms per call with a new prefix, {warm * 1000:.0f}ms with a repeated prefix "
+                 f"({(warm - cold) / cold:+.0%})" if cold else "")
+    return line
+
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+class Telemetry:
+    """Collects the records of all LLM calls of a run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.records: list[CallRecord] = []
+
+    def record(self, record: CallRecord) -> None:
+        with self._lock:
+            self.records.append(record)
+
+    def summary(self) -> dict[str, dict]:
+        """Aggregates the records per stage, backend and model."""
+        with self._lock:
+            records = list(self.records)
+        groups: dict[str, dict] = {}
+        for record in records:
+            group = groups.setdefault(f"{record.stage}/{record.backend}/{record.model}", {
+                'stage': record.stage, 'backend': record.backend, 'model': record.model,
+                'calls': 0, 'errors': 0, 'retries': 0, 'cache_hits': 0,
+                'prompt_tokens': 0, 'completion_tokens': 0,
+                'queue_seconds': 0.0, 'network_seconds': 0.0, 'parse_seconds': 0.0, 'total_seconds': 0.0,
+                'prompt_chars': 0, 'reused_prefix_chars': 0,
+                'cold_prefix_calls': 0, 'cold_prefix_network_seconds': 0.0,
+                'warm_prefix_calls': 0, 'warm_prefix_network_seconds': 0.0,
+                'streamed_calls': 0, 'streamed_tokens': 0, 'first_token_seconds': 0.0, 'generation_seconds': 0.0,
+            })
+            group['calls'] += 1
+            group['errors'] += record.error is not None
+            group['retries'] += record.retries
+            group['cache_hits'] += record.cache == "hit"
+            for key in ('prompt_tokens', 'completion_tokens', 'queue_seconds', 'network_seconds', 'parse_seconds',
+                        'total_seconds'):
+                group[key] += getattr(record, key)
+            if record.prefix_reused is not None and record.error is None:
+                group['prompt_chars'] += record.prompt_chars
+                warmth = "warm" if record.prefix_reused else "cold"
+                group['reused_prefix_chars'] += record.prefix_chars if record.prefix_reused else 0
+                group[f'{warmth}_prefix_calls'] += 1
+                group[f'{warmth}_prefix_network_seconds'] += record.network_seconds
+            if record.time_to_first_token is not None:
+                group['streamed_calls'] += 1
+                group['streamed_tokens'] += record.completion_tokens
+                group['first_token_seconds'] += record.time_to_first_token
+                group['generation_seconds'] += record.generation_seconds
+        return groups
+
+    def format_summary(self) -> str:
+        lines = []
+        for group in self.summary().values():
+            lines.append(f"{group['stage']} {group['backend']}/{group['model']}: {group['calls']} calls "
+                         f"({group['cache_hits']} cached, {group['errors']} failed, {group['retries']} retries), "
+                         f"{group['prompt_tokens']} prompt + {group['completion_tokens']} completion tokens, "
+                         f"{group['total_seconds']:.1f}s total, {group['network_seconds']:.1f}s network, "
+                         f"{group['queue_seconds']:.1f}s queued")
+            if group['prompt_chars']:
+                lines.append("  " + format_prefix_reuse(group))
+            if group['streamed_calls']:
+                lines.append("  " + format_stream(group))
+        return "\n".join(lines)
+
+    def export_jsonl(self, path: str) -> None:
+        with self._lock:
+            records = list(self.records)
+        with open(path, "w", encoding='utf-8') as file:
+            for record in records:
+                file.write(json.dumps(asdict(record), ensure_ascii=False) + "\n")
+
+    def export_prometheus(self) -> str:
+        """Returns the summary in the Prometheus text exposition format."""
+        lines = [
+            "# HELP llm_calls_total Number of LLM calls.",
+            "# TYPE llm_calls_total counter",
+        ]
+        groups = list(self.summary().values())
+        for group in groups:
+            labels = dict(stage=group['stage'], backend=group['backend'], model=group['model'])
+            lines.append(f"llm_calls_total{_labels(**labels)} {group['calls']}")
+        metrics = [
+            ("llm_call_errors_total", "Number of failed LLM calls.", "counter", lambda g: [({}, g['errors'])]),
+            ("llm_call_retries_total", "Number of retried LLM requests.", "counter", lambda g: [({}, g['retries'])]),
+            ("llm_cache_hits_total", "Number of LLM calls answered from the cache.", "counter",
+             lambda g: [({}, g['cache_hits'])]),
+            ("llm_tokens_total", "Number of tokens sent to and generated by the models.", "counter",
+             lambda g: [({'kind': 'prompt'}, g['prompt_tokens']), ({'kind': 'completion'}, g['completion_tokens'])]),
+            ("llm_prompt_chars_total", "Characters of sent prompts and of the prefixes repeated in them.", "counter",
+             lambda g: [({'kind': 'total'}, g['prompt_chars']), ({'kind': 'reused_prefix'}, g['reused_prefix_chars'])]),
+            ("llm_call_seconds_total", "Time spent in LLM calls per phase.", "counter",
+             lambda g: [({'phase': phase}, round(g[f"{phase}_seconds"], 6))
+                        for phase in ('queue', 'network', 'parse', 'total')]),
+            ("llm_streamed_calls_total", "Number of LLM calls whose answer was streamed.", "counter",
+             lambda g: [({}, g['streamed_calls'])]),
+            ("llm_stream_seconds_total", "Time of streamed calls until the first token and generating after it.",
+             "counter", lambda g: [({'phase': 'first_token'}, round(g['first_token_seconds'], 6)),
+                                   ({'phase': 'generation'}, round(g['generation_seconds'], 6))]),
+        ]
+        for name, description, metric_type, values in metrics:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for group in groups:
+                for extra_labels, value in values(group):
+                    labels = dict(stage=group['stage'], backend=group['backend'], model=group['model'],
+                                  **extra_labels)
+                    lines.append(f"{name}{_labels(**labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+_telemetry = Telemetry()
+
+
+def get_telemetry() -> Telemetry:
+    """Returns the process-wide collector used by AbstractApi."""
+    return _telemetry
@@ -0,0 +1,68 @@
+import threading
+import time
+
+import pytest
+
+from AbstractApi import AugmentedFeedback, Criteria, Criterion, FeedbackCollection
+from CascadeApi import CascadeApi, CascadeSettings
+from scheduler import JobScheduler
+from typed_decoders import DecodeError, parse_model_json
+
+
+class FakeTier:
+    """Tier answering every criterion with the same grade, or with invalid JSON."""
+    backend = "fake"
+    context_window = 8192
+
+    def __init__(self, model: str, answer: str):
+        self.model = model
+        self.seed = None
+        self.answer = answer
+        self.calls = 0
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def with_seed(self, seed):
+        return self
+
+    def analyze_requirement(self, criteria: Criteria, requirement: str) -> FeedbackCollection:
+        with self._lock:
+            self.calls += 1
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.01)
+        with self._lock:
+            self.running -= 1
+        feedback = parse_model_json(self.answer)
+        return FeedbackCollection(feedback_collection=[AugmentedFeedback(criterion=criterion, feedback=feedback)
+                                                       for criterion in criteria['criteria']])
+
+
+def test_invalid_json_is_escalated_to_the_next_tier():
+    small = FakeTier("small", '{"grade": "B", "suggestion": ')
+    large = FakeTier("large", '{"grade": "A", "suggestion": "None"}')
+    cascade = CascadeApi("cascade", settings=CascadeSettings(models=["small", "large"], seeds=1), tiers=[small, large])
+
+    result = cascade.analyze_requirement(Criteria(criteria=[Criterion(title="T", explanation="E")]), "R")
+
+    assert result['feedback_collection'][0]['decided_by'] == "large"
+    assert result['feedback_collection'][0]['feedback']['grade'] == "A"
+
+
+def test_invalid_json_is_a_decode_error():
+    with pytest.raises(DecodeError):
+        parse_model_json("not json")
+
+
+def test_tier_requests_hold_a_slot_of_the_tier_backend():
+    tier = FakeTier("small", '{"grade": "A", "suggestion": "None"}')
+    cascade = CascadeApi("cascade", settings=CascadeSettings(models=["small"], seeds=1), tiers=[tier])
+    scheduler = JobScheduler({"cascade": 4, "fake": 1}, progress=None)
+    for number in range(4):
+        scheduler.submit(f"analyze {number}", "cascade", cascade.analyze_requirement,
+                         Criteria(criteria=[Criterion(title="T", explanation="E")]), "R")
+
+    assert scheduler.wait().ok
+    assert tier.calls == 4
+    assert tier.max_running == 1
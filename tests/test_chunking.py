@@ -0,0 +1,72 @@
+import threading
+import time
+
+import pytest
+
+import chunking
+from AbstractApi import Criteria, Criterion, estimate_tokens
+from scheduler import JobScheduler
+
+
+class CountingApi:
+    """Generates one criterion per guideline section and records the most requests running at the same time."""
+    model = "counting"
+    context_window = 2000
+
+    def __init__(self):
+        self.requests = 0
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def determine_criteria(self, section: str) -> Criteria:
+        with self._lock:
+            self.requests += 1
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.02)
+        with self._lock:
+            self.running -= 1
+        return Criteria(criteria=[Criterion(title=section[:40], explanation=section)])
+
+
+def test_guideline_sections_stay_within_the_backend_limit(tmp_path, monkeypatch):
+    monkeypatch.setenv("chunk-concurrency", "8")
+    guideline = tmp_path / "guideline"
+    guideline.write_text("\n\n".join(f"Rule {number}: " + f"term{number} " * 150 for number in range(12)),
+                         encoding='utf-8')
+    api = CountingApi()
+    scheduler = JobScheduler({"llm": 3}, progress=None)
+    for _ in range(2):
+        scheduler.submit("criteria", "llm", chunking.extract_criteria, api, str(guideline))
+    report = scheduler.wait()
+
+    assert report.ok
+    sections = chunking.count_guideline_sections(api, str(guideline))
+    assert 1 < sections < 12
+    assert api.requests == 2 * sections
+    assert 1 < api.max_running <= 3
+
+
+def test_context_window_too_small_for_the_prompt(tmp_path):
+    api = CountingApi()
+    api.context_window = 400
+    with pytest.raises(ValueError, match="too small"):
+        chunking.guideline_budget(api)
+
+
+def test_trimmed_requirement_fits_the_budget_including_markers(tmp_path):
+    requirement = tmp_path / "requirement"
+    paragraphs = ["Summary of the login feature."] + [f"Unrelated paragraph {number} " + "filler " * 20
+                                                      for number in range(30)]
+    paragraphs[10] = "The login must lock the account after three failed attempts."
+    paragraphs[20] = "Failed login attempts are logged."
+    requirement.write_text("\n\n".join(paragraphs), encoding='utf-8')
+    criteria = [Criterion(title="Account lock", explanation="Failed login attempts lock the account")]
+
+    trimmed = chunking.read_requirement(str(requirement), criteria, 120)
+
+    assert estimate_tokens(trimmed) <= 120
+    assert trimmed.startswith("Summary of the login feature.")
+    assert "three failed attempts" in trimmed
+    assert trimmed.endswith(chunking.OMITTED_MARKER)
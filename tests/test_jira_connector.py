@@ -0,0 +1,101 @@
+import os
+import re
+from datetime import datetime, timedelta, timezone
+
+import jira_connector
+
+START = datetime(2024, 5, 1, 8, 0, tzinfo=timezone.utc)
+
+
+class FakeJira:
+    """Answers the JQL queries issued by jira_connector from an in-memory list of tickets."""
+
+    def __init__(self, count: int):
+        self.now = START
+        self.issues = {}
+        for number in range(1, count + 1):
+            self.add(f"ABC-{number}", f"Ticket {number}")
+        self.on_search = None
+
+    def add(self, key: str, summary: str):
+        # Several tickets share a minute, as the JQL date precision is a minute
+        self.now += timedelta(seconds=20)
+        self.issues[key] = {'summary': summary, 'description': f"Description of {key}", 'updated': self.now}
+
+    def edit(self, key: str, summary: str):
+        self.now += timedelta(seconds=20)
+        self.issues[key].update(summary=summary, updated=self.now)
+
+    def myself(self):
+        return {'timeZone': "UTC"}
+
+    def _json(self, key: str, fields: str) -> dict:
+        issue = self.issues[key]
+        values = {'summary': issue['summary'], 'description': issue['description'],
+                  'updated': issue['updated'].strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "+0000"}
+        return {'key': key, 'fields': {name: values[name] for name in fields.split(",")}}
+
+    def search_issues(self, jql, startAt=0, maxResults=50, validate_query=True, fields="*all", json_result=False):
+        if self.on_search is not None:
+            self.on_search(self, jql)
+        keys_query = re.fullmatch(r"key in \((.*)\)", jql)
+        if keys_query:
+            keys = [key for key in keys_query.group(1).split(",") if key in self.issues]
+        else:
+            match = re.fullmatch(r'\(.*\)(?: AND updated >= "(.*)")? ORDER BY updated ASC, key ASC', jql)
+            assert match, jql
+            since = datetime.strptime(match.group(1), "%Y/%m/%d %H:%M").replace(tzinfo=timezone.utc) \
+                if match.group(1) else None
+            keys = sorted((key for key, issue in self.issues.items() if since is None or issue['updated'] >= since),
+                          key=lambda key: (self.issues[key]['updated'], jira_connector._key_order(key)))
+        page = keys[startAt:startAt + maxResults]
+        return {'startAt': startAt, 'total': len(keys), 'issues': [self._json(key, fields) for key in page]}
+
+
+def read_requirement(tmp_path, key: str) -> str:
+    with open(os.path.join(tmp_path, "subject", "requirements", key), encoding='utf-8') as requirement_file:
+        return requirement_file.read()
+
+
+def test_full_sync_fetches_tickets_edited_during_the_sync(tmp_path):
+    jira = FakeJira(25)
+    edited = []
+
+    def edit_during_sync(fake, jql):
+        # Once the first page is listed, an early ticket moves to the end of "ORDER BY updated"
+        if not edited and "ORDER BY" in jql and "updated >=" in jql:
+            fake.edit("ABC-2", "Edited while syncing")
+            edited.append(True)
+
+    jira.on_search = edit_during_sync
+    changed = jira_connector.sync("subject", "project = ABC", str(tmp_path), jira, page_size=5, parallel_pages=2)
+
+    assert edited
+    # ABC-2 is written once before and once after the edit
+    assert changed == 26
+    assert sorted(os.listdir(tmp_path / "subject" / "requirements")) == sorted(jira.issues)
+    assert read_requirement(tmp_path, "ABC-2").startswith("Edited while syncing")
+
+
+def test_incremental_sync_fetches_only_changed_tickets(tmp_path):
+    jira = FakeJira(12)
+    assert jira_connector.sync("subject", "project = ABC", str(tmp_path), jira, page_size=5) == 12
+
+    jira.now += timedelta(hours=1)
+    jira.edit("ABC-3", "Changed summary")
+    jira.add("ABC-13", "New ticket")
+    queried = []
+    jira.on_search = lambda fake, jql: queried.append(jql)
+
+    assert jira_connector.sync("subject", "project = ABC", str(tmp_path), jira, page_size=5) == 2
+    assert read_requirement(tmp_path, "ABC-3").startswith("Changed summary")
+    assert read_requirement(tmp_path, "ABC-13").startswith("New ticket")
+    # Only the tickets updated since the high-water mark, minus the overlap for the search index, are downloaded
+    assert queried[-1] == "key in (ABC-12,ABC-3,ABC-13)"
+
+
+def test_sync_with_more_tickets_per_minute_than_a_page(tmp_path):
+    # Three tickets per minute, so a page may lie entirely within the minute the next page starts at
+    jira = FakeJira(10)
+    assert jira_connector.sync("subject", "project = ABC", str(tmp_path), jira, page_size=2) == 10
+    assert sorted(os.listdir(tmp_path / "subject" / "requirements")) == sorted(jira.issues)
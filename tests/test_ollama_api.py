@@ -0,0 +1,22 @@
+import httpx
+
+from OllamaApi import _generate_payload, prime_ollama_context
+
+
+def test_seed_is_passed_in_the_model_options():
+    payload = _generate_payload("prompt", "llama3.2", seed=7)
+    assert payload['options'] == {'seed': 7}
+    assert 'seed' not in payload
+
+
+def test_without_seed_the_server_chooses():
+    assert 'options' not in _generate_payload("prompt", "llama3.2")
+
+
+def test_primed_context_ends_with_the_prompt():
+    def answer(request):
+        # Context of the evaluated prompt followed by the single generated token
+        return httpx.Response(200, json={'context': [11, 12, 13, 99], 'prompt_eval_count': 3, 'eval_count': 1})
+
+    client = httpx.Client(transport=httpx.MockTransport(answer))
+    assert prime_ollama_context("prompt", "llama3.2", client, base_url="http://ollama/") == [11, 12, 13]
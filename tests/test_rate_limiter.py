@@ -0,0 +1,19 @@
+from rate_limiter import AdmissionController
+
+
+def test_window_is_halved_once_per_congestion_event():
+    controller = AdmissionController(max_concurrency=32)
+    admissions = [controller.admit() for _ in range(32)]
+    tickets = [admission.__enter__() for admission in admissions]
+    # All requests in flight are answered with 429
+    for ticket in tickets:
+        controller.on_overload(admitted=ticket)
+    for admission in admissions:
+        admission.__exit__(None, None, None)
+    assert controller.window == 16
+
+    # A request admitted after the decrease signals a new congestion event
+    with controller.admit() as ticket:
+        controller.on_overload(admitted=ticket)
+    assert controller.window == 8
+
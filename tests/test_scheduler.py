@@ -0,0 +1,26 @@
+import threading
+
+from scheduler import JobScheduler
+
+
+def test_every_backend_runs_up_to_its_limit_at_the_same_time():
+    scheduler = JobScheduler({"ollama": 2, "openai": 3}, default_concurrency=2, progress=None)
+    # Two configured backends and two using the default, nine jobs may run at once
+    limits = {"ollama": 2, "openai": 3, "mock": 2, "vertexai": 2}
+    started = threading.Barrier(sum(limits.values()) + 1, timeout=10)
+    release = threading.Event()
+
+    def job():
+        started.wait()
+        release.wait(timeout=10)
+
+    for backend, limit in limits.items():
+        for number in range(limit):
+            scheduler.submit(f"{backend} {number}", backend, job)
+    # Fails with a BrokenBarrierError if the pool cannot run all of them at once
+    started.wait()
+    release.set()
+
+    report = scheduler.wait()
+    assert report.ok
+    assert report.succeeded == 9
@@ -0,0 +1,18 @@
+import telemetry
+
+
+def test_streamed_calls_are_summarized_and_exported():
+    collector = telemetry.Telemetry()
+    for time_to_first_token in (0.1, 0.3):
+        record = telemetry.CallRecord(stage="analyze_requirement", backend="ollama", model="llama3.2", cache="miss")
+        with telemetry.track_call(record):
+            telemetry.add_tokens(100, 20)
+            telemetry.add_stream(time_to_first_token, 0.5, "complete")
+        collector.record(record)
+
+    group = collector.summary()["analyze_requirement/ollama/llama3.2"]
+    assert group['streamed_calls'] == 2
+    assert group['streamed_tokens'] == 40
+    assert "streamed: 2 calls, 200ms to the first token, 40.0 tokens/s" in collector.format_summary()
+    assert ('llm_stream_seconds_total{stage="analyze_requirement",backend="ollama",model="llama3.2",'
+            'phase="first_token"} 0.4') in collector.export_prometheus()
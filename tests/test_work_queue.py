@@ -0,0 +1,58 @@
+import threading
+import time
+
+from work_queue import WorkQueue
+
+
+def test_two_workers_process_every_job_exactly_once_after_a_lease_expires(tmp_path):
+    path = str(tmp_path / "queue.sqlite")
+    WorkQueue(path).enqueue([(f"job-{number}", "analyze", "subject", "llama3.2", None, []) for number in range(20)])
+    committed = []
+    committed_lock = threading.Lock()
+
+    # A worker which stalls on its first job without sending heartbeats
+    stalled_queue = WorkQueue(path, lease_seconds=0.2)
+    stalled = stalled_queue.claim("stalled", ["*"])
+    time.sleep(0.3)
+
+    def work(worker: str):
+        # Every worker process opens the database on its own
+        queue = WorkQueue(path, lease_seconds=0.2)
+        while queue.has_work(["llama*"]):
+            lease = queue.claim(worker, ["llama*"])
+            if lease is None:
+                time.sleep(0.05)
+                continue
+
+            def commit(name=lease.name):
+                with committed_lock:
+                    committed.append(name)
+            queue.complete(lease, commit)
+
+    workers = [threading.Thread(target=work, args=(f"worker-{number}",)) for number in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=30)
+
+    # The stalled worker lost its lease, so its output is discarded
+    assert not stalled_queue.complete(stalled, lambda: committed.append("stalled"))
+    assert sorted(committed) == sorted(f"job-{number}" for number in range(20))
+    assert stalled_queue.counts() == {'done': 20}
+
+
+def test_has_work_skips_jobs_waiting_for_models_of_other_workers(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"))
+    queue.enqueue([("criteria", "criteria", "subject", "gpt-4o", None, []),
+                   ("analyze", "analyze", "subject", "llama3.2", "R1", ["criteria"]),
+                   ("refine", "refine", "subject", "llama3.2", "R1", ["analyze"])])
+
+    assert not queue.has_work(["llama*"])
+    assert queue.blocked(["llama*"]) == 2
+    assert queue.has_work(["gpt*"])
+
+    lease = queue.claim("gpt-worker", ["gpt*"])
+    # Once a worker runs the job, the dependent jobs are worth waiting for
+    assert queue.has_work(["llama*"])
+    assert queue.complete(lease, lambda: None)
+    assert queue.claim("llama-worker", ["llama*"]).name == "analyze"
@@ -0,0 +1,154 @@
+import json
+import os
+import threading
+import types
+import typing
+from functools import lru_cache
+from typing import Any, Callable, Union
+
+import typing_extensions
+
+
+class DecodeError(ValueError):
+    """Raised when a JSON value does not match the expected type, e.g. for malformed model output."""
+
+
+Decoder = Callable[[Any, str], Any]
+
+
+def _is_optional(expected_type: Any) -> bool:
+    return typing.get_origin(expected_type) in (Union, types.UnionType) and type(None) in typing.get_args(expected_type)
+
+
+def _build(expected_type: Any) -> Decoder:
+    if expected_type is Any:
+        return lambda value, path: value
+
+    if typing_extensions.is_typeddict(expected_type):
+        hints = typing.get_type_hints(expected_type)
+        fields = [(key, _build(hint), key in expected_type.__required_keys__ and not _is_optional(hint))
+                  for key, hint in hints.items()]
+        name = expected_type.__name__
+
+        def decode_typed_dict(value, path):
+            if not isinstance(value, dict):
+                raise DecodeError(f"{path}: expected {name} object, got {type(value).__name__}")
+            result = {}
+            for key, decode_field, required in fields:
+                if key in value:
+                    result[key] = decode_field(value[key], f"{path}.{key}")
+                elif required:
+                    raise DecodeError(f"{path}: missing key '{key}' of {name}")
+                else:
+                    result[key] = None
+            return result
+        return decode_typed_dict
+
+    origin = typing.get_origin(expected_type)
+    if origin is list:
+        (item_type,) = typing.get_args(expected_type) or (Any,)
+        decode_item = _build(item_type)
+
+        def decode_list(value, path):
+            if not isinstance(value, list):
+                raise DecodeError(f"{path}: expected list, got {type(value).__name__}")
+            return [decode_item(item, f"{path}[{index}]") for index, item in enumerate(value)]
+        return decode_list
+
+    if origin is dict:
+        _, value_type = typing.get_args(expected_type) or (str, Any)
+        decode_value = _build(value_type)
+
+        def decode_dict(value, path):
+            if not isinstance(value, dict):
+                raise DecodeError(f"{path}: expected object, got {type(value).__name__}")
+            return {key: decode_value(item, f"{path}.{key}") for key, item in value.items()}
+        return decode_dict
+
+    if origin in (Union, types.UnionType):
+        options = [option for option in typing.get_args(expected_type) if option is not type(None)]
+        decoders = [_build(option) for option in options]
+        allows_none = len(options) < len(typing.get_args(expected_type))
+
+        def decode_union(value, path):
+            if value is None and allows_none:
+                return None
+            errors = []
+            for decode_option in decoders:
+                try:
+                    return decode_option(value, path)
+                except DecodeError as e:
+                    errors.append(str(e))
+            raise DecodeError("; ".join(errors) or f"{path}: unexpected null")
+        return decode_union
+
+    if expected_type in (str, bool):
+        def decode_scalar(value, path):
+            if not isinstance(value, expected_type):
+                raise DecodeError(f"{path}: expected {expected_type.__name__}, got {type(value).__name__}")
+            return value
+        return decode_scalar
+
+    if expected_type in (int, float):
+        def decode_number(value, path):
+            # bool is a subclass of int, but true/false are not valid numbers
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+                    (expected_type is int and not isinstance(value, int)):
+                raise DecodeError(f"{path}: expected {expected_type.__name__}, got {type(value).__name__}")
+            return value
+        return decode_number
+
+    raise TypeError(f"Unsupported type for decoding: {expected_type!r}")
+
+
+@lru_cache(maxsize=None)
+def compile_decoder(cls: Any) -> Callable[[Any], Any]:
+    """Returns a validating decoder for the type, e.g. a TypedDict from AbstractApi.
+
+    The type hints are resolved once, so decoding does not inspect the type again. Keys of a TypedDict whose type
+    is Optional may be missing and are set to None, all other keys are required. Unknown keys are dropped.
+    """
+    decode = _build(cls)
+    return lambda value: decode(value, "$")
+
+
+def decode(cls: Any, value: Any) -> Any:
+    return compile_decoder(cls)(value)
+
+
+def parse_model_json(text: Any) -> Any:
+    """Parses the JSON answer of a model, raising DecodeError if it is not valid JSON."""
+    if not isinstance(text, str):
+        raise DecodeError(f"$: expected a JSON answer, got {type(text).__name__}")
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError as e:
+        raise DecodeError(f"$: invalid JSON answer: {e}") from e
+
+
+def load_typed_json(path: str, cls: Any) -> Any:
+    """Loads the JSON file and decodes it as cls, raising DecodeError if it does not match."""
+    with open(path, "r", encoding='utf-8') as file:
+        return decode(cls, json.load(file))
+
+
+_file_cache: dict[tuple[str, Any], tuple[tuple[int, int], Any]] = {}
+_file_cache_lock = threading.Lock()
+
+
+def load_cached(path: str, cls: Any) -> Any:
+    """Like load_typed_json, but decodes a file only again once its modification time or size changed.
+
+    The returned object is shared between all callers and must not be modified.
+    """
+    key = (os.path.realpath(path), cls)
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _file_cache_lock:
+        cached = _file_cache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+    value = load_typed_json(path, cls)
+    with _file_cache_lock:
+        _file_cache[key] = (version, value)
+    return value
@@ -0,0 +1,412 @@
+"""Durable queue of pipeline jobs shared by several worker processes, possibly on different machines.
+
+Usage:
+    python work_queue.py enqueue                 plans the stale outputs of the configured subjects and models
+    python work_queue.py work --models 'llama*' --ollama-url http://gpu-1:11434/
+    python work_queue.py status
+"""
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from dotenv import load_dotenv
+
+DEFAULT_QUEUE_PATH = "data/queue.sqlite"
+DEFAULT_LEASE_SECONDS = 120.0
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_POLL_INTERVAL = 2.0
+
+
+@dataclass
+class Lease:
+    """A job leased by a worker. Only the holder of the current token may complete or fail the job."""
+    name: str
+    stage: str
+    subject: str
+    model: str
+    requirement: Optional[str]
+    token: str
+    attempt: int
+
+
+class WorkQueue:
+    """Jobs of the pipeline stages in a SQLite database with a rollback journal, as WAL mode needs memory shared
+    by all processes and therefore does not work for workers on different machines.
+
+    A worker leases a job whose dependencies are done and whose model matches one of the worker's patterns. The
+    lease expires unless the worker extends it by heartbeats, after which the job is leased again, up to
+    max_attempts times. A job is completed in the same transaction in which its output is written, and only if
+    the lease is still held, so the output of every job is committed exactly once even if a worker stalls.
+
+    All workers must see the same database file, e.g. on local disk or a file system with working locks.
+    """
+
+    def __init__(self, path: str = DEFAULT_QUEUE_PATH, lease_seconds: float = DEFAULT_LEASE_SECONDS,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                name TEXT PRIMARY KEY,
+                stage TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                model TEXT NOT NULL,
+                requirement TEXT,
+                -- pending, leased, done or failed
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease_owner TEXT,
+                lease_token TEXT,
+                lease_expires REAL,
+                available_at REAL NOT NULL DEFAULT 0,
+                error TEXT,
+                updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS dependencies (
+                job TEXT NOT NULL,
+                dependency TEXT NOT NULL,
+                PRIMARY KEY (job, dependency)
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, model);
+            CREATE INDEX IF NOT EXISTS dependencies_dependency ON dependencies (dependency);
+        """)
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread, transactions are started explicitly."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=DELETE")
+            connection.execute("PRAGMA synchronous=FULL")
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction, which takes the database's write lock right away so that leases cannot race."""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def enqueue(self, jobs: list[tuple[str, str, str, str, Optional[str], list[str]]]) -> int:
+        """Adds jobs or queues finished jobs again. Jobs which are pending or leased are left as they are.
+
+        :param jobs: (name, stage, subject, model, requirement, names of the jobs it depends on) per job.
+        :return: Number of jobs which are pending afterwards because of this call.
+        """
+        now = time.time()
+        queued = 0
+        with self._transaction() as connection:
+            for name, stage, subject, model, requirement, dependencies in jobs:
+                row = connection.execute("SELECT status FROM jobs WHERE name = ?", (name,)).fetchone()
+                if row is None:
+                    connection.execute(
+                        "INSERT INTO jobs (name, stage, subject, model, requirement, status, updated) "
+                        "VALUES (?, ?, ?, ?, ?, 'pending', ?)", (name, stage, subject, model, requirement, now))
+                    queued += 1
+                elif row[0] in ("done", "failed"):
+                    connection.execute(
+                        "UPDATE jobs SET status = 'pending', attempts = 0, available_at = 0, error = NULL, "
+                        "updated = ? WHERE name = ?", (now, name))
+                    queued += 1
+                connection.execute("DELETE FROM dependencies WHERE job = ?", (name,))
+                connection.executemany("INSERT OR IGNORE INTO dependencies (job, dependency) VALUES (?, ?)",
+                                       [(name, dependency) for dependency in dependencies])
+        return queued
+
+    def _expire_leases(self, connection: sqlite3.Connection, now: float):
+        expired = connection.execute("SELECT name, attempts FROM jobs WHERE status = 'leased' AND lease_expires < ?",
+                                     (now,)).fetchall()
+        for name, attempts in expired:
+            self._release(connection, name, attempts, "lease expired", now)
+
+    def _release(self, connection: sqlite3.Connection, name: str, attempts: int, error: str, now: float):
+        """Queues the job again with a backoff, or fails it and its dependents after max_attempts."""
+        if attempts < self.max_attempts:
+            connection.execute(
+                "UPDATE jobs SET status = 'pending', lease_owner = NULL, lease_token = NULL, available_at = ?, "
+                "error = ?, updated = ? WHERE name = ?", (now + min(60.0, 2.0 ** attempts), error, now, name))
+            return
+        connection.execute("UPDATE jobs SET status = 'failed', lease_owner = NULL, lease_token = NULL, error = ?, "
+                           "updated = ? WHERE name = ?", (error, now, name))
+        connection.execute("""
+            WITH RECURSIVE dependents(name) AS (
+                SELECT job FROM dependencies WHERE dependency = ?
+                UNION SELECT dependencies.job FROM dependencies JOIN dependents ON dependencies.dependency = dependents.name
+            )
+            UPDATE jobs SET status = 'failed', error = 'a job it depends on failed', updated = ?
+            WHERE name IN (SELECT name FROM dependents) AND status = 'pending'
+        """, (name, now))
+
+    @staticmethod
+    def _model_filter(patterns: list[str]) -> tuple[str, list[str]]:
+        # GLOB matches like fnmatchcase, so that e.g. 'llama*' selects the jobs of all llama models
+        return "(" + " OR ".join("model GLOB ?" for _ in patterns) + ")", list(patterns)
+
+    def claim(self, worker: str, patterns: list[str]) -> Optional[Lease]:
+        """Leases the oldest job that is ready and matches one of the model patterns, None if there is none."""
+        now = time.time()
+        model_filter, model_parameters = self._model_filter(patterns)
+        with self._transaction() as connection:
+            self._expire_leases(connection, now)
+            row = connection.execute(f"""
+                SELECT name, stage, subject, model, requirement, attempts FROM jobs
+                WHERE status = 'pending' AND available_at <= ? AND {model_filter}
+                AND NOT EXISTS (SELECT 1 FROM dependencies JOIN jobs AS dependency ON dependency.name = dependencies.dependency
+                                WHERE dependencies.job = jobs.name AND dependency.status != 'done')
+                ORDER BY rowid LIMIT 1
+            """, [now, *model_parameters]).fetchone()
+            if row is None:
+                return None
+            name, stage, subject, model, requirement, attempts = row
+            token = uuid.uuid4().hex
+            connection.execute(
+                "UPDATE jobs SET status = 'leased', attempts = ?, lease_owner = ?, lease_token = ?, "
+                "lease_expires = ?, updated = ? WHERE name = ?",
+                (attempts + 1, worker, token, now + self.lease_seconds, now, name))
+        return Lease(name, stage, subject, model, requirement, token, attempts + 1)
+
+    def heartbeat(self, lease: Lease) -> bool:
+        """Extends the lease, returns False if it was lost, e.g. because it expired and the job was leased again."""
+        now = time.time()
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET lease_expires = ?, updated = ? WHERE name = ? AND status = 'leased' "
+                "AND lease_token = ?", (now + self.lease_seconds, now, lease.name, lease.token))
+            return cursor.rowcount == 1
+
+    def complete(self, lease: Lease, commit: Callable[[], None]) -> bool:
+        """Calls commit to write the output and marks the job as done, if the lease is still held.
+
+        The database's write lock is held while commit runs, so no other worker can take over the job meanwhile.
+        :return: False if the lease was lost, in which case commit is not called.
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute("SELECT 1 FROM jobs WHERE name = ? AND status = 'leased' AND lease_token = ?",
+                                     (lease.name, lease.token)).fetchone()
+            if row is None:
+                return False
+            commit()
+            connection.execute("UPDATE jobs SET status = 'done', lease_owner = NULL, lease_token = NULL, "
+                               "error = NULL, updated = ? WHERE name = ?", (now, lease.name))
+        return True
+
+    def fail(self, lease: Lease, error: str) -> None:
+        """Queues the job again, or fails it and all jobs depending on it after max_attempts."""
+        with self._transaction() as connection:
+            row = connection.execute("SELECT attempts FROM jobs WHERE name = ? AND status = 'leased' "
+                                     "AND lease_token = ?", (lease.name, lease.token)).fetchone()
+            if row is not None:
+                self._release(connection, lease.name, row[0], error, time.time())
+
+    @staticmethod
+    def _blocked_jobs(model_filter: str) -> str:
+        """Common table expression of the jobs waiting, directly or indirectly, for a pending job of other models."""
+        return f"""WITH RECURSIVE blocked(name) AS (
+                SELECT name FROM jobs WHERE status = 'pending' AND NOT {model_filter}
+                UNION SELECT dependencies.job FROM dependencies JOIN blocked ON dependencies.dependency = blocked.name
+            )"""
+
+    def has_work(self, patterns: list[str]) -> bool:
+        """Whether jobs matching the patterns are pending or leased, i.e. whether a worker should keep polling.
+
+        Jobs which wait, directly or indirectly, for a pending job matching none of the patterns are skipped, as
+        only a worker serving other models can run that job. They are left in the queue for such a worker.
+        """
+        model_filter, model_parameters = self._model_filter(patterns)
+        row = self._connection().execute(f"""
+            {self._blocked_jobs(model_filter)}
+            SELECT 1 FROM jobs WHERE status IN ('pending', 'leased') AND {model_filter}
+            AND name NOT IN (SELECT name FROM blocked) LIMIT 1
+        """, [*model_parameters, *model_parameters]).fetchone()
+        return row is not None
+
+    def blocked(self, patterns: list[str]) -> int:
+        """Number of pending jobs matching the patterns which has_work skips."""
+        model_filter, model_parameters = self._model_filter(patterns)
+        return self._connection().execute(f"""
+            {self._blocked_jobs(model_filter)}
+            SELECT COUNT(*) FROM jobs WHERE status = 'pending' AND {model_filter}
+            AND name IN (SELECT name FROM blocked)
+        """, [*model_parameters, *model_parameters]).fetchone()[0]
+
+    def counts(self) -> dict[str, int]:
+        return dict(self._connection().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def failures(self) -> list[tuple[str, str]]:
+        return self._connection().execute(
+            "SELECT name, error FROM jobs WHERE status = 'failed' ORDER BY rowid").fetchall()
+
+
+def enqueue_subjects(queue: WorkQueue, subjects_folder: str, subjects: list[str], models: list[str]) -> int:
+    """Plans the stale outputs like app.run_pipeline and adds a job per output to the queue."""
+    import app
+    from build_manifest import BuildManifest
+
+    store = app.create_results_store(subjects_folder)
+    jobs = []
+    try:
+        for subject, model in app.unique_combinations(subjects, models):
+            manifest = BuildManifest(os.path.join(subjects_folder, subject))
+            plan = app.plan_subject(model, subject, subjects_folder, manifest, store)
+            manifest.save()
+            names = {app.stage_key(planned): planned.name for planned in plan}
+            for planned in plan:
+                dependency = names.get(app.previous_stage_key(planned))
+                requirement = planned.requirement.name if planned.requirement is not None else None
+                jobs.append((planned.name, planned.stage, subject, model, requirement,
+                             [dependency] if dependency else []))
+    finally:
+        store.close()
+    return queue.enqueue(jobs)
+
+
+def _planned_stage(lease: Lease, subjects_folder: str):
+    import app
+
+    subject_path = os.path.join(subjects_folder, lease.subject)
+    requirement = None
+    if lease.requirement is not None:
+        requirement = next(entry for entry in os.scandir(os.path.join(subject_path, "requirements"))
+                           if entry.name == lease.requirement)
+    output_path = app.stage_output_path(lease.stage, lease.model, subject_path, lease.requirement)
+    return app.PlannedStage(lease.stage, lease.subject, lease.model, output_path, requirement)
+
+
+def run_worker(queue: WorkQueue, subjects_folder: str, patterns: list[str], worker: str, concurrency: int = 4,
+               poll_interval: float = DEFAULT_POLL_INTERVAL, progress: Optional[Callable[[str], None]] = print) -> int:
+    """Works on jobs matching the model patterns until no such job is pending or leased anymore.
+
+    :return: Number of jobs this worker completed.
+    """
+    import app
+    from build_manifest import BuildManifest
+
+    store = app.create_results_store(subjects_folder, shared=True)
+    active: dict[str, Lease] = {}
+    active_lock = threading.Lock()
+    stopped = threading.Event()
+    completed = [0]
+
+    def log(message: str):
+        if progress is not None:
+            progress(f"[{worker}] {message}")
+
+    def send_heartbeats():
+        while not stopped.wait(queue.lease_seconds / 3):
+            with active_lock:
+                leases = list(active.values())
+            for lease in leases:
+                if not queue.heartbeat(lease):
+                    log(f"{lease.name}: lease lost, its result will be discarded")
+
+    def run_job(lease: Lease):
+        manifest = BuildManifest(os.path.join(subjects_folder, lease.subject))
+
+        def commit(write_and_record: Callable[[], None]):
+            def write():
+                # Other workers may have recorded outputs of the subject since the manifest was read
+                manifest.reload()
+                write_and_record()
+                store.flush()
+            if queue.complete(lease, write):
+                completed[0] += 1
+                log(f"{lease.name}: done")
+            else:
+                log(f"{lease.name}: lease lost, result discarded")
+
+        try:
+            app.build_stage(_planned_stage(lease, subjects_folder), subjects_folder, manifest, store, commit)
+        except Exception as e:
+            log(f"{lease.name}: failed in attempt {lease.attempt} ({e!r})")
+            queue.fail(lease, repr(e))
+
+    def work():
+        while True:
+            lease = queue.claim(worker, patterns)
+            if lease is None:
+                if not queue.has_work(patterns):
+                    return
+                time.sleep(poll_interval)
+                continue
+            with active_lock:
+                active[lease.name] = lease
+            try:
+                run_job(lease)
+            finally:
+                with active_lock:
+                    del active[lease.name]
+
+    heartbeat_thread = threading.Thread(target=send_heartbeats, daemon=True)
+    heartbeat_thread.start()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="worker") as executor:
+            for future in [executor.submit(work) for _ in range(concurrency)]:
+                future.result()
+    finally:
+        stopped.set()
+        store.close()
+        app.ApiFactory.close_all()
+    blocked = queue.blocked(patterns)
+    if blocked:
+        log(f"{blocked} jobs are left, they wait for jobs of models matching none of {patterns}")
+    return completed[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["enqueue", "work", "status"])
+    parser.add_argument("--queue", default=None, help=f"queue database (default: queue-db or {DEFAULT_QUEUE_PATH})")
+    parser.add_argument("--subjects-folder", default="data/subjects")
+    parser.add_argument("--models", default="*",
+                        help="comma-separated patterns of the models this worker serves, e.g. 'llama*,mock'")
+    parser.add_argument("--ollama-url", help="Ollama base URL of this worker, overrides ollama_base_url")
+    parser.add_argument("--worker-id", default=f"{socket.gethostname()}-{os.getpid()}")
+    parser.add_argument("--concurrency", type=int, default=4, help="jobs this worker runs at the same time")
+    parser.add_argument("--lease-seconds", type=float, default=DEFAULT_LEASE_SECONDS)
+    parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS)
+    args = parser.parse_args()
+
+    load_dotenv()
+    if args.ollama_url:
+        os.environ["ollama_base_url"] = args.ollama_url
+    queue = WorkQueue(args.queue or os.getenv("queue-db", DEFAULT_QUEUE_PATH), args.lease_seconds,
+                      args.max_attempts)
+    subjects_folder = os.path.abspath(args.subjects_folder)
+
+    if args.command == "enqueue":
+        subjects = json.loads(os.getenv('subjects'))
+        models = json.loads(os.getenv('models'))
+        print(f"Queued {enqueue_subjects(queue, subjects_folder, subjects, models)} jobs")
+    elif args.command == "work":
+        if os.getenv("filter-mode", "policy") == "interactive":
+            raise SystemExit("Workers cannot ask for input, use filter-mode=policy")
+        patterns = [pattern.strip() for pattern in args.models.split(",") if pattern.strip()]
+        completed = run_worker(queue, subjects_folder, patterns, args.worker_id, args.concurrency)
+        print(f"Completed {completed} jobs")
+    else:
+        print(json.dumps(queue.counts(), indent=4))
+        for name, error in queue.failures():
+            print(f"  FAILED {name}: {error}")
+
+
+if __name__ == '__main__':
+    main()